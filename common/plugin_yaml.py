@@ -1,4 +1,5 @@
 #!/usr/bin/python3
+import copy
 import os
 import yaml
 
@@ -6,6 +7,11 @@ from common import (
     constants
 )
 
+# What has been output to MASTER_YAML_OUT so far. It is loaded the first time
+# it is needed and then kept up to date by dump() so that checking or reading
+# what other parts output does not need the master yaml to be parsed again.
+MASTER_YAML = {"path": None, "tree": None}
+
 
 class HOTSOSDumper(yaml.Dumper):
     def increase_indent(self, flow=False, indentless=False):
@@ -15,29 +21,57 @@ class HOTSOSDumper(yaml.Dumper):
         return self.represent_dict(data.items())
 
 
+def _get_master_tree():
+    """
+    Returns the contents of the master yaml as a dict. It is only loaded from
+    MASTER_YAML_OUT once per run (or if MASTER_YAML_OUT changes) and is
+    updated in place with what is dumped after that.
+    """
+    if MASTER_YAML["path"] != constants.MASTER_YAML_OUT:
+        if not os.path.exists(constants.MASTER_YAML_OUT):
+            raise Exception("Master yaml path not found '{}'".
+                            format(constants.MASTER_YAML_OUT))
+
+        with open(constants.MASTER_YAML_OUT) as fd:
+            MASTER_YAML["tree"] = yaml.safe_load(fd) or {}
+
+        MASTER_YAML["path"] = constants.MASTER_YAML_OUT
+
+    return MASTER_YAML["tree"]
+
+
+def get_master_yaml():
+    """
+    Returns a copy of the contents of the master yaml as a dict. Callers get
+    a copy so that modifying it does not change what later callers see.
+    """
+    return copy.deepcopy(_get_master_tree())
+
+
 def get_master_plugin_yaml(plugin):
-    return yaml.safe_load(open(constants.MASTER_YAML_OUT)).get(plugin, {})
+    return copy.deepcopy(_get_master_tree().get(plugin, {}))
 
 
 def master_has_plugin(name):
     """Returns True if the master yaml has a top-level entry (dict key)
     with the given plugin name.
     """
-    if not os.path.exists(constants.MASTER_YAML_OUT):
-        raise Exception("Master yaml path not found '{}'".
-                        format(constants.MASTER_YAML_OUT))
-
-    master_yaml = yaml.safe_load(open(constants.MASTER_YAML_OUT))
-    return name in master_yaml
+    return name in _get_master_tree()
 
 
 def dump(data, indent=0, ensure_master_has_plugin=True, stdout=True):
 
     if ensure_master_has_plugin:
         plugin = constants.PLUGIN_NAME
+        # data is copied so that changes the caller makes to it after it
+        # has been dumped are not seen by other parts.
         if plugin and not master_has_plugin(plugin):
+            _get_master_tree()[plugin] = copy.deepcopy(data)
             data = {constants.PLUGIN_NAME: data}
         else:
+            if plugin:
+                _get_master_tree()[plugin].update(copy.deepcopy(data))
+
             indent = 2
 
     indented = []
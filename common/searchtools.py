@@ -1,53 +1,833 @@
 #!/usr/bin/python3
 import os
 
+import atexit
+import bisect
+import collections
+import datetime
+import functools
 import glob
-import gzip
+import hashlib
+import itertools
+import lzma
+import mmap
 import multiprocessing
+import multiprocessing.pool
+import pickle
+import queue
 import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 MAX_PARALLEL_TASKS_DEFAULT = 8
+# Files are searched as bytes and only matched values are decoded.
+ENCODING = "utf-8"
+# Max number of bytes copied at a time when counting lines in a buffer.
+COUNT_BLOCK_SIZE = 16 * 1024 * 1024
+# Plain files are split into chunks no smaller than this that are searched in
+# parallel.
+MIN_CHUNK_SIZE = 64 * 1024 * 1024
+# Compressed files are identified by their magic bytes.
+COMPRESSION_MAGIC = {"gzip": b"\x1f\x8b",
+                     "xz": b"\xfd7zXZ\x00",
+                     "zstd": b"\x28\xb5\x2f\xfd"}
+# Decompressed data is searched in blocks of whole lines of at least this
+# size.
+DECOMPRESS_BLOCK_SIZE = 16 * 1024 * 1024
+# Size of reads from compressed files and decompression pipes.
+DECOMPRESS_READ_SIZE = 1024 * 1024
+SEARCH_CACHE_MAX_SIZE_DEFAULT = 512 * 1024 * 1024
+# Timestamp at the start of a log line used to restrict searches to a time
+# window. Lines are expected to be in time order.
+TIMESTAMP_EXPR = r"^(\d{4}-\d{2}-\d{2})[ T](\d{2}:\d{2}:\d{2})"
+TIMESTAMP_FORMATS = ["%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S",
+                     "%Y-%m-%d %H:%M", "%Y-%m-%d"]
+# Max number of lines read looking for a line with a timestamp.
+TIMESTAMP_MAX_LINES = 100
+# Number of bytes read from each end of a file to get its first and last
+# timestamps.
+TIMESTAMP_READ_SIZE = 64 * 1024
+# Files searched for their newest matches are read backwards in blocks of
+# whole lines of about this size.
+NEWEST_BLOCK_SIZE = 4 * 1024 * 1024
+# Plain files of at least LINE_INDEX_MIN_SIZE bytes get a sparse index of their
+# lines, with an entry about every LINE_INDEX_STRIDE bytes, that is stored in
+# the search results cache and reused by subsequent searches.
+LINE_INDEX_STRIDE = 1024 * 1024
+LINE_INDEX_MIN_SIZE = 16 * 1024 * 1024
+# Logs are split into tokens, runs of these characters, for the token index.
+# Digits are excluded since they are mostly ids and counters that would bloat
+# the index.
+TOKEN_EXPR = r"[A-Za-z_]+"
+# Tokens longer than this are not indexed, instead the blocks they appear in
+# are candidates for any search of a part of a token.
+TOKEN_MAX_LEN = 64
+# The token index records which blocks of whole lines, of about this size,
+# of a file each token appears in.
+TOKEN_INDEX_BLOCK_SIZE = 64 * 1024
+# Files are searched in order of their estimated cost, largest first, which is
+# their size or, for compressed files, their size multiplied by this since
+# decompressing costs more than searching.
+COMPRESSED_COST_FACTOR = 4
+# Files read ahead of being searched are read with reads of this size.
+READ_AHEAD_BLOCK_SIZE = 16 * 1024 * 1024
+# Max number of matchers kept compiled by each search worker.
+MAX_WORKER_MATCHERS = 1024
+# Suffix of rotated logs e.g. foo.log.1 or foo.log.2.gz
+ROTATED_LOG_SUFFIX_EXPR = r"\.[0-9]+(\.(gz|xz|zst))?$"
+# Characters that give a pattern regex semantics. Parentheses are handled
+# separately since plain groups do not change what a pattern matches.
+REGEX_META_CHARS = ".^$*+?{}[]|"
+
+
+def compile_bytes(pattern, flags=0):
+    """
+    Compile a str regex pattern so that it can be used to search bytes.
+
+    Note that shorthand character classes such as whitespace are ASCII-only
+    when matching bytes.
+    """
+    return re.compile(pattern.encode(ENCODING), flags)
+
+
+def decode(value):
+    """
+    Decode a matched value. Undecodable bytes are replaced rather than
+    raising an error so that a bad line never aborts a search.
+    """
+    if value is None:
+        return None
+
+    return value.decode(ENCODING, errors="replace")
+
+
+def count_lines(buf, start, end):
+    """
+    Count the newlines in buf[start:end]. Buffers such as mmap have no count()
+    so this is done in blocks to bound the size of each copy.
+    """
+    count = 0
+    while start < end:
+        block_end = min(start + COUNT_BLOCK_SIZE, end)
+        count += buf[start:block_end].count(b"\n")
+        start = block_end
+
+    return count
+
+
+def get_compression(path):
+    """
+    Returns the name of the compression format of file path or None if it is
+    not compressed in a known format.
+    """
+    try:
+        with open(path, 'rb') as fd:
+            header = fd.read(max([len(m) for m in
+                                  COMPRESSION_MAGIC.values()]))
+    except OSError:
+        return None
+
+    for compression, magic in COMPRESSION_MAGIC.items():
+        if header.startswith(magic):
+            return compression
+
+    return None
+
+
+def _read_pipe(cmd):
+    """Yields the output of cmd as it is produced."""
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            data = proc.stdout.read(DECOMPRESS_READ_SIZE)
+            if not data:
+                break
+
+            yield data
+    finally:
+        proc.stdout.close()
+        if proc.poll() is None:
+            proc.kill()
+
+        proc.wait()
+
+
+def _read_stream(path, get_decompressor):
+    """
+    Yields the decompressed contents of path using decompressor objects
+    returned by get_decompressor. A new decompressor is used for each member
+    of the file since gzip and xz files can be concatenations of many.
+    Decompression stops at the first corrupt or truncated member.
+    """
+    with open(path, 'rb') as fd:
+        decompressor = get_decompressor()
+        try:
+            while True:
+                data = fd.read(DECOMPRESS_READ_SIZE)
+                if not data:
+                    break
+
+                while data:
+                    out = decompressor.decompress(data)
+                    if out:
+                        yield out
+
+                    if not decompressor.eof:
+                        break
+
+                    data = decompressor.unused_data
+                    decompressor = get_decompressor()
+        except (zlib.error, lzma.LZMAError, EOFError):
+            return
+
+
+def _read_zstandard(path):
+    with open(path, 'rb') as fd:
+        for data in zstandard.ZstdDecompressor().read_to_iter(
+                fd, read_size=DECOMPRESS_READ_SIZE):
+            yield data
+
+
+def get_decompressed(path, compression):
+    """
+    Get the decompressed contents of path. Decompression is done in-process
+    with large reads or, where available, by a faster external tool whose
+    output is read through a pipe.
+
+    @param path: path of a compressed file
+    @param compression: compression format as returned by get_compression()
+    @return: iterator of decompressed bytes or None if the format is not
+             supported on this host.
+    """
+    if compression == "gzip":
+        if shutil.which("pigz"):
+            return _read_pipe(["pigz", "-dc", path])
+
+        return _read_stream(path,
+                            lambda: zlib.decompressobj(zlib.MAX_WBITS | 16))
+
+    if compression == "xz":
+        return _read_stream(path, lzma.LZMADecompressor)
+
+    if compression == "zstd":
+        if zstandard:
+            return _read_zstandard(path)
+
+        if shutil.which("zstd"):
+            return _read_pipe(["zstd", "-dcq", path])
+
+    return None
+
+
+def get_blocks(chunks, block_size=None):
+    """
+    Join chunks of data into blocks of whole lines of at least block_size
+    bytes, apart from the last.
+    """
+    if block_size is None:
+        block_size = DECOMPRESS_BLOCK_SIZE
+
+    pending = []
+    size = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        size += len(chunk)
+        if size < block_size:
+            continue
+
+        data = b"".join(pending)
+        end = data.rfind(b"\n") + 1
+        if not end:
+            pending = [data]
+            continue
+
+        yield data[:end]
+        pending = [data[end:]]
+        size = len(pending[0])
+
+    if size:
+        yield b"".join(pending)
+
+
+class SearchTimeWindow(object):
+
+    def __init__(self, since=None, until=None):
+        """
+        Time window that searches of logs are restricted to. Timestamps are
+        compared as they appear in logs i.e. timezones are ignored. Lines
+        without a timestamp, such as tracebacks, belong with the line before
+        them and files whose lines have no timestamps are not restricted.
+
+        @param since: optional start of the window as a string in one of
+                      TIMESTAMP_FORMATS.
+        @param until: optional end of the window as a string in one of
+                      TIMESTAMP_FORMATS.
+        """
+        self.since = self._parse(since)
+        self.until = self._parse(until)
+        self.expr = compile_bytes(TIMESTAMP_EXPR)
+
+    @staticmethod
+    def _parse(value):
+        """
+        Returns value as a timestamp of the form YYYY-MM-DD HH:MM:SS as bytes
+        so that it can be compared with timestamps in logs.
+        """
+        if not value:
+            return None
+
+        for fmt in TIMESTAMP_FORMATS:
+            try:
+                ts = datetime.datetime.strptime(value, fmt)
+            except ValueError:
+                continue
+
+            return ts.strftime("%Y-%m-%d %H:%M:%S").encode(ENCODING)
+
+        raise Exception("invalid timestamp '{}' (expected one of {})".
+                        format(value, ", ".join(TIMESTAMP_FORMATS)))
+
+    @property
+    def active(self):
+        return bool(self.since or self.until)
+
+    def get_timestamp(self, buf, start, end, reverse=False,
+                      max_lines=TIMESTAMP_MAX_LINES):
+        """
+        Find the first line in buf[start:end], or last if reverse is True,
+        that has a timestamp.
+
+        @param start: offset of the start of a line.
+        @param max_lines: max number of lines read or None to read as many
+                          as it takes.
+        @return: tuple of (line start, line end, timestamp) or None.
+        """
+        if reverse:
+            line_end = end
+        else:
+            line_start = start
+
+        num_lines = 0
+        while max_lines is None or num_lines < max_lines:
+            num_lines += 1
+            if reverse:
+                if line_end <= start:
+                    break
+
+                line_start = buf.rfind(b"\n", start, line_end - 1) + 1
+                if line_start <= 0:
+                    line_start = start
+            else:
+                if line_start >= end:
+                    break
+
+                line_end = buf.find(b"\n", line_start, end) + 1
+                if line_end <= 0:
+                    line_end = end
+
+            ret = self.expr.match(buf[line_start:line_end])
+            if ret:
+                return line_start, line_end, b" ".join(ret.groups())
+
+            if reverse:
+                line_end = line_start
+            else:
+                line_start = line_end
+
+        return None
+
+    def get_last_timestamp(self, buf, end, known=False):
+        """
+        Returns the timestamp of the last line in buf[:end] that has one or
+        None. Only TIMESTAMP_MAX_LINES lines are read unless known is True,
+        or the first lines of buf have a timestamp, i.e. it is known that
+        buf has timestamps.
+        """
+        ret = self.get_timestamp(buf, 0, end, reverse=True)
+        if ret is None and (known or self.get_timestamp(buf, 0, end)):
+            ret = self.get_timestamp(buf, 0, end, reverse=True,
+                                     max_lines=None)
+
+        if ret:
+            return ret[2]
+
+        return None
+
+    def _find(self, buf, start, end, timestamp, after=False):
+        """
+        Binary search buf[start:end] for the first line with a timestamp not
+        before timestamp or after it if after is True. Since only
+        TIMESTAMP_MAX_LINES lines are read at each step the offset returned
+        may be before that of the exact line but is never after it.
+
+        @return: offset of the start of a line.
+        """
+        lo = start
+        hi = end
+        while lo < hi:
+            mid = (lo + hi) // 2
+            line_start = mid
+            if mid > start:
+                pos = buf.find(b"\n", mid - 1, hi)
+                line_start = pos + 1 if pos >= 0 else hi
+
+            ret = None
+            if line_start < hi:
+                ret = self.get_timestamp(buf, line_start, end)
+
+            if ret and ret[0] < hi and (ret[2] < timestamp or
+                                        (after and ret[2] == timestamp)):
+                lo = ret[1]
+            else:
+                hi = mid
+
+        return lo
+
+    def _find_next(self, buf, start, end, timestamp, after=False):
+        """
+        Find the first line in buf[start:end] with a timestamp not before
+        timestamp, or after it if after is True, reading forward from start
+        for as long as it takes.
+
+        @return: tuple of (line start, line end, timestamp) or None.
+        """
+        while True:
+            ret = self.get_timestamp(buf, start, end, max_lines=None)
+            if (ret is None or ret[2] > timestamp or
+                    (not after and ret[2] == timestamp)):
+                return ret
+
+            start = ret[1]
+
+    def get_offsets(self, buf, start, end, index=None, previous=None):
+        """
+        Restrict the range start:end of buf, which must contain lines in
+        time order, to the lines within the window. Lines without a
+        timestamp belong to the line with one before them so are only
+        within the window if it is.
+
+        @param index: optional LineIndex of buf used to narrow the range
+                      before searching it.
+        @param previous: optional timestamp of the last line with one before
+                         start, if buf does not contain it, which lines at
+                         the start of the range without a timestamp belong
+                         to.
+        @return: tuple of (start, end) offsets.
+        """
+        if not self.active or start >= end:
+            return start, end
+
+        if index:
+            index_start, index_end = index.get_time_range(self.since,
+                                                          self.until)
+            start = min(max(start, index_start), end)
+            if index_end is not None:
+                end = max(min(end, index_end), start)
+
+            if start >= end:
+                return start, end
+
+        first = self.get_timestamp(buf, start, end)
+        if previous is None and start > 0:
+            previous = self.get_last_timestamp(buf, start, bool(first))
+
+        if previous is None and not first:
+            # lines have no timestamps
+            return start, end
+
+        if not first:
+            first = self.get_timestamp(buf, start, end, max_lines=None)
+            if not first:
+                # every line belongs to the line before the range
+                if self.since and previous < self.since:
+                    return end, end
+
+                if self.until and previous > self.until:
+                    return start, start
+
+                return start, end
+
+        if self.since:
+            ret = self._find_next(buf, self._find(buf, start, end,
+                                                  self.since),
+                                  end, self.since)
+            if ret is None:
+                # every line is before the window
+                return end, end
+
+            # lines without a timestamp before the first line in the window
+            # are skipped unless they belong to a line in the window
+            if (ret[0] > first[0] or previous is None or
+                    previous < self.since):
+                start = ret[0]
+
+        if self.until:
+            ret = self._find_next(buf, max(self._find(buf, start, end,
+                                                      self.until,
+                                                      after=True), start),
+                                  end, self.until, after=True)
+            # if there is no line after the window then the lines at the end
+            # without a timestamp belong to a line in it
+            if ret:
+                end = max(ret[0], start)
+                if (ret[0] <= first[0] and previous is not None and
+                        previous > self.until):
+                    # lines before it belong to a line after the window
+                    end = start
+
+        return start, end
+
+    def get_file_timestamps(self, path):
+        """
+        Get the timestamps of the first and last lines of file path. The last
+        timestamp of compressed files is not read since that would require
+        decompressing the whole file.
+
+        @return: tuple of (first, last) timestamps, either of which may be
+                 None.
+        """
+        first = last = None
+        compression = get_compression(path)
+        try:
+            if compression:
+                chunks = get_decompressed(path, compression)
+                if chunks is None:
+                    return first, last
+
+                try:
+                    head = next(get_blocks(chunks, TIMESTAMP_READ_SIZE), b"")
+                finally:
+                    chunks.close()
+            else:
+                with open(path, 'rb') as fd:
+                    head = fd.read(TIMESTAMP_READ_SIZE)
+                    size = os.fstat(fd.fileno()).st_size
+                    tail_start = max(size - TIMESTAMP_READ_SIZE, 0)
+                    fd.seek(tail_start)
+                    tail = fd.read()
+
+                # skip partial line
+                offset = 0
+                if tail_start:
+                    offset = tail.find(b"\n") + 1
+
+                ret = self.get_timestamp(tail, offset, len(tail),
+                                         reverse=True)
+                if ret:
+                    last = ret[2]
+        except OSError:
+            return first, last
+
+        ret = self.get_timestamp(head, 0, len(head))
+        if ret:
+            first = ret[2]
+
+        return first, last
+
+    def contains(self, first, last):
+        """
+        Returns False if the period from first to last is outside the window.
+        Unknown timestamps are treated as within the window.
+        """
+        if self.until and first and first > self.until:
+            return False
+
+        if self.since and last and last < self.since:
+            return False
+
+        return True
+
+    def filter_files(self, files):
+        """
+        Remove files that contain nothing within the window.
+
+        Rotated logs are grouped so that the last timestamp of each file
+        can be taken to be no later than the first timestamp of the next
+        newer file of the same log, which avoids having to read compressed
+        files all the way to the end.
+
+        @param files: list of file paths
+        @return: list of file paths
+        """
+        if not self.active:
+            return files
+
+        timestamps = {f: self.get_file_timestamps(f) for f in files}
+        logs = {}
+        for f in files:
+            log = re.sub(ROTATED_LOG_SUFFIX_EXPR, "", f)
+            if timestamps[f][0]:
+                logs.setdefault(log, []).append(f)
+
+        for rotated in logs.values():
+            rotated = sorted(rotated, key=lambda f: timestamps[f][0])
+            for older, newer in zip(rotated, rotated[1:]):
+                if not timestamps[older][1]:
+                    timestamps[older] = (timestamps[older][0],
+                                         timestamps[newer][0])
+
+        return [f for f in files if self.contains(*timestamps[f])]
+
+
+class LineIndex(object):
+
+    def __init__(self, entries=None):
+        """
+        Sparse index of the lines of a file with an entry about every
+        LINE_INDEX_STRIDE bytes. Offsets are mapped to line numbers, and vice
+        versa, by counting lines from the nearest entry rather than from the
+        start of the file and the part of a file within a time window can be
+        found without reading it.
+
+        @param entries: list of (offset, linenumber, timestamp) in offset
+                        order where offset is that of the start of a line and
+                        timestamp is that of the line or None if it has none.
+        """
+        self.entries = entries or []
+        self.offsets = [e[0] for e in self.entries]
+        self.linenumbers = [e[1] for e in self.entries]
+
+    def __len__(self):
+        return len(self.entries)
+
+    @classmethod
+    def build(cls, buf, start=0, end=None, window=None):
+        """
+        Build an index of the range start:end of buf with line numbers
+        relative to start. Entries are moved forward to the next line with a
+        timestamp, if there is one within TIMESTAMP_MAX_LINES lines, so that
+        lines without a timestamp are never separated from the line they
+        belong to by a time range.
+
+        @param window: SearchTimeWindow used to read timestamps.
+        """
+        if end is None:
+            end = len(buf)
+
+        window = window or SearchTimeWindow()
+        entries = []
+        ln = 1
+        pos = start
+        while pos < end:
+            ts = None
+            ret = window.get_timestamp(buf, pos, end)
+            if ret:
+                ln += count_lines(buf, pos, ret[0])
+                pos, ts = ret[0], ret[2]
+
+            entries.append((pos, ln, ts))
+            next_pos = max(pos + LINE_INDEX_STRIDE, pos + 1)
+            if next_pos >= end:
+                break
+
+            line_end = buf.find(b"\n", next_pos - 1, end) + 1
+            if line_end <= 0:
+                break
+
+            ln += count_lines(buf, pos, line_end)
+            pos = line_end
+
+        return cls(entries)
+
+    def merge(self, other, line_offset):
+        """
+        Append the entries of an index of a later range of the same file.
+
+        @param line_offset: number of lines before the start of that range.
+        """
+        self.entries.extend([(offset, ln + line_offset, ts)
+                             for offset, ln, ts in other.entries])
+        self.offsets = [e[0] for e in self.entries]
+        self.linenumbers = [e[1] for e in self.entries]
+
+    def get_linenumber(self, buf, offset):
+        """Returns the number of the line containing offset."""
+        i = bisect.bisect_right(self.offsets, offset) - 1
+        if i < 0:
+            return 1 + count_lines(buf, 0, offset)
+
+        return self.linenumbers[i] + count_lines(buf, self.offsets[i], offset)
+
+    def get_offset(self, buf, linenumber):
+        """
+        Returns the offset of the start of line linenumber or the end of buf
+        if it has fewer lines.
+        """
+        i = bisect.bisect_right(self.linenumbers, linenumber) - 1
+        if i < 0:
+            offset, ln = 0, 1
+        else:
+            offset, ln = self.offsets[i], self.linenumbers[i]
+
+        while ln < linenumber:
+            offset = buf.find(b"\n", offset) + 1
+            if offset <= 0:
+                return len(buf)
+
+            ln += 1
+
+        return offset
+
+    def get_time_range(self, since=None, until=None):
+        """
+        Get the range of offsets that contains every line from since until
+        until. Entries without a timestamp are ignored.
+
+        @return: tuple of (start, end) offsets where end is None if the
+                 range extends to the end of the file.
+        """
+        start = 0
+        end = None
+        for offset, _, ts in self.entries:
+            if ts is None:
+                continue
+
+            if since and ts < since:
+                start = offset
+            elif until and ts > until:
+                end = offset
+                break
+
+        return start, end
+
+
+class SearchAggregate(object):
+    COUNT = "count"
+    SUM = "sum"
+    MIN = "min"
+    MAX = "max"
+
+    def __init__(self, group_by=None, op=COUNT, value=None):
+        """
+        A reduction applied to the matches of a search term by the search
+        workers so that only the reduced values, rather than every match, are
+        returned.
+
+        @param group_by: list of indexes of the match groups whose values
+                         make up the key that matches are grouped by.
+        @param op: one of count, sum, min or max.
+        @param value: index of the match group holding the numeric value to
+                      reduce. Required for all but count.
+        """
+        if op not in [self.COUNT, self.SUM, self.MIN, self.MAX]:
+            raise Exception("unknown aggregate op '{}'".format(op))
+
+        if op != self.COUNT and value is None:
+            raise Exception("aggregate op '{}' requires a value".format(op))
+
+        self.group_by = tuple(group_by or [])
+        self.op = op
+        self.value = value
+
+
+def get_number(value):
+    """Returns value as an int or float or None if it is not a number."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        pass
+
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def merge_aggregate(op, aggregate, key, value):
+    """
+    Merge value into the reduced value stored under key in aggregate.
+
+    @param op: SearchAggregate op
+    @param aggregate: dict of reduced values
+    @param key: group key
+    @param value: value to merge e.g. 1 to count a match
+    """
+    if key not in aggregate:
+        aggregate[key] = value
+    elif op in [SearchAggregate.COUNT, SearchAggregate.SUM]:
+        aggregate[key] += value
+    elif op == SearchAggregate.MIN:
+        aggregate[key] = min(aggregate[key], value)
+    else:
+        aggregate[key] = max(aggregate[key], value)
 
 
 class SearchDef(object):
 
-    def __init__(self, key, tag=None, hint=None):
+    def __init__(self, key, tag=None, hint=None, aggregate=None):
         """
         Add a search definition
 
         @param key: regex pattern to search for
         @param tag: optional user-friendly identifier for this search term
         @param hint: pre-search term to speed things up
+        @param aggregate: optional SearchAggregate. If provided, matches are
+                          not returned as results but reduced and retrieved
+                          with SearchResultsCollection.find_aggregate_by_tag().
+                          Terms that share a tag must use the same op.
         """
         self.key = key
         self.tag = tag
         self.hint = hint
-
-
-class SearchResultPart(object):
-
-    def __init__(self, index, value):
-        self.index = index
-        self.value = value
+        self.aggregate = aggregate
 
 
 class SearchResult(object):
+    # There can be millions of results so they are kept as small as possible.
+    __slots__ = ("tag", "source", "_linenumber", "_values")
 
-    def __init__(self, linenumber, source, search_term_tag=None):
+    def __init__(self, linenumber, source, search_term_tag=None, values=None):
+        """
+        @param linenumber: number of the line that matched or, if negative,
+                           its number counting back from the end of the file
+                           where -1 is the last line.
+        @param source: path of the file that matched
+        @param search_term_tag: tag of the search term that matched
+        @param values: optional tuple of result parts i.e. the whole match
+                       followed by each group of the match.
+        """
         self.tag = search_term_tag
         self.source = source
-        self.linenumber = linenumber
-        self._parts = {}
+        self._linenumber = linenumber
+        self._values = values or ()
+
+    @property
+    def linenumber(self):
+        if self._linenumber < 0:
+            # Only the end of the file was searched so the lines before it
+            # are only counted if the line number is needed.
+            self._linenumber += get_num_lines(self.source) + 1
+
+        return self._linenumber
+
+    @linenumber.setter
+    def linenumber(self, linenumber):
+        self._linenumber = linenumber
 
     def add(self, index, value):
-        self._parts[index] = SearchResultPart(index, value)
+        values = list(self._values)
+        if index >= len(values):
+            values.extend([None] * (index + 1 - len(values)))
+
+        values[index] = value
+        self._values = tuple(values)
 
     def get(self, index):
         """Retrieve a result part by its index."""
-        if index not in self._parts:
+        if index < 0 or index >= len(self._values):
             return None
 
-        return self._parts[index].value
+        return self._values[index]
 
 
 class SearchResultsCollection(object):
@@ -55,13 +835,55 @@ class SearchResultsCollection(object):
     def __init__(self):
         self._iter_idx = 0
         self._results = {}
+        # tag: {path: results} index so that lookups by tag do not need to
+        # scan every result.
+        self._tags = {}
+        # tag: {path: (op, reduced values)}
+        self._aggregates = {}
 
     @property
     def files(self):
         return list(self._results.keys())
 
-    def add(self, path, results):
-        self._results[path] = results
+    def _index(self, path, results):
+        for result in results:
+            if result.tag not in self._tags:
+                self._tags[result.tag] = {}
+
+            by_path = self._tags[result.tag]
+            if path not in by_path:
+                by_path[path] = [result]
+            else:
+                by_path[path].append(result)
+
+    def add(self, path, results, aggregates=None):
+        """
+        Add the results of a file.
+
+        @param path: path of the file
+        @param results: list of SearchResult
+        @param aggregates: optional dict of (op, reduced values) keyed by tag
+                           for terms that are aggregated.
+        """
+        for tag in self._aggregates:
+            self._aggregates[tag].pop(path, None)
+
+        for tag, aggregate in (aggregates or {}).items():
+            if tag not in self._aggregates:
+                self._aggregates[tag] = {}
+
+            self._aggregates[tag][path] = aggregate
+
+        if path in self._results:
+            # rebuild so that the index stays in the same path order as
+            # the results.
+            self._results[path] = results
+            self._tags = {}
+            for _path, _results in self._results.items():
+                self._index(_path, _results)
+        else:
+            self._results[path] = results
+            self._index(path, results)
 
     def find_by_path(self, path):
         if path not in self._results:
@@ -74,124 +896,2101 @@ class SearchResultsCollection(object):
 
         If no path is provided tagged results from all paths are returned.
         """
+        by_path = self._tags.get(tag)
+        if not by_path:
+            return []
+
+        if path:
+            return list(by_path.get(path, []))
+
         results = []
+        for path_results in by_path.values():
+            results.extend(path_results)
+
+        return results
+
+    def find_aggregate_by_tag(self, tag, path=None):
+        """Return the reduced values of the aggregated terms tagged with tag.
+
+        If no path is provided the values of all paths are merged.
+
+        @return: dict of reduced values keyed by tuple of group values.
+        """
+        by_path = self._aggregates.get(tag, {})
         if path:
             paths = [path]
         else:
-            paths = list(self._results.keys())
+            paths = list(by_path.keys())
 
+        merged = {}
         for path in paths:
-            for result in self._results.get(path, []):
-                if result.tag == tag:
-                    results.append(result)
+            if path not in by_path:
+                continue
 
-        return results
+            op, aggregate = by_path[path]
+            for key, value in aggregate.items():
+                merge_aggregate(op, merged, key, value)
+
+        return merged
+
+    def find_aggregates_by_path(self, path):
+        """
+        @return: dict of (op, reduced values) keyed by tag of the aggregated
+                 terms of path.
+        """
+        return {tag: by_path[path] for tag, by_path in self._aggregates.items()
+                if path in by_path}
 
     def __iter__(self):
         return iter(self._results.items())
 
 
-class FileSearcher(object):
+def get_literal(pattern):
+    """
+    If pattern is nothing more than a literal string, optionally wrapped in
+    plain capture groups, return that string otherwise return None.
 
-    def __init__(self):
-        self.paths = {}
+    @param pattern: regex pattern string
+    """
+    literal = []
+    escaped = False
+    for c in pattern:
+        if escaped:
+            # e.g. \d, \s or a backreference
+            if c.isalnum():
+                return None
 
-    @property
-    def num_cpus(self):
-        USER_MAX_PARALLEL_TASKS = int(os.environ.get('USER_MAX_PARALLEL_TASKS',
-                                                     -1))
-        if USER_MAX_PARALLEL_TASKS >= 0:
-            if USER_MAX_PARALLEL_TASKS == 0:
-                cpus = 1  # i.e. no parallelism
-            else:
-                cpus = min(USER_MAX_PARALLEL_TASKS, os.cpu_count())
+            literal.append(c)
+            escaped = False
+        elif c == "\\":
+            escaped = True
+        elif c in "()":
+            continue
+        elif c in REGEX_META_CHARS:
+            return None
         else:
-            cpus = min(MAX_PARALLEL_TASKS_DEFAULT, os.cpu_count())
+            literal.append(c)
 
-        return cpus
+    if escaped or not literal:
+        return None
 
-    def add_search_term(self, searchdef, path):
-        """Add a term to search for.
+    return ''.join(literal)
 
-        A search definition is registered against a path which can be a
-        file,  directory or glob. Any number of searches can be registered.
-        Searches are executed concurrently by file.
 
-        @param searchdef: definition of what to search for
-        @param path: path that we will be searching for this key
-        """
-        entry = {"key": re.compile(searchdef.key), "tag": searchdef.tag}
-        if searchdef.hint:
-            entry["hint"] = re.compile(searchdef.hint)
+def get_trie_pattern(literals):
+    """
+    Build a regex pattern that matches any of the given literals. The
+    literals are arranged as a trie so that the regex engine only ever
+    considers the branches that match the next character rather than trying
+    every literal at every position.
 
-        if path in self.paths:
-            self.paths[path].append(entry)
-        else:
-            self.paths[path] = [entry]
+    Since the result is used to test whether any literal is present, literals
+    that extend another literal are redundant and are dropped.
 
-    def _job_wrapper(self, pool, path, entry):
-        term_key = path
-        return pool.apply_async(self._search_task_wrapper,
-                                (entry, term_key))
+    @param literals: list of literal strings
+    """
+    trie = {}
+    for literal in literals:
+        node = trie
+        for c in literal:
+            node = node.setdefault(c, {})
 
-    def _search_task_wrapper(self, path, term_key):
-        with gzip.open(path, 'r') as fd:
-            try:
-                # test if file is gzip
-                fd.read(1)
-                fd.seek(0)
-                return self._search_task(term_key, fd, path)
-            except OSError:
-                pass
+        node[None] = True
 
-        with open(path) as fd:
-            return self._search_task(term_key, fd, path)
+    def _build(node):
+        if None in node:
+            return ""
 
-    def _search_task(self, term_key, fd, path):
-        results = []
-        for ln, line in enumerate(fd, start=1):
-            for s_term in self.paths[term_key]:
-                if type(line) == bytes:
-                    line = line.decode("utf-8")
-
-                if s_term.get("hint"):
-                    ret = s_term["hint"].search(line)
-                    if not ret:
-                        continue
+        branches = []
+        for c in sorted(node):
+            branches.append(re.escape(c) + _build(node[c]))
 
-                ret = s_term["key"].match(line)
-                if ret:
-                    r = SearchResult(ln, path, s_term.get("tag"))
-                    for i in range(0, len(ret.groups()) + 1):
-                        r.add(i, ret.group(i))
+        if len(branches) == 1:
+            return branches[0]
 
-                    results.append(r)
+        return "(?:{})".format("|".join(branches))
 
-        return results
+    return _build(trie)
 
-    def search(self):
-        results = SearchResultsCollection()
-        """Execute all the search queries.
 
-        @return: search results
+class SearchTermMatcher(object):
+
+    def __init__(self, entries):
+        """
+        Compile the search terms registered against a path into a single
+        matcher so that each line is examined once regardless of how many
+        terms are registered.
+
+        All hints, along with the keys of terms that have no hint, are
+        merged into one pre-filter pattern (literal hints are merged into a
+        trie). Lines that do not match the pre-filter cannot match any term
+        and are rejected with a single regex call. Lines that do match are
+        dispatched to the individual terms with each distinct hint evaluated
+        at most once.
+
+        @param entries: list of search term entries as created by
+                        FileSearcher.add_search_term()
         """
-        with multiprocessing.Pool(processes=self.num_cpus) as pool:
-            jobs = {}
-            for path in self.paths:
-                jobs[path] = {}
-                if os.path.isfile(path):
-                    jobs[path][path] = self._job_wrapper(pool, path, path)
-                elif os.path.isdir(path):
-                    for e in os.listdir(path):
-                        d_entry = os.path.join(path, e)
-                        jobs[path][d_entry] = self._job_wrapper(pool, path,
-                                                                d_entry)
+        self.entries = entries
+        # Workers are sent the patterns of the terms, rather than compiled
+        # patterns, along with an id under which they keep the matcher.
+        self.terms = tuple((e["key"].pattern, e.get("tag"),
+                            e["hint"].pattern if e.get("hint") else None,
+                            e.get("aggregate"), e.get("index"))
+                           for e in entries)
+        self.id = hashlib.sha1(repr(self.terms).encode()).hexdigest()
+        self.hint_literals = {}
+        literals = []
+        patterns = []
+        for entry in entries:
+            hint = entry.get("hint")
+            if hint:
+                pattern = hint.pattern.decode(ENCODING)
+                literal = get_literal(pattern)
+                if literal:
+                    self.hint_literals[hint.pattern] = literal.encode(ENCODING)
+                    literals.append(literal)
                 else:
-                    for e in glob.glob(path):
-                        jobs[path][e] = self._job_wrapper(pool, path, e)
+                    self.hint_literals[hint.pattern] = None
+                    patterns.append(pattern)
+            else:
+                pattern = entry["key"].pattern.decode(ENCODING)
+                patterns.append(r"^(?:{})".format(pattern))
+
+        # If every term has a literal hint only lines containing one of them
+        # can match so only the parts of a file that its TokenIndex says
+        # contain them need to be searched.
+        self.literals = None
+        if not patterns:
+            self.literals = list(set(self.hint_literals.values()))
+
+        if literals:
+            patterns.insert(0, get_trie_pattern(literals))
+
+        self.prefilter = self._compile_prefilter(patterns)
+
+    def __reduce__(self):
+        return get_matcher, (self.id, self.terms)
+
+    @staticmethod
+    def _compile_prefilter(patterns):
+        """
+        Returns a single compiled pattern matching any of patterns or None if
+        they cannot be safely combined in which case every line is a
+        candidate.
+        """
+        patterns = list(dict.fromkeys(patterns))
+        for pattern in patterns:
+            # numbered backreferences would refer to the wrong group once
+            # patterns are combined.
+            if re.search(r"\\[1-9]", pattern):
+                return None
+
+        try:
+            return compile_bytes("|".join(["(?:{})".format(p)
+                                           for p in patterns]), re.M)
+        except re.error:
+            return None
+
+    def match(self, line):
+        """
+        Yields (entry, match) for each search term that matches line (bytes)
+        in the order the terms were registered.
+        """
+        if self.prefilter and not self.prefilter.search(line):
+            return
+
+        hint_matches = {}
+        for entry in self.entries:
+            hint = entry.get("hint")
+            if hint:
+                pattern = hint.pattern
+                if pattern not in hint_matches:
+                    literal = self.hint_literals[pattern]
+                    if literal:
+                        hint_matches[pattern] = literal in line
+                    else:
+                        hint_matches[pattern] = bool(hint.search(line))
+
+                if not hint_matches[pattern]:
+                    continue
+
+            ret = entry["key"].match(line)
+            if ret:
+                yield entry, ret
+
+    def search_buffer(self, buf, start=0, end=None):
+        """
+        Search a buffer containing many lines e.g. a mmap of a whole file.
+
+        The pre-filter is run over the buffer so that only lines around a hit
+        are extracted and dispatched to the search terms, avoiding any per
+        line overhead for lines that cannot match. If the matcher has no
+        pre-filter every line is dispatched.
+
+        @param buf: bytes-like buffer supporting find() and rfind()
+        @param start: offset to start from. Must be the start of a line.
+        @param end: offset to stop at.
+        @return: yields (line_start, entry, match) for each match.
+        """
+        if end is None:
+            end = len(buf)
+
+        if not self.prefilter:
+            pos = start
+            while pos < end:
+                line_end = buf.find(b"\n", pos, end)
+                if line_end < 0:
+                    line_end = end
+                else:
+                    line_end += 1
+
+                for entry, ret in self.match(buf[pos:line_end]):
+                    yield pos, entry, ret
+
+                pos = line_end
+
+            return
+
+        pos = start
+        while pos < end:
+            hit = self.prefilter.search(buf, pos, end)
+            if not hit:
+                break
+
+            line_start = buf.rfind(b"\n", pos, hit.start())
+            if line_start < 0:
+                line_start = pos
+            else:
+                line_start += 1
+
+            line_end = buf.find(b"\n", hit.start(), end)
+            if line_end < 0:
+                line_end = end
+            else:
+                line_end += 1
+
+            for entry, ret in self.match(buf[line_start:line_end]):
+                yield line_start, entry, ret
+
+            pos = line_end
+
+
+# Matchers compiled by this process keyed by id. This is only used by search
+# workers so that each matcher is compiled once per worker rather than once
+# per task.
+_MATCHERS = {}
+
+
+def get_matcher(matcher_id, terms):
+    """
+    Returns the SearchTermMatcher for terms, compiling it if this process
+    has not already done so.
+
+    @param matcher_id: id of the matcher as set by SearchTermMatcher
+    @param terms: terms of the matcher as set by SearchTermMatcher
+    """
+    matcher = _MATCHERS.get(matcher_id)
+    if matcher is not None:
+        return matcher
+
+    entries = []
+    for key, tag, hint, aggregate, index in terms:
+        entry = {"key": re.compile(key), "tag": tag, "index": index}
+        if hint is not None:
+            entry["hint"] = re.compile(hint)
+
+        if aggregate:
+            entry["aggregate"] = aggregate
+
+        entries.append(entry)
+
+    if len(_MATCHERS) >= MAX_WORKER_MATCHERS:
+        _MATCHERS.clear()
+
+    matcher = SearchTermMatcher(entries)
+    _MATCHERS[matcher_id] = matcher
+    return matcher
+
+
+def run_timed(func, *args):
+    """
+    Call func with args.
+
+    @return: tuple of the time taken in seconds and the return value.
+    """
+    start = time.time()
+    ret = func(*args)
+    return time.time() - start, ret
+
+
+class SearchJob(object):
+
+    def __init__(self, path, entries):
+        """
+        A search of one file for the terms of all the registered paths that
+        reach it.
+
+        @param path: path of the file to search
+        @param entries: search term entries registered for this file
+        """
+        self.path = path
+        self.entries = entries
+        # registered path or tuple of registered paths whose terms are
+        # searched for.
+        self.term_key = None
+        # (registered path, file) pairs through which the file was reached
+        self.refs = []
+        # tuple of raw results and aggregates once collected
+        self.results = None
+        # term index: cached results
+        self.cached = {}
+        # entries that are being searched i.e. not cached
+        self.searched = []
+        self.tasks = []
+        self.chunked = False
+        self.pending = 0
+        # functions called with the job once all its tasks have completed
+        self.callbacks = []
+        # time taken by the tasks of the job in seconds
+        self.elapsed = 0
+
+    def task_done(self, _result=None):
+        """
+        Called once each task of the job has completed, successfully or not.
+        Once all have completed the job callbacks are called.
+        """
+        self.pending -= 1
+        if not self.pending:
+            for callback in self.callbacks:
+                callback(self)
+
+
+def get_file_id(path):
+    """
+    Returns a tuple that identifies the current contents of file path, such
+    that any change to the file changes it, or None if the file cannot be
+    read.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return
+
+    return (os.path.realpath(path), st.st_size, st.st_mtime_ns, st.st_ino,
+            st.st_dev)
+
+
+@functools.lru_cache(maxsize=1024)
+def _count_file_lines(file_id):
+    with open(file_id[0], 'rb') as fd:
+        try:
+            buf = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # e.g. empty file
+            return 0
+
+        with buf:
+            num_lines = count_lines(buf, 0, len(buf))
+            if len(buf) and buf[-1:] != b"\n":
+                num_lines += 1
+
+            return num_lines
+
+
+def get_num_lines(path):
+    """
+    Returns the number of lines of file path, counting a last line without a
+    newline. Counts are cached for as long as the file does not change.
+    """
+    file_id = get_file_id(path)
+    if not file_id:
+        return 0
+
+    return _count_file_lines(file_id)
+
+
+def load_pickle(path):
+    """Returns the object pickled in path or {} if it cannot be loaded."""
+    try:
+        with open(path, 'rb') as fd:
+            return pickle.load(fd)
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+        return {}
+
+
+def dump_pickle(obj, path):
+    """
+    Pickle obj to path. This is done atomically since other processes may be
+    reading it.
+    """
+    dirname = os.path.dirname(path)
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as fobj:
+            pickle.dump(obj, fobj)
+
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class SearchResultsCache(object):
+
+    def __init__(self, path, max_size=SEARCH_CACHE_MAX_SIZE_DEFAULT,
+                 window=None, newest=None):
+        """
+        Persistent on-disk cache of search results.
+
+        Results are stored in one cache file per searched file, keyed by the
+        identity of that file (real path, size, mtime and inode) so that any
+        change to the file invalidates them. Within that cache file results
+        are stored per search term, keyed by the term pattern and hint, so
+        that only terms not seen before need to be searched. The cache is
+        bounded by size with least recently used files evicted first.
+
+        The sparse line indexes of large files are stored alongside results
+        since they too are only valid for as long as the file is unchanged.
+
+        @param path: directory to store the cache in
+        @param max_size: max size in bytes of the cache
+        @param window: optional SearchTimeWindow that searches are restricted
+                       to.
+        @param newest: optional max number of newest matches per tag that
+                       searches are restricted to.
+        """
+        self.path = path
+        self.max_size = max_size
+        self.window = window
+        self.newest = newest
+
+    @staticmethod
+    def get_term_id(entry):
+        """
+        Terms are identified by their key and hint since they are all that
+        determine what is matched, along with any aggregation since that
+        determines what is stored.
+        """
+        hint = entry.get("hint")
+        term = (entry["key"].pattern, hint.pattern if hint else None)
+        if entry.get("aggregate"):
+            # reduced values are stored with the line they were first seen on
+            term += (entry["aggregate"], "seen")
+        return hashlib.sha1(repr(term).encode()).hexdigest()
+
+    def _get_cache_path(self, path, start_line=None):
+        """
+        Returns the path of the cache file for the given file or None if it
+        cannot be identified.
+        """
+        file_id = get_file_id(path)
+        if not file_id:
+            return
+
+        if start_line:
+            file_id += (start_line,)
+
+        if self.window and self.window.active:
+            # results only cover the window
+            file_id += (self.window.since, self.window.until)
+
+        if self.newest:
+            # line numbers are counted back from the end of the file
+            file_id += (self.newest, "from-end")
+
+        name = hashlib.sha1(repr(file_id).encode()).hexdigest()
+        return os.path.join(self.path, name)
+
+    def get(self, path, entries, start_line=None):
+        """
+        Get cached results for file path.
+
+        @param path: path of a file
+        @param entries: search term entries to look up
+        @param start_line: line from which the file is searched, if not the
+                           first.
+        @return: dict of cached results keyed by term index.
+        """
+        cache_path = self._get_cache_path(path, start_line)
+        if not cache_path or not os.path.exists(cache_path):
+            return {}
+
+        terms = load_pickle(cache_path)
+        cached = {}
+        for entry in entries:
+            term_id = self.get_term_id(entry)
+            if term_id in terms:
+                cached[entry["index"]] = terms[term_id]
+
+        if cached:
+            try:
+                # mark as recently used
+                os.utime(cache_path)
+            except OSError:
+                pass
+
+        return cached
+
+    def set(self, path, entries, results, start_line=None):
+        """
+        Add results for file path to the cache.
+
+        @param path: path of a file
+        @param entries: search term entries that were searched
+        @param results: dict of results keyed by term index
+        @param start_line: line from which the file was searched, if not the
+                           first.
+        """
+        cache_path = self._get_cache_path(path, start_line)
+        if not cache_path:
+            return
+
+        try:
+            terms = load_pickle(cache_path)
+            for entry in entries:
+                terms[self.get_term_id(entry)] = results[entry["index"]]
+
+            dump_pickle(terms, cache_path)
+        except OSError:
+            # The cache is only an optimisation so never fail a search.
+            pass
+
+    def _get_index_path(self, path):
+        """
+        Returns the path of the line index of the given file or None if it
+        cannot be identified. Unlike results, the index covers the whole file
+        regardless of what searches are restricted to.
+        """
+        file_id = get_file_id(path)
+        if not file_id:
+            return
+
+        name = hashlib.sha1(repr(file_id).encode()).hexdigest()
+        return os.path.join(self.path, "{}.idx".format(name))
+
+    def get_index(self, path):
+        """
+        Get the LineIndex of file path.
+
+        @return: LineIndex or None if the file has not been indexed.
+        """
+        index_path = self._get_index_path(path)
+        if not index_path or not os.path.exists(index_path):
+            return None
+
+        entries = load_pickle(index_path)
+        if not entries:
+            return None
+
+        return LineIndex(entries)
+
+    def set_index(self, path, index):
+        """Add the LineIndex of file path to the cache."""
+        index_path = self._get_index_path(path)
+        if not index_path:
+            return
+
+        try:
+            dump_pickle(index.entries, index_path)
+        except OSError:
+            pass
+
+    def evict(self):
+        """Remove least recently used cache files until within max_size."""
+        try:
+            entries = []
+            for name in os.listdir(self.path):
+                if name.startswith(".tmp"):
+                    continue
+
+                st = os.stat(os.path.join(self.path, name))
+                entries.append((st.st_mtime, st.st_size, name))
+        except OSError:
+            return
+
+        total = sum([e[1] for e in entries])
+        for _, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+
+            total -= size
+
+
+# Results of searches run up front by SearchRegistry.search(), keyed by the
+# terms they are for, so that the FileSearcher that later searches for the
+# same terms, in this process or one forked from it, gets them without
+# searching again.
+PRESEARCHED = {}
+
+# Process-wide pool of workers shared by all searches.
+_POOL = None
+_POOL_SIZE = None
+_POOL_PID = None
+
+
+def get_pool(processes):
+    """
+    Returns the process-wide pool of search workers, starting it on first
+    use. Sharing one pool avoids starting and stopping workers for every
+    search which dominates the cost of searching small files. The pool is
+    restarted if a different number of workers is needed and closed when
+    the process exits.
+
+    Since workers are forked when the pool is started they do not see any
+    later changes to module state.
+    """
+    global _POOL, _POOL_SIZE, _POOL_PID
+    if _POOL is not None and _POOL_PID != os.getpid():
+        # inherited from a parent process so not ours to use or close.
+        _POOL = None
+
+    if _POOL is not None and _POOL_SIZE != processes:
+        close_pool()
+
+    if _POOL is None:
+        _POOL = multiprocessing.Pool(processes=processes)
+        _POOL_SIZE = processes
+        _POOL_PID = os.getpid()
+
+    return _POOL
+
+
+def close_pool():
+    """Stop the shared pool of search workers if it has been started."""
+    global _POOL
+    if _POOL is None or _POOL_PID != os.getpid():
+        _POOL = None
+        return
+
+    _POOL.terminate()
+    _POOL.join()
+    _POOL = None
+
+
+atexit.register(close_pool)
+
+
+class FileReader(object):
+
+    def __init__(self, depth):
+        """
+        Reads files ahead of them being searched so that search workers find
+        them in the page cache. This is worth it on storage where the latency
+        of each read rather than the cpu limits searches e.g. NFS or CephFS.
+
+        Up to depth files are read concurrently, each with large sequential
+        reads. A file is only read once one of depth slots is free and its
+        slot is freed once it has been searched so that no more than depth
+        files are read ahead of the workers.
+
+        @param depth: number of files to read ahead.
+        """
+        self.depth = depth
+        self.slots = threading.BoundedSemaphore(depth)
+        self.pool = multiprocessing.pool.ThreadPool(depth)
+
+    @staticmethod
+    def read(path):
+        """Read file path, discarding what is read."""
+        buf = bytearray(READ_AHEAD_BLOCK_SIZE)
+        try:
+            with open(path, 'rb', buffering=0) as fd:
+                while fd.readinto(buf):
+                    pass
+        except OSError:
+            # the search of the file reports any error.
+            pass
+
+    def submit(self, path, callback):
+        """
+        Read file path then call callback. Blocks until a slot is free.
+        """
+        self.slots.acquire()
+        self.pool.apply_async(self.read, (path,),
+                              callback=lambda _: callback())
+
+    def done(self, _job=None):
+        """Free the slot of a file once it has been searched."""
+        self.slots.release()
+
+    def close(self):
+        """Wait for all files to be read and their callbacks called."""
+        self.pool.close()
+        self.pool.join()
+
+
+class TokenIndex(object):
+
+    def __init__(self, blocks, tokens, long_blocks=None):
+        """
+        Inverted index of the tokens of a file. Rather than every line, the
+        blocks of whole lines that each token appears in are recorded which
+        keeps the index small while still allowing searches for rare terms
+        to skip almost all of the file.
+
+        @param blocks: list of (offset, linenumber) of the start of each
+                       block followed by (size of file, number of lines + 1).
+        @param tokens: dict of lists of block numbers keyed by token (bytes).
+        @param long_blocks: list of block numbers of the blocks containing
+                            tokens longer than TOKEN_MAX_LEN.
+        """
+        self.blocks = blocks
+        self.tokens = tokens
+        self.long_blocks = long_blocks or []
+        self.token_expr = compile_bytes(TOKEN_EXPR)
+
+    @classmethod
+    def build(cls, buf):
+        """Build the index of a buffer containing a whole file."""
+        token_expr = compile_bytes(TOKEN_EXPR)
+        blocks = []
+        tokens = {}
+        long_blocks = []
+        pos = 0
+        ln = 1
+        while pos < len(buf):
+            end = min(pos + TOKEN_INDEX_BLOCK_SIZE, len(buf))
+            if end < len(buf):
+                end = buf.find(b"\n", end - 1) + 1 or len(buf)
+
+            block = buf[pos:end]
+            for token in set(token_expr.findall(block)):
+                if len(token) <= TOKEN_MAX_LEN:
+                    tokens.setdefault(token, []).append(len(blocks))
+                elif not long_blocks or long_blocks[-1] != len(blocks):
+                    long_blocks.append(len(blocks))
+
+            blocks.append((pos, ln))
+            ln += block.count(b"\n")
+            pos = end
+
+        blocks.append((len(buf), ln))
+        return cls(blocks, tokens, long_blocks)
+
+    def _get_token_blocks(self, token, at_start, at_end):
+        """
+        Get the blocks containing a token of a literal.
+
+        @param at_start: True if the token is known to start a token of the
+                         file i.e. it is preceded by a separator in the
+                         literal.
+        @param at_end: True if the token is known to end a token of the
+                       file.
+        @return: set of block numbers.
+        """
+        if at_start and at_end:
+            return set(self.tokens.get(token, []))
+
+        # the token may be part of one that is too long to be indexed
+        blocks = set(self.long_blocks)
+        for _token, token_blocks in self.tokens.items():
+            if at_start:
+                found = _token.startswith(token)
+            elif at_end:
+                found = _token.endswith(token)
+            else:
+                found = token in _token
+
+            if found:
+                blocks.update(token_blocks)
+
+        return blocks
+
+    def get_blocks(self, literal):
+        """
+        Get the blocks that may contain literal i.e. those that contain all
+        of its tokens.
+
+        @param literal: bytes
+        @return: set of block numbers.
+        """
+        blocks = None
+        for ret in self.token_expr.finditer(literal):
+            token = ret.group(0)
+            if len(token) > TOKEN_MAX_LEN:
+                continue
+
+            token_blocks = self._get_token_blocks(token, ret.start() > 0,
+                                                  ret.end() < len(literal))
+            if blocks is None:
+                blocks = token_blocks
+            else:
+                blocks &= token_blocks
+
+            if not blocks:
+                break
+
+        if blocks is None:
+            # nothing to look up so any block may contain it
+            return set(range(len(self.blocks) - 1))
+
+        return blocks
+
+    def get_ranges(self, literals):
+        """
+        Get the parts of the file that may contain any of literals.
+
+        @return: list of (start, end, linenumber of start) in offset order.
+        """
+        blocks = set()
+        for literal in literals:
+            blocks.update(self.get_blocks(literal))
+
+        ranges = []
+        for block in sorted(blocks):
+            start, ln = self.blocks[block]
+            end = self.blocks[block + 1][0]
+            if ranges and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], end, ranges[-1][2])
+            else:
+                ranges.append((start, end, ln))
+
+        return ranges
+
+
+class TokenIndexStore(object):
+
+    def __init__(self, path):
+        """
+        On-disk store of the token indexes of files. Indexes are keyed by the
+        identity of the file they were built from so that they are never used
+        once it has changed. Unlike the results cache, the store is not
+        bounded since indexes are only built on request.
+
+        @param path: directory to store indexes in.
+        """
+        self.path = path
+
+    def _get_index_path(self, path):
+        file_id = get_file_id(path)
+        if not file_id:
+            return
+
+        name = hashlib.sha1(repr(file_id).encode()).hexdigest()
+        return os.path.join(self.path, name)
+
+    def exists(self, path):
+        """Returns True if file path has an index."""
+        index_path = self._get_index_path(path)
+        return bool(index_path and os.path.exists(index_path))
+
+    def get(self, path):
+        """
+        Get the TokenIndex of file path.
+
+        @return: TokenIndex or None if the file has not been indexed.
+        """
+        index_path = self._get_index_path(path)
+        if not index_path:
+            return None
+
+        index = load_pickle(index_path)
+        if not index or "long-blocks" not in index:
+            # not indexed or by a version that dropped long tokens
+            return None
+
+        return TokenIndex(index["blocks"], index["tokens"],
+                          index["long-blocks"])
+
+    def _build(self, path):
+        index_path = self._get_index_path(path)
+        if not index_path or self.get(path):
+            return False
+
+        with open(path, 'rb') as fd:
+            try:
+                buf = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                return False
+
+            with buf:
+                index = TokenIndex.build(buf)
+
+        dump_pickle({"blocks": index.blocks, "tokens": index.tokens,
+                     "long-blocks": index.long_blocks}, index_path)
+        return True
+
+    def build(self, paths, num_cpus=1):
+        """
+        Index all plain files in paths. Compressed files are skipped since
+        they have to be read from the start regardless.
+
+        @param paths: list of file or directory paths. Directories are
+                      indexed recursively.
+        @param num_cpus: number of files to index in parallel.
+        @return: number of files indexed.
+        """
+        files = []
+        for path in paths:
+            if os.path.isfile(path):
+                files.append(path)
+                continue
+
+            for root, _, names in os.walk(path):
+                files.extend([os.path.join(root, name) for name in names])
+
+        files = [f for f in files
+                 if os.path.isfile(f) and not get_compression(f)]
+        return sum(get_pool(num_cpus).map(self._build, files))
+
+
+class FileSearcher(object):
+
+    def __init__(self, cache_dir=None, since=None, until=None, newest=None):
+        """
+        @param cache_dir: optional directory to cache results in. Defaults to
+                          SEARCH_CACHE_DIR.
+        @param since: optional timestamp from which to search logs. Defaults
+                      to SEARCH_SINCE.
+        @param until: optional timestamp until which to search logs. Defaults
+                      to SEARCH_UNTIL.
+        @param newest: optional max number of matches to get per tag per
+                       file. If set only the newest matches are returned, or
+                       aggregated, and plain files are searched backwards
+                       from the end so that the search stops as soon as they
+                       are found. Defaults to SEARCH_NEWEST.
+        """
+        self.paths = {}
+        # registered path(s): (merged entries, origins) as returned by
+        # _get_entries().
+        self.merged = {}
+        self.matchers = {}
+        self.start_lines = {}
+        # file: time taken to search it in seconds
+        self.timings = {}
+        self.cache_dir = cache_dir
+        # The cache and token index store used by workers. These are set
+        # when jobs are submitted since workers of the shared pool may have
+        # been started before the environment was changed.
+        self.worker_cache = None
+        self.worker_token_indexes = None
+        self.window = SearchTimeWindow(since or
+                                       os.environ.get('SEARCH_SINCE'),
+                                       until or
+                                       os.environ.get('SEARCH_UNTIL'))
+        self.newest = int(newest or os.environ.get('SEARCH_NEWEST') or 0)
+
+    def __getstate__(self):
+        """
+        Tasks are bound methods so the searcher is pickled with each of
+        them. Only what workers need is pickled, in particular not the terms
+        registered against every path since tasks are given the matcher of
+        the file they search.
+        """
+        state = self.__dict__.copy()
+        state["paths"] = {}
+        state["merged"] = {}
+        state["matchers"] = {}
+        return state
+
+    @property
+    def num_cpus(self):
+        USER_MAX_PARALLEL_TASKS = int(os.environ.get('USER_MAX_PARALLEL_TASKS',
+                                                     -1))
+        if USER_MAX_PARALLEL_TASKS >= 0:
+            if USER_MAX_PARALLEL_TASKS == 0:
+                cpus = 1  # i.e. no parallelism
+            else:
+                cpus = min(USER_MAX_PARALLEL_TASKS, os.cpu_count())
+        else:
+            cpus = min(MAX_PARALLEL_TASKS_DEFAULT, os.cpu_count())
+
+        return cpus
+
+    @property
+    def cache(self):
+        """
+        Returns the persistent results cache or None if caching is disabled
+        i.e. no cache_dir was provided and SEARCH_CACHE_DIR is not set.
+        """
+        cache_dir = self.cache_dir or os.environ.get('SEARCH_CACHE_DIR')
+        if not cache_dir:
+            return
+
+        max_size = int(os.environ.get('SEARCH_CACHE_MAX_SIZE',
+                                      SEARCH_CACHE_MAX_SIZE_DEFAULT))
+        return SearchResultsCache(cache_dir, max_size, self.window,
+                                  self.newest)
+
+    @property
+    def token_indexes(self):
+        """
+        Returns the TokenIndexStore or None if SEARCH_INDEX_DIR is not set.
+        """
+        index_dir = os.environ.get('SEARCH_INDEX_DIR')
+        if not index_dir:
+            return
+
+        return TokenIndexStore(index_dir)
+
+    @property
+    def read_ahead(self):
+        """
+        Returns the number of files to read ahead of them being searched as
+        set by SEARCH_READ_AHEAD. Files are not read ahead by default.
+        """
+        return int(os.environ.get('SEARCH_READ_AHEAD') or 0)
+
+    def _get_token_index(self, matcher_key, path, load=True):
+        """
+        Returns the TokenIndex of file path if it has one and it can be used
+        to search for the terms of the matcher, otherwise None. If load is
+        False only whether there is one is returned.
+        """
+        token_indexes = self.worker_token_indexes
+        if (not token_indexes or self.newest or
+                not self.matchers[matcher_key].literals):
+            return
+
+        if not load:
+            return token_indexes.exists(path)
+
+        return token_indexes.get(path)
+
+    def add_search_term(self, searchdef, path, owner=None):
+        """Add a term to search for.
+
+        A search definition is registered against a path which can be a
+        file,  directory or glob. Any number of searches can be registered.
+        Searches are executed concurrently by file.
+
+        @param searchdef: definition of what to search for
+        @param path: path that we will be searching for this key
+        @param owner: optional name of the consumer the term is searched
+                      for, see search_by_owner().
+        """
+        entry = {"key": compile_bytes(searchdef.key), "tag": searchdef.tag}
+        if owner is not None:
+            entry["owner"] = owner
+
+        if searchdef.hint:
+            entry["hint"] = compile_bytes(searchdef.hint)
+
+        if searchdef.aggregate:
+            entry["aggregate"] = (searchdef.aggregate.op,
+                                  searchdef.aggregate.group_by,
+                                  searchdef.aggregate.value)
+
+        if path in self.paths:
+            entry["index"] = len(self.paths[path])
+            self.paths[path].append(entry)
+        else:
+            entry["index"] = 0
+            self.paths[path] = [entry]
+
+    def set_start_line(self, path, linenumber):
+        """
+        Only search file path from line linenumber onwards e.g. when
+        following up on the results of a previous search of it. Line numbers
+        of results are still relative to the start of the file.
+
+        @param path: path of a file
+        @param linenumber: number of the first line to search
+        """
+        self.start_lines[path] = linenumber
+
+    def _get_entries(self, term_key):
+        """
+        Merge the terms registered against the paths of term_key, a path or
+        tuple of paths that reach the same file, so that each distinct term
+        is searched for once.
+
+        @return: tuple of the list of merged entries and a dict of the
+                 (path, index) of the registered terms keyed by the index of
+                 the merged entry they were merged into.
+        """
+        if term_key in self.merged:
+            return self.merged[term_key]
+
+        paths = term_key if isinstance(term_key, tuple) else (term_key,)
+        entries = []
+        origins = {}
+        # (term id, tag): index of merged entry
+        seen = {}
+        for path in paths:
+            for entry in self.paths[path]:
+                term = (SearchResultsCache.get_term_id(entry),
+                        entry.get("tag"))
+                if term not in seen:
+                    seen[term] = len(entries)
+                    origins[len(entries)] = []
+                    entries.append(dict(entry, index=len(entries)))
+
+                origins[seen[term]].append((path, entry["index"]))
+
+        self.merged[term_key] = (entries, origins)
+        return entries, origins
+
+    def _get_matcher_key(self, term_key, entries):
+        """
+        Returns the key of a matcher for entries, creating the matcher if
+        it does not already exist. Entries may be a subset of the terms
+        registered against term_key e.g. if the rest have cached results.
+        """
+        if len(entries) == len(self._get_entries(term_key)[0]):
+            matcher_key = term_key
+        else:
+            matcher_key = (term_key, tuple(e["index"] for e in entries))
+
+        if matcher_key not in self.matchers:
+            self.matchers[matcher_key] = SearchTermMatcher(entries)
+
+        return matcher_key
+
+    def _get_chunks(self, matcher_key, path):
+        """
+        If path is a plain file large enough to be worth splitting, return a
+        list of (start, end) byte ranges that are aligned to line boundaries
+        and cover the whole file, otherwise return None.
+        """
+        if (not self.matchers[matcher_key].prefilter or self.newest or
+                path in self.start_lines):
+            return
+
+        if self._get_token_index(matcher_key, path, load=False):
+            # only the parts of the file with candidate lines are searched
+            return
+
+        try:
+            size = os.path.getsize(path)
+            num_chunks = min(self.num_cpus, size // MIN_CHUNK_SIZE)
+            if num_chunks < 2:
+                return
+
+            boundaries = [0]
+            if get_compression(path):
+                return
+
+            with open(path, 'rb') as fd:
+                for i in range(1, num_chunks):
+                    fd.seek(max(size * i // num_chunks, boundaries[-1]))
+                    fd.readline()
+                    if fd.tell() >= size:
+                        break
+
+                    boundaries.append(fd.tell())
+        except OSError:
+            return
+
+        boundaries.append(size)
+        return list(zip(boundaries[:-1], boundaries[1:]))
+
+    @staticmethod
+    def _submit_tasks(pool, job, tasks):
+        """
+        Submit the tasks of a job.
+
+        @param tasks: list of (function, args) tuples.
+        """
+        # set before submitting since tasks may complete straight away.
+        job.pending = len(tasks)
+        for func, args in tasks:
+            job.tasks.append(pool.apply_async(run_timed, (func,) + args,
+                                              callback=job.task_done,
+                                              error_callback=job.task_done))
+
+    def _get_job(self, refs, cache=None, callback=None):
+        """
+        Get the search of a file for the terms of all the registered paths
+        that reach it.
+
+        @param refs: list of (registered path, file) through which the file
+                     was reached.
+        @param callback: optional function called with the job once all its
+                         tasks have completed.
+        @return: tuple of SearchJob and list of the (function, args) tasks
+                 to submit, empty if all results are cached.
+        """
+        paths = tuple(dict.fromkeys([p for p, _ in refs]))
+        term_key = paths[0] if len(paths) == 1 else paths
+        files = [f for _, f in refs]
+        entry = files[0]
+        for file in files:
+            if file in self.start_lines:
+                entry = file
+                break
+
+        job = SearchJob(entry, self._get_entries(term_key)[0])
+        job.term_key = term_key
+        job.refs = refs
+        if callback:
+            job.callbacks.append(callback)
+
+        entries = job.entries
+        if cache:
+            job.cached = cache.get(entry, entries,
+                                   self.start_lines.get(entry))
+            entries = [e for e in entries if e["index"] not in job.cached]
+            if not entries:
+                if callback:
+                    callback(job)
+
+                return job, []
+
+        matcher_key = self._get_matcher_key(term_key, entries)
+        job.searched = entries
+        chunks = self._get_chunks(matcher_key, entry)
+        matcher = self.matchers[matcher_key]
+        if not chunks:
+            tasks = [(self._search_task_wrapper,
+                      (entry, matcher_key, matcher))]
+        else:
+            job.chunked = True
+            tasks = [(self._search_task_chunk,
+                      (entry, matcher_key, matcher, start, end))
+                     for start, end in chunks]
+
+        return job, tasks
+
+    @staticmethod
+    def _merge_seen(op, aggregate, key, value, ln):
+        """
+        Merge value into aggregate as merge_aggregate() does but keeping,
+        along with the reduced value, the number of the line on which key was
+        first seen so that keys can be put back in the order they were found.
+        """
+        if key not in aggregate:
+            aggregate[key] = (value, ln)
+            return
+
+        reduced = {key: aggregate[key][0]}
+        merge_aggregate(op, reduced, key, value)
+        aggregate[key] = (reduced[key], min(aggregate[key][1], ln))
+
+    def _merge_aggregates(self, job, aggregates, task_aggregates,
+                          ln_offset=0):
+        for index, aggregate in task_aggregates.items():
+            op = job.entries[index]["aggregate"][0]
+            if index not in aggregates:
+                aggregates[index] = {}
+
+            for key, (value, ln) in aggregate.items():
+                self._merge_seen(op, aggregates[index], key, value,
+                                 ln + ln_offset)
+
+    def _get_job_results(self, job, cache=None):
+        """
+        Get the results of a job. Results from a file searched in chunks are
+        merged back in line order with line numbers made relative to the
+        start of the file. Newly searched terms are added to the cache and
+        merged with the cached ones. Results are only collected once however
+        many of the registered paths reach the file.
+
+        @return: tuple of list of (linenumber, term index, values) in line
+                 order and dict of (reduced value, first linenumber) keyed by
+                 group key, keyed by term index, for aggregated terms.
+        """
+        if job.results is not None:
+            return job.results
+
+        raw = []
+        # term index: reduced values
+        aggregates = {}
+        if not job.chunked:
+            for task in job.tasks:
+                elapsed, (task_raw, task_aggregates) = task.get()
+                job.elapsed += elapsed
+                raw.extend(task_raw)
+                self._merge_aggregates(job, aggregates, task_aggregates)
+        else:
+            offset = 0
+            line_index = LineIndex()
+            for task in job.tasks:
+                elapsed, (chunk_raw, chunk_aggregates, num_lines,
+                          chunk_index) = task.get()
+                job.elapsed += elapsed
+                for ln, index, values in chunk_raw:
+                    raw.append((ln + offset, index, values))
+
+                self._merge_aggregates(job, aggregates, chunk_aggregates,
+                                       offset)
+                if chunk_index is None:
+                    line_index = None
+                elif line_index is not None:
+                    line_index.merge(chunk_index, offset)
+
+                offset += num_lines
+
+            if cache and line_index:
+                cache.set_index(job.path, line_index)
+
+        if job.tasks:
+            self.timings[job.path] = job.elapsed
+
+        if cache and job.searched:
+            searched = {}
+            for e in job.searched:
+                if e.get("aggregate"):
+                    searched[e["index"]] = aggregates.get(e["index"], {})
+                else:
+                    searched[e["index"]] = []
+
+            for ln, index, values in raw:
+                searched[index].append((ln, values))
+
+            cache.set(job.path, job.searched, searched,
+                      self.start_lines.get(job.path))
+
+        if job.cached:
+            for index, cached_raw in job.cached.items():
+                if job.entries[index].get("aggregate"):
+                    aggregates[index] = cached_raw
+                    continue
+
+                raw.extend([(ln, index, values) for ln, values in cached_raw])
+
+            # results are ordered by line then by the order in which the
+            # terms were registered.
+            raw.sort(key=lambda r: (r[0], r[1]))
+
+        job.results = (raw, aggregates)
+        return job.results
+
+    def _get_file_results(self, job, file, cache=None, owner=None):
+        """
+        Get the results of a job for the terms registered against the paths
+        through which file was reached.
+
+        @param file: path of the file as reached through the registered
+                     paths.
+        @param owner: optional owner of the terms to get the results of.
+                      Defaults to all terms.
+        @return: tuple of list of SearchResult in line order and dict of
+                 (op, reduced values) keyed by tag for aggregated terms.
+        """
+        raw, aggregates = self._get_job_results(job, cache)
+        origins = self._get_entries(job.term_key)[1]
+        # refs are in the order the paths were registered
+        paths = {p: i for i, p in enumerate([p for p, f in job.refs
+                                             if f == file])}
+
+        def is_wanted(path, term_index):
+            if path not in paths:
+                return False
+
+            return (owner is None or
+                    self.paths[path][term_index].get("owner") == owner)
+
+        file_raw = []
+        for ln, index, values in raw:
+            for path, term_index in origins[index]:
+                if is_wanted(path, term_index):
+                    file_raw.append((ln, paths[path], term_index, path,
+                                     values))
+
+        # results are ordered by line then by the order in which the terms
+        # were registered.
+        file_raw.sort(key=lambda r: r[:3])
+        # tag: (op, list of (first linenumber, key, reduced value))
+        tag_seen = {}
+        for index, aggregate in aggregates.items():
+            for path, term_index in origins[index]:
+                if not is_wanted(path, term_index):
+                    continue
+
+                entry = self.paths[path][term_index]
+                tag = entry.get("tag")
+                if tag not in tag_seen:
+                    tag_seen[tag] = (entry["aggregate"][0], [])
+
+                tag_seen[tag][1].extend([(ln, key, value) for key, (value, ln)
+                                         in aggregate.items()])
+
+        # keys are ordered by the line on which they were first seen
+        tag_aggregates = {}
+        for tag, (op, seen) in tag_seen.items():
+            tag_aggregates[tag] = (op, {})
+            for _, key, value in sorted(seen, key=lambda s: s[0]):
+                merge_aggregate(op, tag_aggregates[tag][1], key, value)
+
+        results = [SearchResult(ln, file,
+                                self.paths[path][term_index].get("tag"),
+                                values)
+                   for ln, _, term_index, path, values in file_raw]
+        return results, tag_aggregates
+
+    def _get_line_index(self, path, buf, build=True):
+        """
+        Get the LineIndex of a plain file from the cache, building it if it
+        does not exist and build is True. Files smaller than
+        LINE_INDEX_MIN_SIZE are not indexed and nothing is indexed if caching
+        is disabled.
+
+        @return: LineIndex or None.
+        """
+        cache = self.worker_cache
+        if not cache or len(buf) < LINE_INDEX_MIN_SIZE:
+            return None
+
+        index = cache.get_index(path)
+        if index is None and build:
+            index = LineIndex.build(buf, window=self.window)
+            cache.set_index(path, index)
+
+        return index
+
+    def _search_task_chunk(self, path, matcher_key, matcher, start, end):
+        """
+        Search the range start:end of a plain file. If the file should be
+        indexed but is not, the range is indexed so that the index of the
+        file can be put together from those of its chunks.
+
+        @return: tuple of results, with line numbers relative to start,
+                 aggregates, the number of lines in the range and its
+                 LineIndex or None.
+        """
+        self.matchers[matcher_key] = matcher
+        aggregates = {}
+        with open(path, 'rb') as fd:
+            with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                index = self._get_line_index(path, buf, build=False)
+                results = self._search_task_buffer(matcher_key, buf, start,
+                                                   end, aggregates, index)
+                chunk_index = None
+                if index:
+                    num_lines = (index.get_linenumber(buf, end) -
+                                 index.get_linenumber(buf, start))
+                else:
+                    num_lines = count_lines(buf, start, end)
+                    if (self.worker_cache and
+                            len(buf) >= LINE_INDEX_MIN_SIZE):
+                        chunk_index = LineIndex.build(buf, start, end,
+                                                      self.window)
+
+                return results, aggregates, num_lines, chunk_index
+
+    def _search_task_wrapper(self, path, matcher_key, matcher):
+        """
+        Search a file.
+
+        @param matcher: SearchTermMatcher of the terms to search for.
+        @return: tuple of results and aggregates.
+        """
+        self.matchers[matcher_key] = matcher
+        aggregates = {}
+        start_line = self.start_lines.get(path)
+        compression = get_compression(path)
+        if compression:
+            chunks = get_decompressed(path, compression)
+            if chunks is not None:
+                results = self._search_task_blocks(matcher_key,
+                                                   get_blocks(chunks),
+                                                   aggregates, start_line)
+                return results, aggregates
+
+        with open(path, 'rb') as fd:
+            try:
+                buf = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                # e.g. empty or special file
+                pass
+            else:
+                with buf:
+                    # Building the index reads the whole file which newest
+                    # searches avoid so they only use an existing one.
+                    index = self._get_line_index(path, buf,
+                                                 build=not self.newest)
+                    start = 0
+                    if start_line:
+                        start = (index or LineIndex()).get_offset(buf,
+                                                                  start_line)
+
+                    token_index = self._get_token_index(matcher_key, path)
+                    if token_index:
+                        results = self._search_task_indexed(matcher_key, buf,
+                                                            token_index,
+                                                            start, aggregates)
+                    elif self.newest:
+                        results = self._search_task_newest(matcher_key, buf,
+                                                           aggregates, index,
+                                                           start)
+                    else:
+                        results = self._search_task_buffer(
+                            matcher_key, buf, start, aggregates=aggregates,
+                            index=index, first_line=start_line or 1)
+
+                    return results, aggregates
+
+            results = self._search_task(matcher_key, fd, aggregates,
+                                        start_line)
+            return results, aggregates
+
+    def _iter_blocks(self, matcher_key, blocks, start_line=None):
+        """
+        Search blocks of whole lines e.g. of decompressed data.
+
+        @param start_line: optional number of the first line to search.
+        @return: yields (linenumber, term, match) for each match.
+        """
+        ln_offset = 0
+        # timestamp of the last line with one in the blocks before
+        previous = None
+        for block in blocks:
+            num_lines = block.count(b"\n")
+            if not start_line or ln_offset + num_lines >= start_line - 1:
+                for ln, s_term, ret in self._iter_buffer(matcher_key, block,
+                                                         previous=previous):
+                    if start_line and ln + ln_offset < start_line:
+                        continue
+
+                    yield ln + ln_offset, s_term, ret
+
+            ln_offset += num_lines
+            if self.window.active:
+                # blocks without a timestamp belong to the line before them
+                previous = (self.window.get_last_timestamp(
+                    block, len(block), previous is not None) or previous)
+                if (previous and self.window.until and
+                        previous > self.window.until):
+                    # the rest is after the window
+                    break
+
+    def _search_task_blocks(self, matcher_key, blocks, aggregates=None,
+                            start_line=None):
+        """
+        Search blocks of whole lines e.g. of decompressed data.
+
+        @return: list of (linenumber, term index, values) tuples.
+        """
+        matches = self._iter_blocks(matcher_key, blocks, start_line)
+        if self.newest:
+            matches = self._get_newest(matches)
+
+        results = []
+        for ln, s_term, ret in matches:
+            self._add_result(results, aggregates, ln, s_term, ret)
+
+        return results
+
+    @staticmethod
+    def _get_values(ret):
+        return tuple(decode(ret.group(i))
+                     for i in range(0, len(ret.groups()) + 1))
+
+    def _aggregate(self, aggregates, ln, s_term, ret):
+        """Reduce a match into aggregates rather than returning it."""
+        op, group_by, value_idx = s_term["aggregate"]
+        key = tuple(decode(ret.group(i)) for i in group_by)
+        if op == SearchAggregate.COUNT:
+            value = 1
+        else:
+            value = get_number(decode(ret.group(value_idx)))
+            if value is None:
+                return
+
+        if s_term["index"] not in aggregates:
+            aggregates[s_term["index"]] = {}
+
+        self._merge_seen(op, aggregates[s_term["index"]], key, value, ln)
+
+    def _add_result(self, results, aggregates, ln, s_term, ret):
+        """
+        Add a match to results or, if its term is aggregated, aggregates.
+        """
+        if s_term.get("aggregate"):
+            if aggregates is not None:
+                self._aggregate(aggregates, ln, s_term, ret)
+        else:
+            results.append((ln, s_term["index"], self._get_values(ret)))
+
+    def _get_newest(self, matches):
+        """
+        Keep only the newest matches of each tag.
+
+        @param matches: (linenumber, term, match) tuples in line order
+        @return: list of the newest (linenumber, term, match) tuples in line
+                 order.
+        """
+        newest = {}
+        for match in matches:
+            tag = match[1].get("tag")
+            if tag not in newest:
+                newest[tag] = collections.deque(maxlen=self.newest)
+
+            newest[tag].append(match)
+
+        return sorted(itertools.chain(*newest.values()),
+                      key=lambda m: (m[0], m[1]["index"]))
+
+    def _iter_buffer(self, matcher_key, buf, start=0, end=None, index=None,
+                     first_line=1, previous=None):
+        """
+        Search the range start:end of a buffer restricted to the time window.
+
+        @param index: optional LineIndex of buf used to seek to the window
+                      and to get the line numbers of matches far apart.
+        @param first_line: number of the line at start.
+        @param previous: optional timestamp of the last line with one before
+                         buf, see SearchTimeWindow.get_offsets.
+        @return: yields (linenumber, term, match) for each match.
+        """
+        if end is None:
+            end = len(buf)
+
+        matcher = self.matchers[matcher_key]
+        window_start, end = self.window.get_offsets(buf, start, end, index,
+                                                    previous)
+        if index:
+            # line numbers from the index are relative to the start of buf
+            ln_base = index.get_linenumber(buf, start) - first_line
+            ln = index.get_linenumber(buf, window_start) - ln_base
+        else:
+            ln = first_line + count_lines(buf, start, window_start)
+
+        ln_offset = window_start
+        for line_start, s_term, ret in matcher.search_buffer(buf,
+                                                             window_start,
+                                                             end):
+            # line numbers are calculated lazily from the last match.
+            if index and line_start - ln_offset > LINE_INDEX_STRIDE:
+                ln = index.get_linenumber(buf, line_start) - ln_base
+            else:
+                ln += count_lines(buf, ln_offset, line_start)
+
+            ln_offset = line_start
+            yield ln, s_term, ret
+
+    def _search_task_buffer(self, matcher_key, buf, start=0, end=None,
+                            aggregates=None, index=None, first_line=1):
+        """
+        Search a buffer.
+
+        @param aggregates: dict in which the reduced values of aggregated
+                           terms are collected, keyed by term index.
+        @return: list of (linenumber, term index, values) tuples.
+        """
+        results = []
+        for ln, s_term, ret in self._iter_buffer(matcher_key, buf, start,
+                                                 end, index, first_line):
+            self._add_result(results, aggregates, ln, s_term, ret)
+
+        return results
+
+    def _search_task_indexed(self, matcher_key, buf, token_index, start=0,
+                             aggregates=None):
+        """
+        Search only the parts of a buffer that its TokenIndex says contain
+        the literal hints of the search terms.
+
+        @return: list of (linenumber, term index, values) tuples.
+        """
+        matcher = self.matchers[matcher_key]
+        window_start, window_end = self.window.get_offsets(buf, start,
+                                                           len(buf))
+        results = []
+        for r_start, r_end, ln in token_index.get_ranges(matcher.literals):
+            r_end = min(r_end, window_end)
+            if r_start < window_start:
+                ln += count_lines(buf, r_start, window_start)
+                r_start = window_start
+
+            ln_offset = r_start
+            for line_start, s_term, ret in matcher.search_buffer(buf, r_start,
+                                                                 r_end):
+                ln += count_lines(buf, ln_offset, line_start)
+                ln_offset = line_start
+                self._add_result(results, aggregates, ln, s_term, ret)
+
+        return results
+
+    def _search_task_newest(self, matcher_key, buf, aggregates=None,
+                            index=None, start=0):
+        """
+        Search a buffer backwards from the end, in blocks of whole lines,
+        until the newest matches of every tag have been found or the start
+        of the time window, or start, is reached.
+
+        Since only the end of the buffer is read, line numbers are counted
+        back from the end as negative numbers, see SearchResult.
+
+        @param index: optional LineIndex of buf.
+        @return: list of (linenumber, term index, values) tuples.
+        """
+        matcher = self.matchers[matcher_key]
+        tags = set([e.get("tag") for e in matcher.entries])
+        window_start, block_end = self.window.get_offsets(buf, start,
+                                                          len(buf), index)
+        # tag: newest matches as (line start, term, match) newest first
+        newest = {tag: [] for tag in tags}
+        while block_end > window_start:
+            block_start = max(block_end - NEWEST_BLOCK_SIZE, window_start)
+            if block_start > window_start:
+                block_start = buf.rfind(b"\n", window_start, block_start) + 1
+                if block_start <= 0:
+                    block_start = window_start
+
+            matches = list(matcher.search_buffer(buf, block_start,
+                                                 block_end))
+            for line_start, s_term, ret in reversed(matches):
+                tag_matches = newest[s_term.get("tag")]
+                if len(tag_matches) < self.newest:
+                    tag_matches.append((line_start, s_term, ret))
+
+            if all([len(m) >= self.newest for m in newest.values()]):
+                break
+
+            block_end = block_start
+
+        matches = sorted(itertools.chain(*newest.values()),
+                         key=lambda m: (m[0], m[1]["index"]))
+        # a last line without a newline is still a line
+        ln = -1 if len(buf) and buf[-1:] != b"\n" else 0
+        ln_offset = len(buf)
+        numbered = []
+        for line_start, s_term, ret in reversed(matches):
+            ln -= count_lines(buf, line_start, ln_offset)
+            ln_offset = line_start
+            numbered.append((ln, s_term, ret))
+
+        results = []
+        for ln, s_term, ret in reversed(numbered):
+            self._add_result(results, aggregates, ln, s_term, ret)
+
+        return results
+
+    def _search_task(self, matcher_key, fd, aggregates=None,
+                     start_line=None):
+        """
+        Search a file line by line.
+
+        @param aggregates: dict in which the reduced values of aggregated
+                           terms are collected, keyed by term index.
+        @param start_line: optional number of the first line to search.
+        @return: list of (linenumber, term index, values) tuples.
+        """
+        matcher = self.matchers[matcher_key]
+
+        def _iter_lines():
+            for ln, line in enumerate(fd, start=1):
+                if start_line and ln < start_line:
+                    continue
+
+                for s_term, ret in matcher.match(line):
+                    yield ln, s_term, ret
+
+        matches = _iter_lines()
+        if self.newest:
+            matches = self._get_newest(matches)
+
+        results = []
+        for ln, s_term, ret in matches:
+            self._add_result(results, aggregates, ln, s_term, ret)
+
+        return results
+
+    @staticmethod
+    def _get_cost(path):
+        """Returns the estimated cost of searching file path."""
+        try:
+            cost = os.path.getsize(path)
+        except OSError:
+            return 0
+
+        if get_compression(path):
+            cost *= COMPRESSED_COST_FACTOR
+
+        return cost
+
+    @staticmethod
+    def _get_file_key(path):
+        """
+        Returns what identifies the file at path such that the same file
+        reached through different paths, symlinks or hard links has the same
+        key.
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return os.path.realpath(path)
+
+        return (st.st_dev, st.st_ino)
+
+    def _submit_jobs(self, cache, callback=None, pool=None):
+        """
+        Submit a job for every file matching the registered paths.
+
+        A file reached through more than one registered path, e.g. a glob
+        and a directory, is only searched once, for the terms of all of
+        them.
+
+        Jobs are submitted largest first so that the pool is not left
+        waiting on a large file submitted last while the other workers are
+        idle. If files are read ahead, each job is only submitted once its
+        file has been read.
+
+        @param pool: optional pool to submit jobs to. Defaults to the shared
+                     pool which is only started if a file needs searching
+                     i.e. its results are not all cached.
+        @return: dict of jobs keyed by registered path then file in the
+                 order the paths were registered. Files reached through more
+                 than one path share the same job.
+        """
+        self.worker_cache = cache
+        self.worker_token_indexes = self.token_indexes
+        jobs = {}
+        # file key: (registered path, file) pairs that reach it
+        refs = {}
+        costs = {}
+        for path in self.paths:
+            jobs[path] = {}
+            if os.path.isfile(path):
+                files = [path]
+            elif os.path.isdir(path):
+                files = [os.path.join(path, e) for e in os.listdir(path)]
+            else:
+                files = glob.glob(path)
+
+            for file in self.window.filter_files(files):
+                # set now so that jobs are kept in registration order
+                jobs[path][file] = None
+                file_key = self._get_file_key(file)
+                if file_key not in refs:
+                    refs[file_key] = []
+                    costs[file_key] = self._get_cost(file)
+
+                refs[file_key].append((path, file))
+
+        # (job, tasks) of files that need searching
+        pending = []
+        for file_key in sorted(costs, key=lambda k: costs[k], reverse=True):
+            job, tasks = self._get_job(refs[file_key], cache, callback)
+            if tasks:
+                pending.append((job, tasks))
+
+            for path, file in refs[file_key]:
+                jobs[path][file] = job
+
+        if not pending:
+            return jobs
+
+        # The pool is started before any read ahead threads since forking
+        # while other threads are running can leave workers with locks that
+        # are never released.
+        if pool is None:
+            pool = get_pool(self.num_cpus)
+
+        reader = None
+        if self.read_ahead:
+            reader = FileReader(self.read_ahead)
+
+        for job, tasks in pending:
+            if reader:
+                job.callbacks.append(reader.done)
+                reader.submit(job.path,
+                              functools.partial(self._submit_tasks, pool,
+                                                job, tasks))
+            else:
+                self._submit_tasks(pool, job, tasks)
+
+        if reader:
+            reader.close()
+
+        return jobs
+
+    def _collect(self, jobs, cache, owner=None):
+        """
+        Collect the results of jobs, for the terms of owner if provided.
+
+        @return: SearchResultsCollection
+        """
+        results = SearchResultsCollection()
+        added = set()
+        for path in jobs:
+            if owner is not None and not any([e.get("owner") == owner
+                                              for e in self.paths[path]]):
+                continue
+
+            for file, job in jobs[path].items():
+                if file in added:
+                    # already added with the results of all paths
+                    continue
+
+                added.add(file)
+                file_results, aggregates = self._get_file_results(job, file,
+                                                                  cache,
+                                                                  owner)
+                results.add(file, file_results, aggregates)
+
+        return results
+
+    def _get_terms_key(self, owner=None):
+        """
+        Returns a key that identifies what a search for the registered terms,
+        or only those of owner, returns.
+        """
+        terms = []
+        for path, entries in self.paths.items():
+            path_terms = tuple([(SearchResultsCache.get_term_id(e),
+                                 e.get("tag")) for e in entries
+                                if owner is None or e.get("owner") == owner])
+            if path_terms:
+                terms.append((path, path_terms))
+
+        return (tuple(terms), tuple(sorted(self.start_lines.items())),
+                self.window.since, self.window.until, self.newest)
+
+    def search(self):
+        """Execute all the search queries.
+
+        If the same terms were searched for up front, see
+        SearchRegistry.search(), those results are returned instead.
+
+        @return: search results
+        """
+        results = PRESEARCHED.pop(self._get_terms_key(), None)
+        if results is not None:
+            return results
+
+        cache = self.cache
+        results = self._collect(self._submit_jobs(cache), cache)
+        if cache:
+            cache.evict()
+
+        return results
+
+    def search_by_owner(self):
+        """
+        Execute all the search queries, with each file searched once for
+        the terms of all owners, and split the results by the owner of the
+        terms they are for.
+
+        @return: dict of search results keyed by owner.
+        """
+        cache = self.cache
+        jobs = self._submit_jobs(cache)
+        owners = dict.fromkeys([e["owner"] for entries in self.paths.values()
+                                for e in entries if "owner" in e])
+        results = {owner: self._collect(jobs, cache, owner)
+                   for owner in owners}
+        if cache:
+            cache.evict()
+
+        return results
+
+    def search_iter(self):
+        """Execute all the search queries, streaming the results.
+
+        Rather than collecting the results of all files before returning,
+        the results of each file are yielded as soon as its search completes
+        so that they can be consumed, and released, while other files are
+        still being searched. Files are therefore yielded in the order in
+        which their searches complete. Results within a file are in line
+        order as with search().
+
+        @return: yields (file, list of SearchResult, dict of (op, reduced
+                 values) keyed by tag for aggregated terms) for each file
+                 searched.
+        """
+        results = PRESEARCHED.pop(self._get_terms_key(), None)
+        if results is not None:
+            for file, file_results in results:
+                yield (file, file_results,
+                       results.find_aggregates_by_path(file))
+
+            return
+
+        cache = self.cache
+        completed = queue.Queue()
+        jobs = self._submit_jobs(cache, completed.put)
+        num_jobs = len(set([job for files in jobs.values()
+                            for job in files.values()]))
+        # only hold on to jobs until they have been consumed.
+        del jobs
+        for _ in range(num_jobs):
+            job = completed.get()
+            for file in dict.fromkeys([f for _, f in job.refs]):
+                yield (file,) + self._get_file_results(job, file, cache)
+
+        if cache:
+            cache.evict()
+
+
+class RegisteredSearcher(object):
+
+    def __init__(self, registry, name):
+        """
+        Registers search terms in a SearchRegistry on behalf of a consumer.
+
+        @param registry: SearchRegistry object
+        @param name: name of the consumer
+        """
+        self.registry = registry
+        self.name = name
+
+    def add_search_term(self, searchdef, path):
+        self.registry.add_search_term(self.name, searchdef, path)
+
+
+class SearchRegistry(object):
+
+    def __init__(self, cache_dir=None):
+        """
+        Run-level registry of search terms declared up front by many
+        consumers (e.g. plugin parts) that may search the same files.
+
+        All registered terms are searched together so that each file is
+        scanned once, then each consumer gets its own share of the results.
+        Results are also stored in the search results cache, if there is
+        one, so that consumers that run later in another process get the
+        same results from their own FileSearcher without scanning again.
+        Consumers that run later in this process, or one forked from it, get
+        them from their FileSearcher if search() is asked to share them.
+
+        @param cache_dir: directory used to share results. Defaults to
+                          SEARCH_CACHE_DIR. If neither is set results are
+                          only available from search().
+        """
+        self.cache_dir = cache_dir or os.environ.get('SEARCH_CACHE_DIR')
+        self.terms = {}
+        # file: time taken to search it in seconds
+        self.timings = {}
+
+    def get_searcher(self, name):
+        """
+        Returns an object on which consumer name can call add_search_term()
+        as it would on a FileSearcher.
+        """
+        return RegisteredSearcher(self, name)
+
+    def add_search_term(self, name, searchdef, path):
+        """
+        Add a term to search for on behalf of consumer name.
+
+        @param name: name of the consumer e.g. plugin part
+        @param searchdef: definition of what to search for
+        @param path: path that we will be searching for this key
+        """
+        if name not in self.terms:
+            self.terms[name] = []
+
+        self.terms[name].append((searchdef, path))
+
+    def search(self, share=False):
+        """
+        Execute the searches of all consumers with a single scan of each
+        file.
+
+        @param share: if True the results of each consumer are returned by
+                      the next FileSearcher.search() for the same terms
+                      instead of it searching again.
+        @return: dict of SearchResultsCollection keyed by consumer name.
+        """
+        combined = FileSearcher(cache_dir=self.cache_dir)
+        for name in self.terms:
+            for searchdef, path in self.terms[name]:
+                combined.add_search_term(searchdef, path, owner=name)
 
-            for path in jobs:
-                for file in jobs[path]:
-                    results.add(file, jobs[path][file].get())
+        results = combined.search_by_owner()
+        self.timings = combined.timings
+        if share:
+            for name, collection in results.items():
+                PRESEARCHED[combined._get_terms_key(name)] = collection
 
         return results
@@ -20,7 +20,7 @@
 #  - opentastic@gmail.com
 
 
-DEBUG_MODE=false
+export DEBUG_MODE=false
 MIMIMAL_MODE=false
 # These globals are made available to all plugins
 export VERBOSITY_LEVEL=0
@@ -31,6 +31,15 @@ export OPENSTACK_AGENT_ERROR_KEY_BY_TIME=false
 # This is the path to the end product that plugins can see along the way.
 export MASTER_YAML_OUT
 export USE_ALL_LOGS=false
+# Search results are cached here across runs. This is also used to share
+# results between plugins so if persistent caching is disabled a temporary
+# directory is used for the duration of the run.
+export SEARCH_CACHE_DIR=${XDG_CACHE_HOME:-$HOME/.cache}/hotsos/search
+SEARCH_CACHE_IS_TMP=false
+# Token indexes of logs built with --build-index are stored here and used by
+# all later runs against the same logs.
+export SEARCH_INDEX_DIR=${XDG_CACHE_HOME:-$HOME/.cache}/hotsos/index
+BUILD_INDEX=false
 # this is set to the name of the current plugin being executed
 export PLUGIN_NAME
 # this is set to the name of the current plugin part being executed
@@ -45,6 +54,11 @@ export PLUGIN_TMP_DIR
 
 MASTER_YAML_OUT=`mktemp`
 SAVE_OUTPUT=false
+# Fleet mode runs sosreports concurrently, each with its own master yaml kept
+# in FLEET_TMP_DIR.
+FLEET_MODE=false
+FLEET_PARALLEL=0
+FLEET_TMP_DIR=
 declare -a SOS_PATHS=()
 # optional part name to run
 declare -a RUN_PARTS=()
@@ -70,6 +84,14 @@ cleanup ()
     if [[ -n ${PLUGIN_TMP_DIR:-""} ]] && [[ -d $PLUGIN_TMP_DIR ]]; then
         rm -rf $PLUGIN_TMP_DIR
     fi
+    if $SEARCH_CACHE_IS_TMP && [[ -d $SEARCH_CACHE_DIR ]]; then
+        rm -rf $SEARCH_CACHE_DIR
+    fi
+    if $FLEET_MODE; then
+        kill `jobs -p` 2>/dev/null
+        wait
+        [[ -d $FLEET_TMP_DIR ]] && rm -rf $FLEET_TMP_DIR
+    fi
     exit
 }
 
@@ -86,8 +108,22 @@ Ceph and more (see supported plugins). The standard output is yaml format to
 allow easy visual inspection and post-processing by other tools.
 
 OPTIONS
+    --build-index
+        Index the tokens of all logs (in $SEARCH_INDEX_DIR) before running
+        plugins. Searches of indexed logs for terms that have a literal hint
+        only read the parts of each log that contain the hint which makes
+        repeated runs against the same sosreport much faster. Indexes are
+        kept across runs and ignored once a log changes.
     --debug)
         Provide some debug output such as plugin execution times.
+    --fleet [INT]
+        Analyse the sosreports provided as SOSPATH concurrently, up to INT at
+        a time, rather than one after another. Output of each is saved to
+        its own file as with --save. The parallel tasks allowed (see
+        --max-parallel-tasks) are shared between the sosreports being
+        analysed, so INT is limited to that number and each of them gets an
+        equal share of the rest. If INT is not provided, as many sosreports
+        as there are parallel tasks are analysed at a time.
     -h|--help
         This message.
     --juju
@@ -100,6 +136,16 @@ OPTIONS
         The searchtools module will execute searches across files in parallel.
         By default the number of cores used is limited to a maximum of 8 and
         you can override that value with this option.
+    --newest [INT]
+        Only get the newest INT matches of each search in each log. Logs are
+        searched backwards from the end and searching stops as soon as they
+        are found which is much faster for large logs. Note that any counts
+        or statistics will only cover those matches.
+    --no-cache
+        The searchtools module caches search results on disk (in
+        $SEARCH_CACHE_DIR) so that running again against the same files is
+        faster. Use this option to disable the cache across runs. Results
+        are still shared between plugins within a run.
     --openstack
         Use the Openstack plugin.
     --openstack-show-cpu-pinning-results
@@ -114,9 +160,21 @@ OPTIONS
         Use the Kubernetes plugin.
     --part
         Name of plugin part to run. May be specified multiple times.
+    --read-ahead [INT]
+        Read up to INT files concurrently ahead of them being searched. This
+        makes searches of sosreports on network filesystems such as NFS or
+        CephFS, where the latency of each read rather than the cpu is the
+        bottleneck, much faster. Files are not read ahead by default.
     --short
         If provided, the output will be filtered to only include known-bugs
         and potential-issues sections for plugins run.
+    --since TIME
+        Only search log lines timestamped at or after TIME (any format
+        accepted by date -d e.g. "2021-03-25 10:00" or "yesterday"). Rotated
+        logs that end before TIME are skipped entirely. Only applies to logs
+        whose lines start with a "YYYY-MM-DD HH:MM:SS" timestamp.
+    --until TIME
+        Only search log lines timestamped at or before TIME. See --since.
     --storage
         Use the Storage plugin.
     --system
@@ -142,9 +200,20 @@ EOF
 
 while (($#)); do
     case $1 in
+        --build-index)
+            BUILD_INDEX=true
+            ;;
         --debug)
             DEBUG_MODE=true
             ;;
+        --fleet)
+            FLEET_MODE=true
+            SAVE_OUTPUT=true
+            if [[ ${2:-""} =~ ^[0-9]+$ ]]; then
+                FLEET_PARALLEL=$2
+                shift
+            fi
+            ;;
         -h|--help)
             usage
             exit 0
@@ -192,6 +261,14 @@ while (($#)); do
             export USER_MAX_PARALLEL_TASKS=$2
             shift
             ;;
+        --newest)
+            export SEARCH_NEWEST=$2
+            shift
+            ;;
+        --no-cache)
+            SEARCH_CACHE_DIR=`mktemp -d`
+            SEARCH_CACHE_IS_TMP=true
+            ;;
         -s|--save)
             SAVE_OUTPUT=true
             ;;
@@ -202,9 +279,23 @@ while (($#)); do
             RUN_PARTS+=( $2 )
             shift
             ;;
+        --read-ahead)
+            export SEARCH_READ_AHEAD=$2
+            shift
+            ;;
         --short)
             MIMIMAL_MODE=true
             ;;
+        --since|--until)
+            ts="`date -d "$2" "+%Y-%m-%d %H:%M:%S"`" || \
+                { echo "ERROR: invalid time '$2'"; exit 1; }
+            if [[ $1 == --since ]]; then
+                export SEARCH_SINCE="$ts"
+            else
+                export SEARCH_UNTIL="$ts"
+            fi
+            shift
+            ;;
         --all-logs)
             USE_ALL_LOGS=true
             ;;
@@ -247,23 +338,12 @@ get_git_rev_info ()
     popd &>/dev/null
 }
 
-run_part ()
-{
-    local plugin=$1
-    local part=$2
+CWD=$(dirname `realpath $0`)
 
-    local t_start=`date +%s%3N`
-    $DEBUG_MODE && echo -n " $part" 1>&2
-    PART_NAME=$part
-    $CWD/plugins/$plugin/$part >> $MASTER_YAML_OUT
-    local t_end=`date +%s%3N`
-    delta=`echo "scale=3;($t_end-$t_start)/1000"| bc`
-    [[ ${delta::1} == '.' ]] && delta="0${delta}"
-    $DEBUG_MODE && echo " (${delta}s)" 1>&2
-}
+run_sosreport ()
+{
+    local data_root=$1
 
-CWD=$(dirname `realpath $0`)
-for data_root in ${SOS_PATHS[@]}; do
     if [ "$data_root" = "/" ]; then
         echo -e "INFO: running against localhost since no sosreport path provided\n" 1>&2
         DATA_ROOT=/
@@ -283,37 +363,23 @@ for data_root in ${SOS_PATHS[@]}; do
     fi
     echo -e "hotsos:\n  version: ${SNAP_REVISION:-"development"}\n  repo-info: $repo_info" > $MASTER_YAML_OUT
 
-    $DEBUG_MODE && echo -e "Running plugins:\n" 1>&2
-    for plugin in ${PLUGIN_NAMES[@]}; do
-        # skip this since not a real plugin
-        [ "$plugin" = "all" ] && continue
-        # is plugin enabled?
-        ${PLUGINS[$plugin]} || continue
-        $DEBUG_MODE && echo -e "${plugin^^}:  " 1>&2
-
-        PLUGIN_NAME=$plugin
-        # setup plugin temp area
-        PLUGIN_TMP_DIR=`mktemp -d`
+    if $BUILD_INDEX; then
+        $CWD/tools/build_index.py ${DATA_ROOT}var/log
+    fi
 
-        if ((${#RUN_PARTS[@]})); then
-            for part in ${RUN_PARTS[@]}; do
-                [[ -r $CWD/plugins/$plugin/$part ]] || continue
-                run_part $plugin $part
-            done
-        else
-            for priority in {00..99}; do
-                for part in `find $CWD/plugins/$plugin -name _$priority\*| grep -v __pycache__`; do
-                    run_part $plugin `basename $part`
-                done
-            done
-        fi
-        # teardown plugin temp area
-        if [[ -n $PLUGIN_TMP_DIR ]] && [[ -d $PLUGIN_TMP_DIR ]]; then
-            rm -rf $PLUGIN_TMP_DIR
-        fi
+    declare -a enabled_plugins=()
+    for plugin in ${PLUGIN_NAMES[@]}; do
+        ${PLUGINS[$plugin]} && enabled_plugins+=( $plugin )
+    done
 
-        $DEBUG_MODE && echo "" 1>&2
+    # All parts of enabled plugins are run from a single python interpreter,
+    # concurrently unless parallel tasks are disabled, with the searches they
+    # declare executed up front so that each file is only read once.
+    declare -a part_args=()
+    for part in ${RUN_PARTS[@]}; do
+        part_args+=( --part $part )
     done
+    $CWD/tools/run_plugins.py ${enabled_plugins[@]} ${part_args[@]}
 
     if $MIMIMAL_MODE; then
         $CWD/tools/output_filter.py $MASTER_YAML_OUT
@@ -334,6 +400,33 @@ for data_root in ${SOS_PATHS[@]}; do
         echo "" 1>&2
         rm $MASTER_YAML_OUT
     fi
+}
 
-    echo "INFO: see --help for more display options" 1>&2
-done
+if $FLEET_MODE; then
+    # The parallel tasks allowed for a single run are shared between the
+    # sosreports run concurrently so that together they do not use more
+    # cores than that. Each run starts no more search workers than its share
+    # whether searching up front or running parts concurrently, which only
+    # get one each (see tools/run_plugins.py).
+    read FLEET_PARALLEL USER_MAX_PARALLEL_TASKS <<< `cd $CWD/tools && \
+python3 -c "import run_plugins; \
+print(*run_plugins.get_fleet_parallel($FLEET_PARALLEL))"`
+    export USER_MAX_PARALLEL_TASKS
+    FLEET_TMP_DIR=`mktemp -d`
+    for data_root in ${SOS_PATHS[@]}; do
+        while ((`jobs -rp| wc -l` >= FLEET_PARALLEL)); do
+            wait -n
+        done
+        (
+            MASTER_YAML_OUT=`mktemp -p $FLEET_TMP_DIR`
+            run_sosreport $data_root
+        ) &
+    done
+    wait
+else
+    for data_root in ${SOS_PATHS[@]}; do
+        run_sosreport $data_root
+    done
+fi
+
+echo "INFO: see --help for more display options" 1>&2
@@ -11,28 +11,33 @@ from juju_common import (
 # maximum number of chars to print when a matching text is detected.
 MAX_MATCH_CHARS = 200
 
+KNOWN_BUGS = {
+    1910958: {
+        "description": ("Unit fails to start complaining there are "
+                        "members in the relation."),
+        "pattern": (
+            r'.* manifold worker returned unexpected error: failed to '
+            r'initialize uniter for "[A-Za-z0-9-]+": cannot create '
+            r'relation state tracker: cannot remove persisted state, '
+            r'relation \d+ has members'),
+        "hint": "manifold worker returned unexpected error",
+        }
+    }
+
+
+def register_search_terms(searchobj):
+    """Add the search terms used by this part to searchobj."""
+    for bug in KNOWN_BUGS:
+        sd = SearchDef(KNOWN_BUGS[bug]["pattern"],
+                       tag=1910958, hint=KNOWN_BUGS[bug]["hint"])
+        searchobj.add_search_term(sd, f"{JUJU_LOG_PATH}/*")
+
 
 def detect_known_bugs():
     """Unit fails to start complaining there are members in the relation."""
-    known_bugs = {
-        1910958: {
-            "description": ("Unit fails to start complaining there are "
-                            "members in the relation."),
-            "pattern": (
-                r'.* manifold worker returned unexpected error: failed to '
-                r'initialize uniter for "[A-Za-z0-9-]+": cannot create '
-                r'relation state tracker: cannot remove persisted state, '
-                r'relation \d+ has members'),
-            "hint": "manifold worker returned unexpected error",
-            }
-        }
-
+    known_bugs = KNOWN_BUGS
     s = FileSearcher()
-    for bug in known_bugs:
-        sd = SearchDef(known_bugs[bug]["pattern"],
-                       tag=1910958, hint=known_bugs[bug]["hint"])
-        s.add_search_term(sd, f"{JUJU_LOG_PATH}/*")
-
+    register_search_terms(s)
     results = s.search()
 
     for bug in known_bugs:
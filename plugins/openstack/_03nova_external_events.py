@@ -16,6 +16,8 @@ EXT_EVENT_META = {"network-vif-plugged": {"stages_keys":
                   "network-changed": {"stages_keys": ["Received",
                                                       "Refreshing"]}}
 EXT_EVENT_INFO = {}
+NOVA_COMPUTE_LOG = os.path.join(constants.DATA_ROOT,
+                                "var/log/nova/nova-compute.log")
 
 
 def get_state_dict(event_name):
@@ -26,6 +28,23 @@ def get_state_dict(event_name):
     return state
 
 
+def get_sequence_starter_search(event_name):
+    """Returns the search definition for the start of an event sequence."""
+    if event_name == "network-vif-plugged":
+        return SearchDef(r".+\[instance: (\S+)\].+Preparing to wait for "
+                         r"external event ({})-(\S+)\s+".format(event_name))
+    elif event_name == "network-changed":
+        return SearchDef(r".+\[instance: (\S+)\].+Received event "
+                         r"({})-(\S+)\s+".format(event_name))
+
+
+def register_search_terms(searchobj):
+    """Add the search terms used by this part to searchobj."""
+    for event_name in EXT_EVENT_META:
+        searchobj.add_search_term(get_sequence_starter_search(event_name),
+                                  NOVA_COMPUTE_LOG)
+
+
 def get_events(event_name, data_source):
     ext_event_info = {}
     events = {}
@@ -33,13 +52,8 @@ def get_events(event_name, data_source):
     s = FileSearcher()
 
     # look for sequence starter
-    if event_name == "network-vif-plugged":
-        sd = SearchDef(r".+\[instance: (\S+)\].+Preparing to wait for "
-                       r"external event ({})-(\S+)\s+".format(event_name))
-        s.add_search_term(sd, data_source)
-    elif event_name == "network-changed":
-        sd = SearchDef(r".+\[instance: (\S+)\].+Received event ({})-(\S+)\s+".
-                       format(event_name))
+    sd = get_sequence_starter_search(event_name)
+    if sd:
         s.add_search_term(sd, data_source)
 
     master_results = s.search()
@@ -48,6 +62,10 @@ def get_events(event_name, data_source):
     s = FileSearcher()
 
     for file, results in master_results:
+        if results:
+            # stages are only logged from the start of their sequence
+            s.set_start_line(file, min([r.linenumber for r in results]))
+
         for result in results:
             instance_id = result.get(1)
             event_id = result.get(3)
@@ -97,11 +115,8 @@ def get_events(event_name, data_source):
 
 if __name__ == "__main__":
     # Supported events - https://docs.openstack.org/api-ref/compute/?expanded=run-events-detail#create-external-events-os-server-external-events  # noqa E501
-    data_source = os.path.join(constants.DATA_ROOT,
-                               "var/log/nova/nova-compute.log")
-
-    get_events("network-changed", data_source)
-    get_events("network-vif-plugged", data_source)
+    get_events("network-changed", NOVA_COMPUTE_LOG)
+    get_events("network-vif-plugged", NOVA_COMPUTE_LOG)
     if EXT_EVENT_INFO:
         EXT_EVENT_INFO = {"os-server-external-events": EXT_EVENT_INFO}
         plugin_yaml.dump(EXT_EVENT_INFO)
@@ -8,6 +8,9 @@ from common import (
     plugin_yaml,
 )
 
+# Parts whose output this part reads from the master yaml.
+PART_DEPENDENCIES = ["_02vm_info.py"]
+
 CONFIG = {"nova": [{"path": os.path.join(constants.DATA_ROOT,
                                          "etc/nova/nova.conf"),
                     "key": "my_ip"}],
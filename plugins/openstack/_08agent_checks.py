@@ -10,6 +10,7 @@ from common import (
     plugin_yaml,
 )
 from common.searchtools import (
+    SearchAggregate,
     SearchDef,
     FileSearcher,
 )
@@ -441,18 +442,30 @@ class CommonAgentChecks(AgentChecksBase):
         if constants.USE_ALL_LOGS:
             data_source_template = "{}*".format(data_source_template)
 
+        # Occurrences are counted by exception (group 3) and date (group 1)
+        # and optionally time (group 2) so only counts are returned.
+        if AGENT_ERROR_KEY_BY_TIME:
+            # use hours and minutes only
+            expr_template = r"^([0-9\-]+) ([0-9]+:[0-9]+)\S* .+{}.*"
+            aggregate = SearchAggregate(group_by=[3, 1, 2])
+        else:
+            expr_template = r"^([0-9\-]+) (\S+) .+{}.*"
+            aggregate = SearchAggregate(group_by=[3, 1])
+
         for agent in AGENT_DAEMON_NAMES[service]:
             data_source = data_source_template.format(agent)
             for exc_msg in self.agent_exceptions[service]:
-                expr = r"^([0-9\-]+) (\S+) .+{}.*".format(exc_msg)
+                expr = expr_template.format(exc_msg)
                 self.searchobj.add_search_term(SearchDef(expr, tag=agent,
-                                                         hint=exc_msg),
+                                                         hint=exc_msg,
+                                                         aggregate=aggregate),
                                                data_source)
 
             for msg in self.agent_issues.get(service, []):
-                expr = r"^([0-9\-]+) (\S+) .+{}.*".format(msg)
+                expr = expr_template.format(msg)
                 self.searchobj.add_search_term(SearchDef(expr, tag=agent,
-                                                         hint=msg),
+                                                         hint=msg,
+                                                         aggregate=aggregate),
                                                data_source)
 
     def add_bug_search_terms(self):
@@ -481,8 +494,7 @@ class CommonAgentChecks(AgentChecksBase):
 
     def process_agent_results(self, results, service):
         for agent in AGENT_DAEMON_NAMES[service]:
-            e = get_agent_exceptions(results.find_by_tag(agent),
-                                     AGENT_ERROR_KEY_BY_TIME)
+            e = get_agent_exceptions(results.find_aggregate_by_tag(agent))
             if e:
                 if service not in self.agent_log_issues:
                     self.agent_log_issues[service] = {}
@@ -501,14 +513,24 @@ class CommonAgentChecks(AgentChecksBase):
         self.process_bug_results(results)
 
 
-if __name__ == "__main__":
-    s = FileSearcher()
-    common_checks = CommonAgentChecks(s)
+def get_agent_checks(searchobj):
+    """Create the agent checks and add their search terms to searchobj."""
+    common_checks = CommonAgentChecks(searchobj)
     common_checks.add_agents_issues_search_terms()
-    neutron_checks = NeutronAgentChecks(s)
+    neutron_checks = NeutronAgentChecks(searchobj)
     neutron_checks.add_rpc_loop_search_terms()
     neutron_checks.add_router_event_search_terms()
+    return common_checks, neutron_checks
+
 
+def register_search_terms(searchobj):
+    """Add the search terms used by this part to searchobj."""
+    get_agent_checks(searchobj)
+
+
+if __name__ == "__main__":
+    s = FileSearcher()
+    common_checks, neutron_checks = get_agent_checks(s)
     results = s.search()
 
     neutron_checks.process_rpc_loop_results(results)
@@ -10,172 +10,143 @@ from common import (
     plugin_yaml,
 )
 from common.searchtools import (
+    SearchAggregate,
     SearchDef,
     FileSearcher,
+    merge_aggregate,
 )
 
 
 CEPH_LOGS = "var/log/ceph/"
 DAEMON_INFO = {}
 
+# All searches are aggregated by date (group 1) and optionally by daemon or
+# value (group 2) so only counts are returned from the search.
 SEARCHES = [
     SearchDef(
         r"^([0-9-]+)\S* \S+ .+ (osd.[0-9]+) reported failed by osd.[0-9]+",
         tag="osd-reported-failed",
-        hint="reported failed"),
+        hint="reported failed",
+        aggregate=SearchAggregate(group_by=[2, 1])),
     SearchDef(
         r"^([0-9-]+)\S* \S+ .+ (mon.\S+) calling monitor election",
         tag="mon-election-called",
-        hint="calling monitor election"),
+        hint="calling monitor election",
+        aggregate=SearchAggregate(group_by=[2, 1])),
     SearchDef(
         (r"^([0-9-]+)\S* \S+ .+ ([0-9]+) slow requests are blocked .+ "
          r"\(REQUEST_SLOW\)"),
         tag="slow-requests",
-        hint="REQUEST_SLOW"),
+        hint="REQUEST_SLOW",
+        aggregate=SearchAggregate(group_by=[1], op=SearchAggregate.SUM,
+                                  value=2)),
     SearchDef(
         r"^([0-9-]+)\S* .+ _verify_csum bad .+",
         tag="crc-err-bluestore",
-        hint="_verify_csum"),
+        hint="_verify_csum",
+        aggregate=SearchAggregate(group_by=[1])),
     SearchDef(
         r"^([0-9-]+)\S* .+ rocksdb: .+block checksum mismatch:.+",
         tag="crc-err-rocksdb",
-        hint="checksum mismatch"),
+        hint="checksum mismatch",
+        aggregate=SearchAggregate(group_by=[1])),
     SearchDef(
         (r"^([0-9-]+)\S* \S+ .+ Long heartbeat ping times on \S+ interface "
          "seen, longest is ([0-9.]+) msec.+"),
         tag="long-heartbeat",
-        hint="Long heartbeat ping"),
+        hint="Long heartbeat ping",
+        aggregate=SearchAggregate(group_by=[1])),
     SearchDef(
         (r"^([0-9-]+)\S* \S+ \S+ \S+ osd.[0-9]+ .+ heartbeat_check: no reply "
          "from [0-9.:]+ (osd.[0-9]+)"),
         tag="heartbeat-no-reply",
-        hint="heartbeat_check"),
+        hint="heartbeat_check",
+        aggregate=SearchAggregate(group_by=[1, 2])),
 ]
 
 
+def register_search_terms(searchobj):
+    """Add the search terms used by this part to searchobj."""
+    data_source = os.path.join(constants.DATA_ROOT, CEPH_LOGS, 'ceph*.log')
+    if constants.USE_ALL_LOGS:
+        data_source = "{}*".format(data_source)
+
+    for search in SEARCHES:
+        searchobj.add_search_term(search, data_source)
+
+
 class CephDaemonLogChecks(CephChecksBase):
 
-    def process_osd_failure_reports(self):
-        reported_failed = {}
-        for result in sorted(self.results.find_by_tag("osd-reported-failed"),
-                             key=lambda r: r.get(1)):
-            date = result.get(1)
-            failed_osd = result.get(2)
-            if failed_osd not in reported_failed:
-                reported_failed[failed_osd] = {date: 1}
-            else:
-                if date in reported_failed[failed_osd]:
-                    reported_failed[failed_osd][date] += 1
-                else:
-                    reported_failed[failed_osd][date] = 1
-
-        if reported_failed:
-            DAEMON_INFO["osd-reported-failed"] = reported_failed
-
-    def process_mon_elections(self):
-        elections_called = {}
-        for result in sorted(self.results.find_by_tag("mon-election-called"),
-                             key=lambda r: r.get(1)):
-            date = result.get(1)
-            calling_mon = result.get(2)
-            if calling_mon not in elections_called:
-                elections_called[calling_mon] = {date: 1}
-            else:
-                if date in elections_called[calling_mon]:
-                    elections_called[calling_mon][date] += 1
-                else:
-                    elections_called[calling_mon][date] = 1
-
-        if elections_called:
-            DAEMON_INFO["mon-elections-called"] = elections_called
-
-    def process_slow_requests(self):
-        slow_requests = {}
-        for result in sorted(self.results.find_by_tag("slow-requests"),
-                             key=lambda r: r.get(1)):
-            date = result.get(1)
-            count = result.get(2)
-            if date not in slow_requests:
-                slow_requests[date] = int(count)
-            else:
-                slow_requests[date] += int(count)
-
-        if slow_requests:
-            DAEMON_INFO["slow-requests"] = slow_requests
-
-    def process_crc_bluestore(self):
-        crc_error = {}
-        for result in sorted(self.results.find_by_tag("crc-err-bluestore"),
-                             key=lambda r: r.get(1)):
-            date = result.get(1)
-            if date not in crc_error:
-                crc_error[date] = 1
-            else:
-                crc_error[date] += 1
-
-        if crc_error:
-            DAEMON_INFO["crc-err-bluestore"] = crc_error
-
-    def process_crc_rocksdb(self):
-        crc_error = {}
-        for result in sorted(self.results.find_by_tag("crc-err-rocksdb"),
-                             key=lambda r: r.get(1)):
-            date = result.get(1)
-            if date not in crc_error:
-                crc_error[date] = 1
-            else:
-                crc_error[date] += 1
-
-        if crc_error:
-            DAEMON_INFO["crc-err-rocksdb"] = crc_error
-
-    def process_long_heartbeat(self):
-        long_heartbeats = {}
-        for result in sorted(self.results.find_by_tag("long-heartbeat"),
-                             key=lambda r: r.get(1)):
-            date = result.get(1)
-            if date not in long_heartbeats:
-                long_heartbeats[date] = 1
-            else:
-                long_heartbeats[date] += 1
-
-        if long_heartbeats:
-            DAEMON_INFO["long-heartbeat-pings"] = long_heartbeats
-
-    def process_heartbeat_no_reply(self):
-        no_replies = {}
-        for result in sorted(self.results.find_by_tag("heartbeat-no-reply"),
-                             key=lambda r: r.get(1)):
-            date = result.get(1)
-            remote_osd = result.get(2)
-            if date not in no_replies:
-                no_replies[date] = {}
-            if remote_osd not in no_replies[date]:
-                no_replies[date][remote_osd] = 1
-            else:
-                no_replies[date][remote_osd] += 1
-
-        if no_replies:
-            DAEMON_INFO["heartbeat-no-reply"] = no_replies
+    @classmethod
+    def _sort_dates(cls, node, date_level, level=0):
+        if not isinstance(node, dict):
+            return node
+
+        items = node.items()
+        if level == date_level:
+            items = sorted(items)
+
+        return {key: cls._sort_dates(value, date_level, level + 1)
+                for key, value in items}
+
+    @classmethod
+    def get_counts(cls, counts, date_level=0):
+        """
+        Convert counts keyed by tuple of group values into nested dicts
+        keyed by each group value in turn. Dates are sorted and other values
+        are in the order they were first seen.
+
+        @param date_level: index of the date in the keys of counts.
+        """
+        nested = {}
+        for key in counts:
+            node = nested
+            for value in key[:-1]:
+                node = node.setdefault(value, {})
+
+            node[key[-1]] = counts[key]
+
+        return cls._sort_dates(nested, date_level)
+
+    def process_counts(self, counts):
+        """
+        @param counts: dict of reduced values keyed by search tag.
+        """
+        info_keys = {"osd-reported-failed": "osd-reported-failed",
+                     "mon-election-called": "mon-elections-called",
+                     "slow-requests": "slow-requests",
+                     "crc-err-bluestore": "crc-err-bluestore",
+                     "crc-err-rocksdb": "crc-err-rocksdb",
+                     "long-heartbeat": "long-heartbeat-pings",
+                     "heartbeat-no-reply": "heartbeat-no-reply"}
+        for search in SEARCHES:
+            if counts.get(search.tag):
+                # the date is always group 1
+                date_level = search.aggregate.group_by.index(1)
+                DAEMON_INFO[info_keys[search.tag]] = \
+                    self.get_counts(counts[search.tag], date_level)
 
     def __call__(self):
         super().__call__()
-        data_source = os.path.join(constants.DATA_ROOT, CEPH_LOGS, 'ceph*.log')
-        if constants.USE_ALL_LOGS:
-            data_source = "{}*".format(data_source)
-
         s = FileSearcher()
-        for search in SEARCHES:
-            s.add_search_term(search, data_source)
-
-        self.results = s.search()
-        self.process_osd_failure_reports()
-        self.process_mon_elections()
-        self.process_slow_requests()
-        self.process_crc_bluestore()
-        self.process_crc_rocksdb()
-        self.process_long_heartbeat()
-        self.process_heartbeat_no_reply()
+        register_search_terms(s)
+        # Only the counts of each file are kept as its search completes.
+        # Searches complete in any order so counts are merged in path order
+        # to keep values in the order they were first seen.
+        by_path = {}
+        for path, _, aggregates in s.search_iter():
+            by_path[path] = aggregates
+
+        counts = {}
+        for path in sorted(by_path):
+            for tag, (op, aggregate) in by_path[path].items():
+                if tag not in counts:
+                    counts[tag] = {}
+
+                for key, value in aggregate.items():
+                    merge_aggregate(op, counts[tag], key, value)
+
+        self.process_counts(counts)
 
 
 def get_ceph_daemon_log_checker():
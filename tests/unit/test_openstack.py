@@ -306,11 +306,11 @@ class TestOpenstackPlugin08agent_checks(utils.BaseTestCase):
     @mock.patch.object(_08agent_checks, "add_known_bug")
     def test_get_agents_issues(self, mock_add_known_bug):
         neutron_expected = {'neutron-openvswitch-agent':
-                            {'MessagingTimeout': {'2021-03-04': 2},
-                             'AMQP server on 10.10.123.22:5672 is unreachable':
+                            {'AMQP server on 10.10.123.22:5672 is unreachable':
                              {'2021-03-04': 3},
-                             'OVS is dead': {'2021-03-29': 1},
+                             'MessagingTimeout': {'2021-03-04': 2},
                              'RuntimeError': {'2021-03-29': 3},
+                             'OVS is dead': {'2021-03-29': 1},
                              }}
         nova_expected = {'nova-api-wsgi':
                          {'OSError: Server unexpectedly closed connection':
@@ -327,11 +327,29 @@ class TestOpenstackPlugin08agent_checks(utils.BaseTestCase):
         c.process_agent_issues_results(s.search())
         self.assertEqual(c.agent_log_issues,
                          {"neutron": neutron_expected, "nova": nova_expected})
+        # exceptions are in the order they were found
+        for service, expected in [("neutron", neutron_expected),
+                                  ("nova", nova_expected)]:
+            for agent, exceptions in expected.items():
+                self.assertEqual(
+                    list(c.agent_log_issues[service][agent]),
+                    list(exceptions))
+
         calls = [mock.call("1896506",
                            description=('identified in neutron-l3-agent logs '
                                         'by testplugin.01part'))]
         mock_add_known_bug.assert_has_calls(calls)
 
+    @mock.patch.object(_08agent_checks, "AGENT_ERROR_KEY_BY_TIME", True)
+    @mock.patch.object(_08agent_checks, "add_known_bug")
+    def test_get_agents_issues_key_by_time(self, mock_add_known_bug):
+        s = searchtools.FileSearcher()
+        c = _08agent_checks.CommonAgentChecks(s)
+        c.add_agents_issues_search_terms()
+        c.process_agent_issues_results(s.search())
+        self.assertEqual(c.agent_log_issues["nova"]["nova-compute"],
+                         {'DBConnectionError': {'2021-03-08_17:12': 2}})
+
     def test_get_router_event_stats(self):
         router = '9b8efc4c-305b-48ce-a5bd-624bc5eeee67'
         spawn_start = datetime.datetime(2021, 3, 25, 18, 10, 14, 747000)
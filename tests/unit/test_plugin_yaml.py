@@ -0,0 +1,86 @@
+import contextlib
+import io
+import os
+
+import mock
+import tempfile
+import utils
+import shutil
+import yaml
+
+from common import (
+    constants,
+    plugin_yaml,
+)
+
+
+class TestPluginYaml(utils.BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.master_yaml = os.path.join(self.tmpdir, "master.yaml")
+        with open(self.master_yaml, 'w') as fd:
+            fd.write("hotsos:\n  version: development\n")
+
+    def tearDown(self):
+        if os.path.isdir(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+
+        super().tearDown()
+
+    def dump(self, data):
+        """Dump data to the master yaml as a part would."""
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            plugin_yaml.dump(data)
+
+        with open(self.master_yaml, 'a') as fd:
+            fd.write(out.getvalue())
+
+    @mock.patch.object(constants, "PLUGIN_NAME", "testplugin")
+    def test_dump(self):
+        with mock.patch.object(constants, "MASTER_YAML_OUT",
+                               self.master_yaml):
+            self.assertFalse(plugin_yaml.master_has_plugin("testplugin"))
+            self.dump({"foo": {"a": 1}})
+            self.assertTrue(plugin_yaml.master_has_plugin("testplugin"))
+            with mock.patch.object(plugin_yaml.yaml, "safe_load") as \
+                    mock_load:
+                self.dump({"bar": ["b"]})
+                self.assertEqual(plugin_yaml.get_master_plugin_yaml(
+                                 "testplugin"),
+                                 {"foo": {"a": 1}, "bar": ["b"]})
+                # the master yaml is not parsed again
+                self.assertFalse(mock_load.called)
+
+            with open(self.master_yaml) as fd:
+                master = yaml.safe_load(fd)
+
+            self.assertEqual(master, plugin_yaml.get_master_yaml())
+
+    @mock.patch.object(constants, "PLUGIN_NAME", "testplugin")
+    def test_dump_copies(self):
+        with mock.patch.object(constants, "MASTER_YAML_OUT",
+                               self.master_yaml):
+            data = {"foo": {"a": 1}}
+            self.dump(data)
+            # changes made by whoever dumped or read it are not seen by
+            # anyone else.
+            data["foo"]["a"] = 2
+            plugin_yaml.get_master_plugin_yaml("testplugin")["foo"]["b"] = 1
+            plugin_yaml.get_master_yaml()["testplugin"]["bar"] = 1
+            self.assertEqual(plugin_yaml.get_master_plugin_yaml(
+                             "testplugin"), {"foo": {"a": 1}})
+
+    def test_get_master_yaml_path_changed(self):
+        with mock.patch.object(constants, "MASTER_YAML_OUT",
+                               self.master_yaml):
+            self.assertEqual(list(plugin_yaml.get_master_yaml()), ["hotsos"])
+
+        with tempfile.NamedTemporaryFile('w') as ftmp:
+            ftmp.write("testplugin:\n  foo: 1\n")
+            ftmp.flush()
+            with mock.patch.object(constants, "MASTER_YAML_OUT", ftmp.name):
+                self.assertEqual(plugin_yaml.get_master_yaml(),
+                                 {"testplugin": {"foo": 1}})
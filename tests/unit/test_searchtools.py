@@ -1,12 +1,38 @@
+import glob
+import gzip
+import lzma
 import os
+import pickle
+import re
+import shutil
+import subprocess
+import tempfile
 
 import mock
 
 import utils
 
 from common.searchtools import (
+    FileReader,
     FileSearcher,
+    LineIndex,
+    SearchAggregate,
     SearchDef,
+    SearchRegistry,
+    SearchResult,
+    SearchResultsCollection,
+    SearchResultsCache,
+    SearchTermMatcher,
+    SearchTimeWindow,
+    TokenIndex,
+    TokenIndexStore,
+    close_pool,
+    compile_bytes,
+    count_lines,
+    get_blocks,
+    get_compression,
+    get_literal,
+    get_trie_pattern,
 )
 
 
@@ -14,8 +40,11 @@ class TestSearchTools(utils.BaseTestCase):
 
     def setUp(self):
         super().setUp()
+        # workers must be started after any patching done by tests
+        close_pool()
 
     def tearDown(self):
+        close_pool()
         super().tearDown()
 
     @mock.patch.object(os, "environ", {})
@@ -126,3 +155,1024 @@ class TestSearchTools(utils.BaseTestCase):
             ln = result.linenumber
             self.assertEquals(result.tag, None)
             self.assertEquals(result.get(1), expected[ln])
+
+    def test_search_result(self):
+        result = SearchResult(10, "a.log", "T1", ("foo bar", "foo"))
+        self.assertEquals(result.get(0), "foo bar")
+        self.assertEquals(result.get(1), "foo")
+        self.assertEquals(result.get(2), None)
+        self.assertEquals(result.get(-1), None)
+        result.add(3, "bar")
+        self.assertEquals(result.get(2), None)
+        self.assertEquals(result.get(3), "bar")
+        self.assertFalse(hasattr(result, "__dict__"))
+
+    def test_search_results_collection_find_by_tag(self):
+        collection = SearchResultsCollection()
+        collection.add("a.log", [SearchResult(1, "a.log", "T1"),
+                                 SearchResult(2, "a.log", "T2"),
+                                 SearchResult(3, "a.log", "T1")])
+        collection.add("b.log", [SearchResult(1, "b.log", "T1")])
+        self.assertEquals([(r.source, r.linenumber)
+                           for r in collection.find_by_tag("T1")],
+                          [("a.log", 1), ("a.log", 3), ("b.log", 1)])
+        self.assertEquals([r.linenumber for r in
+                           collection.find_by_tag("T1", path="b.log")], [1])
+        self.assertEquals(collection.find_by_tag("T2", path="b.log"), [])
+        self.assertEquals(collection.find_by_tag("T3"), [])
+
+        # replacing the results of a path keeps the path order
+        collection.add("a.log", [SearchResult(4, "a.log", "T1")])
+        self.assertEquals([(r.source, r.linenumber)
+                           for r in collection.find_by_tag("T1")],
+                          [("a.log", 4), ("b.log", 1)])
+        self.assertEquals(collection.find_by_tag("T2"), [])
+
+    def test_get_literal(self):
+        self.assertEquals(get_literal(r"Agent rpc_loop"), "Agent rpc_loop")
+        self.assertEquals(get_literal(r"(DBError)"), "DBError")
+        self.assertEquals(get_literal(r" (InstanceNotFound):"),
+                          " InstanceNotFound:")
+        self.assertEquals(get_literal(r"a\.b"), "a.b")
+        self.assertEquals(get_literal(r"(OVS is dead)."), None)
+        self.assertEquals(get_literal(r"(?:abc)"), None)
+        self.assertEquals(get_literal(r"\d+"), None)
+        self.assertEquals(get_literal(r"(a|b)"), None)
+
+    def test_get_trie_pattern(self):
+        literals = ["DBError", "DBDeadlock", "DBErrorX", "KeyError"]
+        regex = re.compile(get_trie_pattern(literals))
+        for literal in literals:
+            self.assertTrue(regex.search("foo {} bar".format(literal)))
+
+        self.assertFalse(regex.search("DBDead KeyErr"))
+
+    def test_search_term_matcher(self):
+        entries = []
+        for i, hint in enumerate(["(DBError)", "DBDeadlock", r"lock \d+",
+                                  "DBError"]):
+            entries.append({"key": compile_bytes(r".+ (\S+)$"),
+                            "tag": i, "hint": compile_bytes(hint)})
+
+        entries.append({"key": compile_bytes(r"^foo (\S+)"), "tag": "nohint"})
+        matcher = SearchTermMatcher(entries)
+        self.assertEquals([e["tag"] for e, _ in
+                           matcher.match(b"a DBError b")], [0, 3])
+        self.assertEquals([e["tag"] for e, _ in
+                           matcher.match(b"a lock 10 b")], [2])
+        self.assertEquals([e["tag"] for e, _ in
+                           matcher.match(b"foo DBDeadlock")],
+                          [1, "nohint"])
+        self.assertEquals(list(matcher.match(b"nothing to see here")), [])
+
+    def test_search_term_matcher_no_prefilter(self):
+        # backreferences cannot be combined so every line is a candidate
+        entries = [{"key": compile_bytes(r"^(a)\1"), "tag": "T1"},
+                   {"key": compile_bytes(r"^(b)\1"), "tag": "T2"}]
+        matcher = SearchTermMatcher(entries)
+        self.assertEquals(matcher.prefilter, None)
+        self.assertEquals([e["tag"] for e, _ in matcher.match(b"bb")], ["T2"])
+
+    def test_search_term_matcher_pickle(self):
+        s = FileSearcher()
+        for i in range(10):
+            s.add_search_term(SearchDef(r"^(\d+) ERROR", tag="T1",
+                                        hint="ERROR"), "{}.log".format(i))
+            s.add_search_term(SearchDef(r"^(\d+) INFO", tag="T2"),
+                              "{}.log".format(i))
+
+        # terms are not pickled with the searcher
+        self.assertEquals(pickle.loads(pickle.dumps(s)).paths, {})
+        matcher = SearchTermMatcher(s.paths["0.log"])
+        unpickled = pickle.loads(pickle.dumps(matcher))
+        self.assertEquals(unpickled.terms, matcher.terms)
+        # compiled once per process
+        self.assertIs(pickle.loads(pickle.dumps(matcher)), unpickled)
+        buf = b"1 ERROR\n2 INFO\n3 DEBUG\n"
+        self.assertEquals([(o, e["tag"], m.group(1)) for o, e, m in
+                           unpickled.search_buffer(buf)],
+                          [(0, "T1", b"1"), (8, "T2", b"2")])
+
+    def test_filesearcher_undecodable(self):
+        with tempfile.TemporaryDirectory() as dtmp:
+            path = os.path.join(dtmp, "test.log")
+            with open(path, 'wb') as fd:
+                fd.write(b"\xff\xfe bad line\n")
+                fd.write(b"ERROR \xff\xfe\n")
+                fd.write(b"ERROR ok\n")
+
+            s = FileSearcher()
+            s.add_search_term(SearchDef(r"^ERROR (\S+)", tag="T1"), path)
+            results = s.search()
+            results = results.find_by_tag("T1")
+            self.assertEquals([r.linenumber for r in results], [2, 3])
+            self.assertEquals([r.get(1) for r in results],
+                              ["\ufffd\ufffd", "ok"])
+
+    def test_filesearcher_many_terms(self):
+        with tempfile.TemporaryDirectory() as dtmp:
+            path = os.path.join(dtmp, "test.log")
+            with open(path, 'w') as fd:
+                for i in range(100):
+                    fd.write("2021-01-01 00:00:{:02d} ERROR Exception{}\n".
+                             format(i % 60, i))
+
+            s = FileSearcher()
+            for i in range(0, 100, 10):
+                expr = r"^(\S+) \S+ ERROR (Exception{})$".format(i)
+                s.add_search_term(SearchDef(expr, tag=i,
+                                            hint="Exception{}".format(i)),
+                                  path)
+
+            results = s.search()
+            self.assertEquals(len(results.find_by_path(path)), 10)
+            for i in range(0, 100, 10):
+                result = results.find_by_tag(i)
+                self.assertEquals(len(result), 1)
+                self.assertEquals(result[0].linenumber, i + 1)
+                self.assertEquals(result[0].get(2), "Exception{}".format(i))
+
+    def test_count_lines(self):
+        buf = b"a\nb\nc\n" * 10
+        with mock.patch("common.searchtools.COUNT_BLOCK_SIZE", 4):
+            self.assertEquals(count_lines(buf, 0, len(buf)), 30)
+            self.assertEquals(count_lines(buf, 2, 7), 2)
+
+    def test_search_buffer(self):
+        entries = [{"key": compile_bytes(r"^(\S+) sync (\S+)"), "tag": "T1",
+                    "hint": compile_bytes(r"sync\s+\S+")},
+                   {"key": compile_bytes(r"^([0-9]+)$"), "tag": "T2"}]
+        matcher = SearchTermMatcher(entries)
+        # the hint matches across the first two lines but the line match is
+        # on the second line only and the last line has no newline.
+        buf = b"a sync\n1 sync 2\nfoo\n12\nb sync 3"
+        matches = [(offset, e["tag"], m.group(1)) for offset, e, m in
+                   matcher.search_buffer(buf)]
+        self.assertEquals(matches, [(7, "T1", b"1"), (20, "T2", b"12"),
+                                    (23, "T1", b"b")])
+
+    def test_filesearcher_buffer_vs_lines(self):
+        with tempfile.TemporaryDirectory() as dtmp:
+            path = os.path.join(dtmp, "test.log")
+            with open(path, 'w') as fd:
+                for i in range(1000):
+                    fd.write("2021-01-01 00:00:00 {} {}\n".
+                             format("ERROR" if i % 7 else "INFO", i))
+
+            s = FileSearcher()
+            s.add_search_term(SearchDef(r"^\S+ \S+ ERROR (\d+)", tag="T1",
+                                        hint="ERROR"), path)
+            s.add_search_term(SearchDef(r"^\S+ \S+ INFO (\d+)", tag="T2"),
+                              path)
+            s.matchers[path] = SearchTermMatcher(s.paths[path])
+            with open(path, 'rb') as fd:
+                expected = s._search_task(path, fd)
+                fd.seek(0)
+                actual = s._search_task_buffer(path, fd.read())
+
+            self.assertEquals(len(actual), 1000)
+            self.assertEquals(actual, expected)
+
+    @mock.patch("common.searchtools.MIN_CHUNK_SIZE", 1024)
+    @mock.patch.object(os, "environ", {"USER_MAX_PARALLEL_TASKS": 8})
+    @mock.patch.object(os, "cpu_count", lambda: 8)
+    def test_filesearcher_chunks(self):
+        with tempfile.TemporaryDirectory() as dtmp:
+            path = os.path.join(dtmp, "test.log")
+            with open(path, 'w') as fd:
+                for i in range(1000):
+                    fd.write("2021-01-01 00:00:00 {} {}\n".
+                             format("ERROR" if i % 7 else "INFO", i))
+
+            s = FileSearcher()
+            s.add_search_term(SearchDef(r"^\S+ \S+ INFO (\d+)", tag="T1",
+                                        hint="INFO"), path)
+            s.add_search_term(SearchDef(r"^\S+ \S+ \S+ (\d+)", tag="T2"),
+                              path)
+            s.matchers[path] = SearchTermMatcher(s.paths[path])
+            chunks = s._get_chunks(path, path)
+            self.assertEquals(len(chunks), 8)
+            self.assertEquals(chunks[0][0], 0)
+            self.assertEquals(chunks[-1][1], os.path.getsize(path))
+            results = s.search().find_by_path(path)
+            self.assertEquals(len(results), 1143)
+            for result in results:
+                self.assertEquals(int(result.get(1)),
+                                  result.linenumber - 1)
+
+    @mock.patch("common.searchtools.MIN_CHUNK_SIZE", 1024)
+    @mock.patch.object(os, "environ", {"USER_MAX_PARALLEL_TASKS": 8})
+    @mock.patch.object(os, "cpu_count", lambda: 8)
+    def test_filesearcher_search_iter(self):
+        with tempfile.TemporaryDirectory() as dtmp:
+            for i, num_lines in enumerate([10, 1000, 0]):
+                with open(os.path.join(dtmp, "{}.log".format(i)), 'w') as fd:
+                    for j in range(num_lines):
+                        level = "ERROR" if j % 3 else "INFO"
+                        fd.write("{} {}\n".format(level, j))
+
+            s = FileSearcher()
+            s.add_search_term(SearchDef(r"^ERROR (\d+)", tag="T1"), dtmp)
+            s.add_search_term(SearchDef(r"^INFO (\d+)", tag="T2",
+                                        hint="INFO"), dtmp)
+            expected = {}
+            for path, results in s.search():
+                expected[path] = [(r.linenumber, r.tag, r.get(1))
+                                  for r in results]
+
+            actual = {}
+            for path, results, aggregates in s.search_iter():
+                self.assertEquals(aggregates, {})
+                actual[path] = [(r.linenumber, r.tag, r.get(1))
+                                for r in results]
+
+            self.assertEquals(len(actual), 3)
+            self.assertEquals(len(actual[os.path.join(dtmp, "1.log")]), 1000)
+            self.assertEquals(actual, expected)
+
+    @mock.patch("common.searchtools.MIN_CHUNK_SIZE", 1024)
+    @mock.patch.object(os, "environ", {"USER_MAX_PARALLEL_TASKS": 8})
+    @mock.patch.object(os, "cpu_count", lambda: 8)
+    def test_filesearcher_aggregate(self):
+        with tempfile.TemporaryDirectory() as dtmp:
+            path = os.path.join(dtmp, "test.log")
+            with open(path, 'w') as fd:
+                for i in range(1000):
+                    fd.write("2021-01-0{} {} {}\n".
+                             format(i % 3, "ERROR" if i % 2 else "INFO", i))
+
+            expr = r"^(\S+) (\S+) (\d+)"
+            searches = [SearchDef(expr, tag="count",
+                                  aggregate=SearchAggregate(group_by=[2, 1])),
+                        SearchDef(expr, tag="sum",
+                                  aggregate=SearchAggregate(
+                                      op=SearchAggregate.SUM, value=3)),
+                        SearchDef(expr, tag="max",
+                                  aggregate=SearchAggregate(
+                                      group_by=[2], op=SearchAggregate.MAX,
+                                      value=3)),
+                        SearchDef(r"^\S+ INFO (\d+)", tag="T1")]
+            s = FileSearcher()
+            for search in searches:
+                s.add_search_term(search, path)
+
+            results = s.search()
+            self.assertEquals(len(s._get_chunks(path, path)), 8)
+            counts = results.find_aggregate_by_tag("count")
+            self.assertEquals(len(counts), 6)
+            self.assertEquals(counts[("ERROR", "2021-01-01")], 167)
+            self.assertEquals(sum(counts.values()), 1000)
+            self.assertEquals(results.find_aggregate_by_tag("sum"),
+                              {(): sum(range(1000))})
+            self.assertEquals(results.find_aggregate_by_tag("max"),
+                              {("ERROR",): 999, ("INFO",): 998})
+            self.assertEquals(results.find_aggregate_by_tag("max", path),
+                              {("ERROR",): 999, ("INFO",): 998})
+            # aggregated terms are not returned as results
+            self.assertEquals(len(results.find_by_path(path)), 500)
+            self.assertEquals(results.find_by_tag("count"), [])
+
+            # aggregates are cached
+            os.environ["SEARCH_CACHE_DIR"] = os.path.join(dtmp, "cache")
+            s.search()
+            s2 = FileSearcher()
+            for search in searches:
+                s2.add_search_term(search, path)
+
+            self.assertEquals(s2.search().find_aggregate_by_tag("count"),
+                              counts)
+            self.assertEquals(s2.matchers, {})
+
+    @mock.patch("common.searchtools.MIN_CHUNK_SIZE", 1024)
+    @mock.patch.object(os, "environ", {"USER_MAX_PARALLEL_TASKS": 8})
+    @mock.patch.object(os, "cpu_count", lambda: 8)
+    def test_filesearcher_aggregate_order(self):
+        with tempfile.TemporaryDirectory() as dtmp:
+            path = os.path.join(dtmp, "test.log")
+            expected = []
+            with open(path, 'w') as fd:
+                for i in range(1000):
+                    level = "ERROR" if i % 3 else "INFO"
+                    key = (level, str(999 - i))
+                    expected.append(key)
+                    fd.write("{} {}\n".format(*key))
+
+            s = FileSearcher()
+            # keys of terms sharing a tag are in the order first seen
+            for level in ["INFO", "ERROR"]:
+                s.add_search_term(SearchDef(r"^({}) (\d+)".format(level),
+                                            tag="T1",
+                                            aggregate=SearchAggregate(
+                                                group_by=[1, 2])), path)
+
+            results = s.search()
+            self.assertEquals(len(s._get_chunks(path, path)), 8)
+            self.assertEquals(list(results.find_aggregate_by_tag("T1")),
+                              expected)
+
+    def test_search_aggregate_invalid(self):
+        self.assertRaises(Exception, SearchAggregate, op="avg")
+        self.assertRaises(Exception, SearchAggregate, op=SearchAggregate.SUM)
+
+    def test_get_blocks(self):
+        chunks = [b"a\nb", b"c\n", b"d", b"e", b"\nf"]
+        self.assertEquals(list(get_blocks(chunks, 2)),
+                          [b"a\n", b"bc\n", b"de\n", b"f"])
+        self.assertEquals(b"".join(get_blocks(chunks, 1024)),
+                          b"".join(chunks))
+
+    @mock.patch("common.searchtools.DECOMPRESS_BLOCK_SIZE", 1024)
+    def test_filesearcher_compressed(self):
+        with tempfile.TemporaryDirectory() as dtmp:
+            lines = ["{} {}\n".format("ERROR" if i % 3 else "INFO", i)
+                     for i in range(1000)]
+            data = "".join(lines).encode()
+            paths = {"plain": os.path.join(dtmp, "test.log"),
+                     "gzip": os.path.join(dtmp, "test.log.1.gz"),
+                     "xz": os.path.join(dtmp, "test.log.2.xz")}
+            with open(paths["plain"], 'wb') as fd:
+                fd.write(data)
+
+            with open(paths["gzip"], 'wb') as fd:
+                # multi-member
+                fd.write(gzip.compress(data[:5000]))
+                fd.write(gzip.compress(data[5000:]))
+
+            with open(paths["xz"], 'wb') as fd:
+                fd.write(lzma.compress(data))
+
+            if shutil.which("zstd"):
+                paths["zstd"] = os.path.join(dtmp, "test.log.3.zst")
+                subprocess.check_call(["zstd", "-q", paths["plain"], "-o",
+                                       paths["zstd"]])
+
+            for compression, path in paths.items():
+                if compression != "plain":
+                    self.assertEquals(get_compression(path), compression)
+                else:
+                    self.assertEquals(get_compression(path), None)
+
+            s = FileSearcher()
+            s.add_search_term(SearchDef(r"^ERROR (\d+)", tag="T1"),
+                              os.path.join(dtmp, "test.log*"))
+            s.add_search_term(SearchDef(r"^INFO (\d+)", tag="T2",
+                                        hint="INFO"),
+                              os.path.join(dtmp, "test.log*"))
+            results = s.search()
+            expected = [(r.linenumber, r.tag, r.get(1))
+                        for r in results.find_by_path(paths["plain"])]
+            self.assertEquals(len(expected), 1000)
+            for path in paths.values():
+                self.assertEquals([(r.linenumber, r.tag, r.get(1))
+                                   for r in results.find_by_path(path)],
+                                  expected)
+
+    def test_search_time_window(self):
+        lines = []
+        for hour in range(24):
+            lines.append("2021-03-25 {:02d}:00:00.123 INFO foo\n".
+                         format(hour))
+            lines.append("Traceback (most recent call last):\n")
+            lines.append("2021-03-25T{:02d}:30:00 ERROR bar\n".format(hour))
+
+        buf = "".join(lines).encode()
+        window = SearchTimeWindow(since="2021-03-25 10:15")
+        start, end = window.get_offsets(buf, 0, len(buf))
+        self.assertTrue(buf[start:].startswith(b"2021-03-25T10:30:00"))
+        self.assertEquals(end, len(buf))
+
+        window = SearchTimeWindow(since="2021-03-25 10:00:00",
+                                  until="2021-03-25 12:00:00")
+        start, end = window.get_offsets(buf, 0, len(buf))
+        self.assertTrue(buf[start:].startswith(b"2021-03-25 10:00:00"))
+        # lines without a timestamp belong to the line before
+        self.assertTrue(buf[:end].endswith(b"Traceback (most recent call "
+                                           b"last):\n"))
+        self.assertTrue(buf[end:].startswith(b"2021-03-25T12:30:00"))
+
+        window = SearchTimeWindow(since="2021-03-26")
+        self.assertEquals(window.get_offsets(buf, 0, len(buf)),
+                          (len(buf), len(buf)))
+        window = SearchTimeWindow(until="2021-03-24")
+        self.assertEquals(window.get_offsets(buf, 0, len(buf)), (0, 0))
+
+        # no timestamps
+        buf = b"foo\nbar\n"
+        self.assertEquals(window.get_offsets(buf, 0, len(buf)), (0, 8))
+        self.assertFalse(SearchTimeWindow().active)
+        self.assertRaises(Exception, SearchTimeWindow, since="25/03/2021")
+
+    def test_filesearcher_time_window(self):
+        with tempfile.TemporaryDirectory() as dtmp:
+            path = os.path.join(dtmp, "test.log")
+            for day, suffix in [(22, ".3.gz"), (23, ".2.gz"), (24, ".1"),
+                                (25, "")]:
+                lines = ["2021-03-{} {:02d}:00:00 ERROR {}\n".
+                         format(day, hour, hour) for hour in range(24)]
+                data = "".join(lines).encode()
+                if suffix.endswith(".gz"):
+                    data = gzip.compress(data)
+
+                with open(path + suffix, 'wb') as fd:
+                    fd.write(data)
+
+            window = SearchTimeWindow(since="2021-03-23 12:00",
+                                      until="2021-03-24 12:00")
+            files = sorted(glob.glob(path + "*"))
+            self.assertEquals(window.get_file_timestamps(path + ".1"),
+                              (b"2021-03-24 00:00:00",
+                               b"2021-03-24 23:00:00"))
+            self.assertEquals(window.get_file_timestamps(path + ".2.gz"),
+                              (b"2021-03-23 00:00:00", None))
+            self.assertEquals(window.filter_files(files),
+                              [path + ".1", path + ".2.gz"])
+
+            s = FileSearcher(since="2021-03-23 12:00",
+                             until="2021-03-24 12:00")
+            s.add_search_term(SearchDef(r"^(\S+) \S+ ERROR (\d+)"),
+                              path + "*")
+            results = s.search()
+            self.assertEquals(sorted(results.files),
+                              [path + ".1", path + ".2.gz"])
+            self.assertEquals([(r.linenumber, r.get(2)) for r in
+                               results.find_by_path(path + ".2.gz")],
+                              [(i + 1, str(i)) for i in range(12, 24)])
+            self.assertEquals([(r.linenumber, r.get(2)) for r in
+                               results.find_by_path(path + ".1")],
+                              [(i + 1, str(i)) for i in range(0, 13)])
+
+    @mock.patch("common.searchtools.MIN_CHUNK_SIZE", 1024)
+    @mock.patch("common.searchtools.DECOMPRESS_BLOCK_SIZE", 64)
+    @mock.patch.object(os, "environ", {"USER_MAX_PARALLEL_TASKS": 8})
+    @mock.patch.object(os, "cpu_count", lambda: 8)
+    def test_filesearcher_time_window_no_timestamp(self):
+        with tempfile.TemporaryDirectory() as dtmp:
+            # each ERROR line is followed by a traceback, including the last
+            # which is at the end of the file
+            lines = []
+            for i in range(100):
+                lines.append("2021-03-25 {:02d}:{:02d}:00 ERROR {}\n".
+                             format(i // 60, i % 60, i))
+                lines += ["Traceback (most recent call last):\n",
+                          "  File \"foo.py\", line {}\n".format(i),
+                          "RuntimeError: {}\n".format(i)]
+
+            data = "".join(lines).encode()
+            path = os.path.join(dtmp, "test.log")
+            with open(path, 'wb') as fd:
+                fd.write(data)
+
+            with open(path + ".1.gz", 'wb') as fd:
+                fd.write(gzip.compress(data))
+
+            for since, until, expected in [(None, "2030-01-01", range(100)),
+                                           ("2021-03-25 00:10", None,
+                                            range(10, 100)),
+                                           ("2021-03-25 00:10",
+                                            "2021-03-25 01:00",
+                                            range(10, 61))]:
+                s = FileSearcher(since=since, until=until)
+                s.add_search_term(SearchDef(r"^RuntimeError: (\d+)"),
+                                  path + "*")
+                s.matchers[path] = SearchTermMatcher(s.paths[path + "*"])
+                # the file is searched in chunks that end in tracebacks
+                self.assertEquals(len(s._get_chunks(path, path)), 8)
+                results = s.search()
+                for p in [path, path + ".1.gz"]:
+                    self.assertEquals([int(r.get(1)) for r in
+                                       results.find_by_path(p)],
+                                      list(expected))
+
+    def test_search_time_window_previous(self):
+        lines = ["2021-03-25 10:00:00 ERROR a\n",
+                 "  cont ERROR b\n",
+                 "2021-03-25 11:00:00 ERROR c\n",
+                 "2021-03-25 12:00:00 ERROR d\n"]
+        buf = "".join(lines).encode()
+        start = len(lines[0])
+        window = SearchTimeWindow(since="2021-03-25 10:00",
+                                  until="2021-03-25 11:00")
+        # the line before the range is read to know which lines at its start
+        # belong to the window
+        self.assertEquals(window.get_offsets(buf, start, len(buf)),
+                          (start, len(buf) - len(lines[3])))
+        window = SearchTimeWindow(since="2021-03-25 10:30")
+        self.assertEquals(window.get_offsets(buf, start, len(buf)),
+                          (start + len(lines[1]), len(buf)))
+        window = SearchTimeWindow(until="2021-03-25 09:00")
+        self.assertEquals(window.get_offsets(buf, start, len(buf)),
+                          (start, start))
+        # or is given if not in buf
+        buf = "".join(lines[1:]).encode()
+        window = SearchTimeWindow(since="2021-03-25 10:00")
+        self.assertEquals(window.get_offsets(buf, 0, len(buf),
+                                             previous=b"2021-03-25 10:00:00"),
+                          (0, len(buf)))
+        self.assertEquals(window.get_offsets(buf, 0, len(buf)),
+                          (len(lines[1]), len(buf)))
+
+    @mock.patch("common.searchtools.NEWEST_BLOCK_SIZE", 100)
+    def test_filesearcher_newest(self):
+        with tempfile.TemporaryDirectory() as dtmp:
+            path = os.path.join(dtmp, "test.log")
+            lines = ["{} {}\n".format("ERROR" if i % 3 else "INFO", i)
+                     for i in range(1000)]
+            data = "".join(lines).encode()
+            with open(path, 'wb') as fd:
+                fd.write(data)
+
+            with open(path + ".1.gz", 'wb') as fd:
+                fd.write(gzip.compress(data))
+
+            searches = [SearchDef(r"^ERROR (\d+)", tag="T1"),
+                        SearchDef(r"^INFO (\d+)", tag="T2"),
+                        SearchDef(r"^\S+ (\d+)", tag="T3",
+                                  aggregate=SearchAggregate(group_by=[]))]
+            s = FileSearcher()
+            for search in searches:
+                s.add_search_term(search, path + "*")
+
+            expected = []
+            for tag in ["T1", "T2"]:
+                expected.extend([(r.linenumber, r.tag, r.get(1)) for r in
+                                 s.search().find_by_tag(tag,
+                                                        path=path)[-5:]])
+
+            expected = sorted(expected)
+            s = FileSearcher(newest=5)
+            for search in searches:
+                s.add_search_term(search, path + "*")
+
+            results = s.search()
+            # lines before the newest matches are only counted when needed
+            self.assertTrue(all([r._linenumber < 0 for r in
+                                 results.find_by_path(path)]))
+            for _path in [path, path + ".1.gz"]:
+                self.assertEquals([(r.linenumber, r.tag, r.get(1)) for r in
+                                   results.find_by_path(_path)], expected)
+                self.assertEquals(results.find_aggregate_by_tag("T3", _path),
+                                  {(): 5})
+
+            # a last line without a newline is still counted
+            with open(path, 'wb') as fd:
+                fd.write(data[:-1])
+
+            self.assertEquals([(r.linenumber, r.tag, r.get(1)) for r in
+                               s.search().find_by_path(path)], expected)
+
+    @mock.patch("common.searchtools.LINE_INDEX_STRIDE", 100)
+    def test_line_index(self):
+        lines = ["2021-03-25 {:02d}:00:00 ERROR {}\n".format(i // 4, i)
+                 for i in range(96)]
+        # lines without a timestamp belong to the one before
+        lines.insert(50, "Traceback\n")
+        buf = "".join(lines).encode()
+        index = LineIndex.build(buf)
+        self.assertTrue(1 < len(index) < 96)
+        for ln in [1, 2, 50, 51, 52, 97]:
+            offset = index.get_offset(buf, ln)
+            self.assertEquals(offset, len("".join(lines[:ln - 1])))
+            self.assertEquals(index.get_linenumber(buf, offset), ln)
+
+        self.assertEquals(index.get_offset(buf, 1000), len(buf))
+        # no entry is at a line without a timestamp
+        self.assertEquals([e for e in index.entries if e[2] is None], [])
+        start, end = index.get_time_range(b"2021-03-25 12:00:00",
+                                          b"2021-03-25 14:00:00")
+        self.assertTrue(start <= buf.index(b"2021-03-25 12:00:00"))
+        self.assertTrue(end >= buf.index(b"2021-03-25 15:00:00"))
+
+        # indexes of consecutive ranges make up that of the whole
+        mid = index.offsets[len(index) // 2]
+        merged = LineIndex.build(buf, 0, mid)
+        merged.merge(LineIndex.build(buf, mid, len(buf)),
+                     buf[:mid].count(b"\n"))
+        self.assertEquals(merged.entries, index.entries)
+
+    @mock.patch("common.searchtools.LINE_INDEX_MIN_SIZE", 0)
+    @mock.patch("common.searchtools.LINE_INDEX_STRIDE", 1000)
+    @mock.patch("common.searchtools.MIN_CHUNK_SIZE", 1024)
+    @mock.patch.object(os, "cpu_count", lambda: 8)
+    def test_filesearcher_line_index(self):
+        with tempfile.TemporaryDirectory() as dtmp:
+            path = os.path.join(dtmp, "test.log")
+            with open(path, 'w') as fd:
+                for i in range(2400):
+                    fd.write("2021-03-25 {:02d}:{:02d}:00 {} {}\n".
+                             format(i // 100, i % 60,
+                                    "ERROR" if i % 3 else "INFO", i))
+
+            def get_results(**kwargs):
+                start_line = kwargs.pop("start_line", None)
+                s = FileSearcher(**kwargs)
+                s.add_search_term(SearchDef(r"^(\S+ \S+) ERROR (\d+)"), path)
+                if start_line:
+                    s.set_start_line(path, start_line)
+
+                return [(r.linenumber, r.get(2)) for r in
+                        s.search().find_by_path(path)]
+
+            expected = get_results()
+            window = {"since": "2021-03-25 05:00", "until": "2021-03-25 17:00"}
+            expected_window = get_results(**window)
+            cache_dir = os.path.join(dtmp, "cache")
+            env = {"SEARCH_CACHE_DIR": cache_dir,
+                   "USER_MAX_PARALLEL_TASKS": "8"}
+            with mock.patch.dict(os.environ, env):
+                cache = SearchResultsCache(cache_dir)
+                # newest searches do not read the whole file to index it
+                self.assertEquals(get_results(newest=1000), expected[-1000:])
+                self.assertIsNone(cache.get_index(path))
+                # the file is indexed in chunks by the first search
+                self.assertEquals(get_results(), expected)
+                index = cache.get_index(path)
+                with open(path, 'rb') as fd:
+                    buf = fd.read()
+
+                self.assertTrue(len(index) > 1)
+                for offset, ln, _ in index.entries:
+                    self.assertEquals(ln, buf[:offset].count(b"\n") + 1)
+                self.assertEquals(get_results(newest=1000), expected[-1000:])
+                self.assertEquals(get_results(**window), expected_window)
+                self.assertEquals(get_results(start_line=1001),
+                                  [r for r in expected if r[0] >= 1001])
+                os.environ["USER_MAX_PARALLEL_TASKS"] = "0"
+                self.assertEquals(get_results(**window), expected_window)
+
+    @mock.patch("common.searchtools.TOKEN_INDEX_BLOCK_SIZE", 1)
+    def test_token_index(self):
+        buf = b"foo bar_baz\n1\nREQUEST_SLOW x\nAgent rpc_loop\n"
+        index = TokenIndex.build(buf)
+        # one line per block
+        self.assertEquals(index.blocks,
+                          [(0, 1), (12, 2), (14, 3), (29, 4), (44, 5)])
+        self.assertEquals(index.get_blocks(b"bar_baz"), {0})
+        self.assertEquals(index.get_blocks(b"QUEST_SL"), {2})
+        self.assertEquals(index.get_blocks(b"Agent rpc_l"), {3})
+        self.assertEquals(index.get_blocks(b"gent rpc_"), {3})
+        self.assertEquals(index.get_blocks(b"Agent rpc_loop "), {3})
+        self.assertEquals(index.get_blocks(b"Agent rpc_loopy"), set())
+        self.assertEquals(index.get_blocks(b"foo rpc"), set())
+        # nothing to look up
+        self.assertEquals(index.get_blocks(b"123"), {0, 1, 2, 3})
+        self.assertEquals(index.get_ranges([b"foo", b"SLOW"]),
+                          [(0, 12, 1), (14, 29, 3)])
+        self.assertEquals(index.get_ranges([b"SLOW", b"rpc"]),
+                          [(14, 44, 3)])
+
+    @mock.patch("common.searchtools.TOKEN_INDEX_BLOCK_SIZE", 1)
+    def test_token_index_long_token(self):
+        long_token = b"x" * 70 + b"_rpc_loop_y"
+        buf = b"foo\n" + long_token + b"\nbar rpc_loop\n"
+        index = TokenIndex.build(buf)
+        self.assertEquals(index.long_blocks, [1])
+        # a part of a token too long to be indexed may be in its block
+        self.assertEquals(index.get_blocks(b"rpc_loop"), {1, 2})
+        self.assertEquals(index.get_blocks(b"x_rpc"), {1})
+        self.assertEquals(index.get_blocks(b"bar rpc_loop"), {1, 2})
+        self.assertEquals(index.get_blocks(b"foo"), {0, 1})
+        # whole tokens cannot be part of a longer one
+        self.assertEquals(index.get_blocks(b" foo "), {0})
+        self.assertEquals(index.get_blocks(long_token), {0, 1, 2})
+        with tempfile.TemporaryDirectory() as dtmp:
+            path = os.path.join(dtmp, "test.log")
+            with open(path, 'wb') as fd:
+                fd.write(buf)
+
+            store = TokenIndexStore(os.path.join(dtmp, "index"))
+            self.assertEquals(store.build([path]), 1)
+            self.assertEquals(store.get(path).get_ranges([b"rpc_loop"]),
+                              [(4, len(buf), 2)])
+
+    @mock.patch("common.searchtools.TOKEN_INDEX_BLOCK_SIZE", 1000)
+    def test_filesearcher_token_index(self):
+        with tempfile.TemporaryDirectory() as dtmp:
+            log_dir = os.path.join(dtmp, "var/log")
+            os.makedirs(log_dir)
+            path = os.path.join(log_dir, "test.log")
+            with open(path, 'w') as fd:
+                for i in range(2400):
+                    if i % 500 == 250:
+                        msg = "Agent rpc_loop took {}".format(i)
+                    else:
+                        msg = "ERROR {}".format(i)
+
+                    fd.write("2021-03-25 {:02d}:{:02d}:00 {}\n".
+                             format(i // 100, i % 60, msg))
+
+            def get_results(**kwargs):
+                s = FileSearcher(**kwargs)
+                s.add_search_term(SearchDef(r"^(\S+ \S+) .+ rpc_loop took "
+                                            r"(\d+)", hint="Agent rpc_loop"),
+                                  path)
+                s.add_search_term(SearchDef(r"^(\S+ \S+) ERROR (12\d\d)",
+                                            hint="ERROR"), path)
+                return [(r.linenumber, r.get(2)) for r in
+                        s.search().find_by_path(path)]
+
+            expected = get_results()
+            window = {"since": "2021-03-25 05:00", "until": "2021-03-25 17:00"}
+            expected_window = get_results(**window)
+            index_dir = os.path.join(dtmp, "index")
+            store = TokenIndexStore(index_dir)
+            self.assertEquals(store.build([dtmp]), 1)
+            # already indexed
+            self.assertEquals(store.build([log_dir]), 0)
+            with mock.patch.dict(os.environ, {"SEARCH_INDEX_DIR": index_dir}):
+                # searches run in other processes so fail them if the whole
+                # file is searched.
+                close_pool()
+                with mock.patch.object(FileSearcher, "_search_task_buffer",
+                                       side_effect=Exception("not indexed")):
+                    self.assertEquals(get_results(), expected)
+                    self.assertEquals(get_results(**window), expected_window)
+
+                close_pool()
+                # the index is not used once the file changes
+                with open(path, 'a') as fd:
+                    fd.write("2021-03-25 23:59:00 Agent rpc_loop took 1\n")
+
+                self.assertEquals(get_results(), expected + [(2401, "1")])
+
+    def test_filesearcher_largest_first(self):
+        with tempfile.TemporaryDirectory() as dtmp:
+            lines = "".join(["ERROR {}\n".format(i) for i in range(1000)])
+            files = {"small.log": lines[:100].encode(),
+                     "big.log": lines.encode(),
+                     # compressed files cost more per byte
+                     "medium.log.1.gz": gzip.compress(lines.encode())}
+            for name, data in files.items():
+                with open(os.path.join(dtmp, name), 'wb') as fd:
+                    fd.write(data)
+
+            path = os.path.join(dtmp, "*")
+            s = FileSearcher()
+            s.add_search_term(SearchDef(r"^ERROR (\d+)"), path)
+            pool = mock.MagicMock()
+            jobs = s._submit_jobs(None, pool=pool)
+            self.assertEquals([os.path.basename(c[0][1][1]) for c in
+                               pool.apply_async.call_args_list],
+                              ["big.log", "medium.log.1.gz", "small.log"])
+            # jobs are still in the order the files were found
+            self.assertEquals(list(jobs[path]), glob.glob(path))
+
+            s.search()
+            self.assertEquals(sorted(s.timings), sorted(glob.glob(path)))
+
+    def test_filesearcher_dedup_paths(self):
+        with tempfile.TemporaryDirectory() as dtmp:
+            path = os.path.join(dtmp, "real.log")
+            with open(path, 'w') as fd:
+                for i in range(10):
+                    fd.write("{} {}\n".format("ERROR" if i % 2 else "INFO",
+                                              i))
+
+            link = os.path.join(dtmp, "link.log")
+            os.symlink(path, link)
+            s = FileSearcher()
+            s.add_search_term(SearchDef(r"^ERROR (\d+)", tag="T1"),
+                              os.path.join(dtmp, "*.log"))
+            s.add_search_term(SearchDef(r"^INFO (\d+)", tag="T2"), dtmp)
+            s.add_search_term(SearchDef(r"^ERROR (\d+)", tag="T1",
+                                        hint="ERROR"), path)
+            s.add_search_term(SearchDef(r"^ERROR (\d+)", tag="T1"), path)
+            pool = mock.MagicMock()
+            s._submit_jobs(None, pool=pool)
+            # both files are the same so are searched once with each
+            # distinct term searched for once.
+            self.assertEquals(pool.apply_async.call_count, 1)
+            self.assertEquals(len(pool.apply_async.call_args[0][1][3].
+                                  entries), 3)
+
+            results = s.search()
+            self.assertEquals(sorted(results.files), sorted([path, link]))
+            self.assertEquals([(r.linenumber, r.tag) for r in
+                               results.find_by_path(link)],
+                              [(1, "T2"), (2, "T1"), (3, "T2"), (4, "T1"),
+                               (5, "T2"), (6, "T1"), (7, "T2"), (8, "T1"),
+                               (9, "T2"), (10, "T1")])
+            # the explicit path also gets the results of its own terms
+            self.assertEquals(len(results.find_by_path(path)), 20)
+            self.assertEquals([r.source for r in results.find_by_tag("T1",
+                                                                     link)],
+                              [link] * 5)
+            self.assertEquals([r.tag for r in results.find_by_path(path)][:4],
+                              ["T2", "T1", "T1", "T1"])
+
+    def test_filesearcher_read_ahead(self):
+        with tempfile.TemporaryDirectory() as dtmp:
+            for i in range(10):
+                with open(os.path.join(dtmp, "{}.log".format(i)), 'w') as fd:
+                    for j in range(100 * i):
+                        fd.write("{} {}\n".format("ERROR" if j % 2 else
+                                                  "INFO", j))
+
+            def get_results():
+                s = FileSearcher()
+                s.add_search_term(SearchDef(r"^ERROR (\d+)", tag="T1"),
+                                  os.path.join(dtmp, "*.log"))
+                results = s.search()
+                return {f: [(r.linenumber, r.get(1)) for r in
+                            results.find_by_path(f)] for f in results.files}
+
+            expected = get_results()
+            self.assertEquals(len(expected), 10)
+            with mock.patch.dict(os.environ, {"SEARCH_READ_AHEAD": "2"}):
+                with mock.patch.object(FileReader, "read",
+                                       wraps=FileReader.read) as mock_read:
+                    self.assertEquals(get_results(), expected)
+                    self.assertEquals(sorted([c[0][0] for c in
+                                              mock_read.call_args_list]),
+                                      sorted(expected))
+
+    def test_file_reader(self):
+        with tempfile.TemporaryDirectory() as dtmp:
+            reader = FileReader(2)
+            done = []
+            for i in range(4):
+                path = os.path.join(dtmp, "{}.log".format(i))
+                with open(path, 'w') as fd:
+                    fd.write("foo\n")
+
+                reader.submit(path, lambda i=i: done.append(i))
+                # slots are freed once files have been searched
+                reader.done()
+
+            reader.submit(os.path.join(dtmp, "missing.log"),
+                          lambda: done.append(None))
+            reader.close()
+            # files that cannot be read are left to the search to report
+            self.assertEquals(sorted(done, key=str), [0, 1, 2, 3, None])
+
+    def test_filesearcher_cache(self):
+        with tempfile.TemporaryDirectory() as dtmp:
+            path = os.path.join(dtmp, "test.log")
+            with open(path, 'w') as fd:
+                for i in range(100):
+                    fd.write("{} {}\n".format("ERROR" if i % 2 else "INFO",
+                                              i))
+
+            cache_dir = os.path.join(dtmp, "cache")
+            with mock.patch.dict(os.environ, {"SEARCH_CACHE_DIR": cache_dir}):
+                s = FileSearcher()
+                s.add_search_term(SearchDef(r"^ERROR (\d+)", tag="T1"), path)
+                expected = [(r.linenumber, r.tag, r.get(1)) for r in
+                            s.search().find_by_path(path)]
+                self.assertEquals(len(expected), 50)
+                self.assertEquals(len(os.listdir(cache_dir)), 1)
+
+                # same term, different tag and a new term
+                s = FileSearcher()
+                s.add_search_term(SearchDef(r"^INFO (\d+)", tag="T2"), path)
+                s.add_search_term(SearchDef(r"^ERROR (\d+)", tag="T3"), path)
+                results = s.search().find_by_path(path)
+                # only the new term was searched
+                self.assertEquals(list(s.matchers), [(path, (0,))])
+                self.assertEquals([(r.linenumber, r.get(1)) for r in results
+                                   if r.tag == "T3"],
+                                  [(ln, value) for ln, _, value in expected])
+                self.assertEquals([r.linenumber for r in results][:3],
+                                  [1, 2, 3])
+
+                # everything is cached now
+                s2 = FileSearcher()
+                s2.add_search_term(SearchDef(r"^INFO (\d+)", tag="T2"), path)
+                s2.add_search_term(SearchDef(r"^ERROR (\d+)", tag="T3"), path)
+                close_pool()
+                with mock.patch("common.searchtools.get_pool") as \
+                        mock_get_pool:
+                    self.assertEquals(len(s2.search().find_by_path(path)),
+                                      100)
+                    # no workers are started if nothing needs searching
+                    self.assertFalse(mock_get_pool.called)
+
+                self.assertEquals(s2.matchers, {})
+
+                # modifying the file invalidates the cache
+                with open(path, 'a') as fd:
+                    fd.write("ERROR 100\n")
+
+                self.assertEquals(len(s.search().find_by_tag("T3")), 51)
+
+    def test_search_results_cache_evict(self):
+        with tempfile.TemporaryDirectory() as dtmp:
+            cache = SearchResultsCache(dtmp, max_size=1000)
+            for i in range(5):
+                with open(os.path.join(dtmp, str(i)), 'wb') as fd:
+                    fd.write(b"x" * 300)
+
+                os.utime(os.path.join(dtmp, str(i)), (i, i))
+
+            cache.evict()
+            self.assertEquals(sorted(os.listdir(dtmp)), ["2", "3", "4"])
+
+    def test_search_registry(self):
+        logs_root = "var/log/neutron/"
+        filepath = os.path.join(os.environ["DATA_ROOT"], logs_root,
+                                'neutron-openvswitch-agent.log')
+        registry = SearchRegistry()
+        part1 = registry.get_searcher("part1")
+        part1.add_search_term(SearchDef(r'^(\S+\s+[0-9:\.]+)\s+.+full sync.+',
+                                        tag="T1"), filepath)
+        part2 = registry.get_searcher("part2")
+        part2.add_search_term(SearchDef(r'^(\S+\s+[0-9:\.]+)\s+.+ERROR.+',
+                                        tag="T1"), filepath)
+        part2.add_search_term(SearchDef(r'^(\S+\s+[0-9:\.]+)\s+.+full sync.+',
+                                        tag="T2"), filepath)
+        results = registry.search()
+        self.assertEquals(sorted(results), ["part1", "part2"])
+        self.assertEquals(len(results["part1"].find_by_tag("T1")), 2)
+        self.assertEquals(len(results["part1"].find_by_path(filepath)), 2)
+        self.assertEquals(len(results["part2"].find_by_tag("T2")), 2)
+        self.assertEquals(len(results["part2"].find_by_path(filepath)), 37)
+
+    def test_search_registry_single_search(self):
+        with tempfile.TemporaryDirectory() as dtmp:
+            path = os.path.join(dtmp, "test.log")
+            with open(path, 'w') as fd:
+                fd.write("ERROR 1\nINFO 2\nERROR 3\n")
+
+            registry = SearchRegistry()
+            registry.get_searcher("part1").add_search_term(
+                SearchDef(r"^ERROR (\d+)", tag="T1"), path)
+            registry.get_searcher("part2").add_search_term(
+                SearchDef(r"^INFO (\d+)", tag="T1"), path)
+            registry.get_searcher("part2").add_search_term(
+                SearchDef(r"^ERROR (\d+)", tag="T1"), dtmp)
+            with mock.patch.object(FileSearcher, "_submit_jobs",
+                                   autospec=True,
+                                   side_effect=FileSearcher._submit_jobs) as \
+                    mock_submit_jobs:
+                results = registry.search()
+                # consumers get their results from the one search
+                self.assertEquals(mock_submit_jobs.call_count, 1)
+
+            self.assertEquals([(r.linenumber, r.get(1)) for r in
+                               results["part1"].find_by_tag("T1")],
+                              [(1, "1"), (3, "3")])
+            self.assertEquals([(r.linenumber, r.get(1)) for r in
+                               results["part2"].find_by_tag("T1")],
+                              [(1, "1"), (2, "2"), (3, "3")])
+
+    @mock.patch.dict("common.searchtools.PRESEARCHED", {})
+    def test_search_registry_share(self):
+        with tempfile.TemporaryDirectory() as dtmp:
+            path = os.path.join(dtmp, "test.log")
+            with open(path, 'w') as fd:
+                fd.write("ERROR 1\nINFO 2\nERROR 3\n")
+
+            def add_terms(searchobj):
+                searchobj.add_search_term(SearchDef(r"^ERROR (\d+)",
+                                                    tag="T1"), path)
+                searchobj.add_search_term(
+                    SearchDef(r"^(\S+) (\d+)", tag="T2",
+                              aggregate=SearchAggregate(group_by=[1])), path)
+
+            registry = SearchRegistry()
+            add_terms(registry.get_searcher("part1"))
+            registry.get_searcher("part2").add_search_term(
+                SearchDef(r"^INFO (\d+)", tag="T1"), path)
+            expected = registry.search(share=True)
+            with mock.patch.object(FileSearcher, "_submit_jobs",
+                                   autospec=True,
+                                   side_effect=FileSearcher._submit_jobs) as \
+                    mock_submit_jobs:
+                # consumers get their share without searching again
+                s = FileSearcher()
+                add_terms(s)
+                self.assertEquals([(r.linenumber, r.get(1)) for r in
+                                   s.search().find_by_tag("T1")],
+                                  [(1, "1"), (3, "3")])
+                s = FileSearcher()
+                s.add_search_term(SearchDef(r"^INFO (\d+)", tag="T1"), path)
+                self.assertEquals(list(s.search_iter()),
+                                  [(path, expected["part2"].find_by_path(path),
+                                    {})])
+                self.assertEquals(mock_submit_jobs.call_count, 0)
+
+                # results are only shared once
+                s = FileSearcher()
+                add_terms(s)
+                self.assertEquals(s.search().find_aggregate_by_tag("T2"),
+                                  {("ERROR",): 2, ("INFO",): 1})
+                self.assertEquals(mock_submit_jobs.call_count, 1)
+
+    def test_search_registry_shared_cache(self):
+        with tempfile.TemporaryDirectory() as dtmp:
+            path = os.path.join(dtmp, "test.log")
+            with open(path, 'w') as fd:
+                fd.write("ERROR 1\nINFO 2\n")
+
+            cache_dir = os.path.join(dtmp, "cache")
+            registry = SearchRegistry(cache_dir=cache_dir)
+            sd = SearchDef(r"^ERROR (\d+)", tag="T1")
+            registry.get_searcher("part1").add_search_term(sd, path)
+            registry.search()
+
+            # a consumer running later gets its results from the cache
+            s = FileSearcher(cache_dir=cache_dir)
+            s.add_search_term(sd, path)
+            results = s.search()
+            self.assertEquals(s.matchers, {})
+            self.assertEquals([r.get(1) for r in results.find_by_tag("T1")],
+                              ["1"])
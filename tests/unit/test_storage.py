@@ -177,3 +177,17 @@ class TestStoragePlugin03ceph_daemon_logs(utils.BaseTestCase):
                                                         'osd.1': 2}}}
         _03ceph_daemon_logs.get_ceph_daemon_log_checker()()
         self.assertEqual(_03ceph_daemon_logs.DAEMON_INFO, result)
+
+    def test_get_counts(self):
+        # in the order first seen
+        counts = {("osd.10", "2021-02-14"): 1, ("osd.2", "2021-02-13"): 2,
+                  ("osd.10", "2021-02-13"): 3}
+        get_counts = _03ceph_daemon_logs.CephDaemonLogChecks.get_counts
+        # dates are sorted, other values are in the order first seen
+        nested = get_counts(counts, date_level=1)
+        self.assertEqual(list(nested), ["osd.10", "osd.2"])
+        self.assertEqual(list(nested["osd.10"].items()),
+                         [("2021-02-13", 3), ("2021-02-14", 1)])
+        nested = get_counts({(k[1], k[0]): v for k, v in counts.items()})
+        self.assertEqual(list(nested), ["2021-02-13", "2021-02-14"])
+        self.assertEqual(list(nested["2021-02-13"]), ["osd.2", "osd.10"])
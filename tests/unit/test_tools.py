@@ -1,10 +1,20 @@
 import mock
+import os
 import tempfile
 import utils
 import yaml
 
+from common import (
+    constants,
+    issues_utils,
+    known_bugs_utils,
+    searchtools,
+)
 from tools import (
+    fleet_report,
     output_filter,
+    prescan,
+    run_plugins,
 )
 
 
@@ -51,3 +61,242 @@ class TestTools(utils.BaseTestCase):
                     result = yaml.load(fd)
 
                 self.assertEqual(result, expected)
+
+    def test_prescan_get_search_parts(self):
+        self.assertEqual(prescan.get_search_parts("openstack"),
+                         ["_03nova_external_events.py",
+                          "_08agent_checks.py"])
+        self.assertEqual(prescan.get_search_parts("storage"),
+                         ["_03ceph_daemon_logs.py"])
+        self.assertEqual(prescan.get_search_parts("kernel"), [])
+
+    def test_run_plugins_get_parts(self):
+        self.assertEqual(run_plugins.get_parts("storage"),
+                         ["_01ceph.py", "_02bcache.py",
+                          "_03ceph_daemon_logs.py",
+                          "_99known_bugs_and_issues.py"])
+        self.assertEqual(run_plugins.get_parts("storage", ["_02bcache.py",
+                                                           "_01kernel.py"]),
+                         ["_02bcache.py"])
+
+    @mock.patch.dict(os.environ, {})
+    @mock.patch.object(constants, "PLUGIN_TMP_DIR", "/tmp/foo")
+    @mock.patch.object(issues_utils, "PLUGIN_TMP_DIR", "/tmp/foo")
+    def test_run_plugins_set_constant(self):
+        run_plugins.set_constant("PLUGIN_TMP_DIR", "/tmp/bar")
+        self.assertEqual(constants.PLUGIN_TMP_DIR, "/tmp/bar")
+        # modules that imported the constant get the new value too
+        self.assertEqual(issues_utils.PLUGIN_TMP_DIR, "/tmp/bar")
+        self.assertEqual(os.environ["PLUGIN_TMP_DIR"], "/tmp/bar")
+
+    @mock.patch.dict(os.environ, {})
+    @mock.patch.object(constants, "PLUGIN_NAME", None)
+    @mock.patch.object(constants, "PART_NAME", None)
+    @mock.patch.object(constants, "PLUGIN_TMP_DIR", None)
+    @mock.patch.object(issues_utils, "PLUGIN_TMP_DIR", None)
+    def test_run_plugins_run_plugin(self):
+        with tempfile.NamedTemporaryFile() as ftmp:
+            with open(ftmp.name, 'w') as fd:
+                fd.write("hotsos:\n  version: development\n")
+
+            with mock.patch.object(constants, 'MASTER_YAML_OUT', ftmp.name):
+                run_plugins.run_plugin("kernel", ["_01kernel.py"])
+                with open(ftmp.name) as fd:
+                    result = yaml.safe_load(fd)
+
+        self.assertEqual(list(result), ["hotsos", "kernel"])
+        self.assertEqual(result["kernel"]["boot"],
+                         "ro console=tty0 console=ttyS0,115200 "
+                         "console=ttyS1,115200 panic=30 raid=noautodetect")
+
+    def test_run_plugins_get_dependencies(self):
+        self.assertEqual(run_plugins.get_dependencies("openstack",
+                                                      "_05network.py"),
+                         ["_02vm_info.py"])
+        self.assertEqual(run_plugins.get_dependencies("kernel",
+                                                      "_01kernel.py"), [])
+
+    @mock.patch.dict(os.environ, {})
+    @mock.patch.object(constants, "PLUGIN_NAME", None)
+    @mock.patch.object(constants, "PART_NAME", None)
+    @mock.patch.object(constants, "PLUGIN_TMP_DIR", None)
+    @mock.patch.object(issues_utils, "PLUGIN_TMP_DIR", None)
+    @mock.patch.object(known_bugs_utils, "PLUGIN_TMP_DIR", None)
+    def test_run_plugins_parallel(self):
+        plugins = ["openstack", "storage", "kernel"]
+        results = []
+        for max_parallel in [1, 4]:
+            with tempfile.NamedTemporaryFile() as ftmp:
+                with open(ftmp.name, 'w') as fd:
+                    fd.write("hotsos:\n  version: development\n")
+
+                with mock.patch.object(constants, 'MASTER_YAML_OUT',
+                                       ftmp.name):
+                    run_plugins.run_plugins(plugins,
+                                            max_parallel=max_parallel)
+
+                with open(ftmp.name, 'rb') as fd:
+                    results.append(fd.read())
+
+        self.assertEqual(list(yaml.safe_load(results[0])),
+                         ["hotsos"] + plugins)
+        # the output is the same as when parts run one after another
+        self.assertEqual(results[1], results[0])
+
+    @mock.patch.object(constants, "PLUGIN_NAME", None)
+    @mock.patch.object(constants, "PART_NAME", None)
+    @mock.patch.object(constants, "PLUGIN_TMP_DIR", None)
+    @mock.patch.object(issues_utils, "PLUGIN_TMP_DIR", None)
+    @mock.patch.object(known_bugs_utils, "PLUGIN_TMP_DIR", None)
+    @mock.patch.object(os, "cpu_count", lambda: 8)
+    def test_run_plugins_fleet_workers(self):
+        def fake_run_part(plugin, part):
+            # report the search workers the part may start and whether it
+            # inherited those of the process it was forked from.
+            with open(constants.MASTER_YAML_OUT, 'a') as fd:
+                fd.write("{}/{}: [{}, {}]\n".format(
+                         plugin, part, searchtools.FileSearcher().num_cpus,
+                         searchtools._POOL is not None))
+
+        plugins = ["openstack", "storage"]
+        # sosreports run concurrently by hotsos --fleet and the parallel
+        # tasks each of them is allowed.
+        expected = {0: (8, 1), 1: (1, 8), 3: (3, 2), 8: (8, 1), 20: (8, 1)}
+        for fleet_arg, (fleet_parallel, tasks) in expected.items():
+            with mock.patch.dict(os.environ):
+                os.environ.pop("USER_MAX_PARALLEL_TASKS", None)
+                self.assertEqual(run_plugins.get_fleet_parallel(fleet_arg),
+                                 (fleet_parallel, tasks))
+
+            # as exported by hotsos --fleet for each sosreport
+            env = {"USER_MAX_PARALLEL_TASKS": str(tasks)}
+            with mock.patch.dict(os.environ, env), \
+                    tempfile.NamedTemporaryFile() as ftmp, \
+                    mock.patch.object(constants, 'MASTER_YAML_OUT',
+                                      ftmp.name), \
+                    mock.patch.object(run_plugins, "run_part",
+                                      fake_run_part):
+                max_parallel = searchtools.FileSearcher().num_cpus
+                # e.g. started by the prescan
+                searchtools.get_pool(max_parallel)
+                run_plugins.run_plugins(plugins, max_parallel=max_parallel)
+                with open(ftmp.name) as fd:
+                    parts = yaml.safe_load(fd)
+
+            self.assertEqual(max_parallel, tasks)
+            self.assertEqual(len(parts), sum([len(run_plugins.get_parts(p))
+                                              for p in plugins]))
+            # each part only starts one search worker when they run
+            # concurrently, otherwise the run's share.
+            workers = set([v[0] for v in parts.values()])
+            if max_parallel > 1:
+                self.assertEqual(set([tuple(v) for v in parts.values()]),
+                                 {(1, False)})
+
+            # the workers of all sosreports fit in the cpus available
+            self.assertLessEqual(fleet_parallel * max(workers) *
+                                 min(max_parallel, len(parts)), 8)
+
+        searchtools.close_pool()
+
+    def test_fleet_report(self):
+        node1 = {"openstack":
+                 {"dpkg": ["nova-common 2:17.0.12", "neutron-common 2:12.1.0"],
+                  "agent-checks":
+                  {"agent-issues":
+                   {"neutron": {"neutron-openvswitch-agent":
+                                {"MessagingTimeout": {"2021-03-04": 2}}}}},
+                  "known-bugs": [{"https://pad.lv/1896506": "a bug"}],
+                  "potential-issues": [{"MemoryWarning": "a msg"}]},
+                 "storage":
+                 {"daemon-events":
+                  {"osd-reported-failed": {"osd.41": {"2021-02-13": 23},
+                                           "osd.85": {"2021-02-13": 4}},
+                   "heartbeat-no-reply": {"2021-02-13": {"osd.1": 2,
+                                                         "osd.2": 1},
+                                          "2021-02-14": {"osd.1": 1}}}}}
+        node2 = {"openstack":
+                 {"dpkg": ["nova-common 2:17.0.13"],
+                  "agent-checks":
+                  {"agent-issues":
+                   {"neutron": {"neutron-openvswitch-agent":
+                                {"MessagingTimeout": {
+                                    "2021-03-04_10:01": 1,
+                                    "2021-03-05_11:02": 2,
+                                    "2021-03-05_12:03": 1}}}}},
+                  "known-bugs": [{"https://pad.lv/1896506": "a bug"}]},
+                 "kubernetes": {"snaps": {"kubectl": "1.20.2"}}}
+        with tempfile.TemporaryDirectory() as dtmp:
+            paths = []
+            for name, summary in [("node1", node1), ("node2", node2)]:
+                path = os.path.join(dtmp, "{}.summary".format(name))
+                with open(path, 'w') as fd:
+                    fd.write(yaml.dump(summary))
+
+                paths.append(path)
+
+            report = fleet_report.build_report(paths)
+
+        self.assertEqual(report["num-nodes"], 2)
+        self.assertEqual(report["nodes"],
+                         {"node1": {"known-bugs": 1, "potential-issues": 1},
+                          "node2": {"known-bugs": 1, "potential-issues": 0}})
+        self.assertEqual(report["known-bugs"],
+                         {"https://pad.lv/1896506": {"description": "a bug",
+                                                     "nodes": 2}})
+        self.assertEqual(report["potential-issues"],
+                         {"(openstack) MemoryWarning": {"a msg": 1}})
+        self.assertEqual(report["agent-exceptions"],
+                         {"neutron": {"neutron-openvswitch-agent":
+                                      {"MessagingTimeout":
+                                       {"nodes": 2,
+                                        "per-day": {"2021-03-04": 3,
+                                                    "2021-03-05": 3}}}}})
+        self.assertEqual(report["daemon-events"],
+                         {"osd-reported-failed":
+                          {"nodes": 1, "per-day": {"2021-02-13": 27}},
+                          "heartbeat-no-reply":
+                          {"nodes": 1, "per-day": {"2021-02-13": 3,
+                                                   "2021-02-14": 1}}})
+        self.assertEqual(report["packages"],
+                         {"nova-common": {"2:17.0.12": 1, "2:17.0.13": 1},
+                          "neutron-common": {"2:12.1.0": 1},
+                          "kubectl": {"1.20.2": 1}})
+        self.assertEqual(report["nodes-by-num-bugs-and-issues"], {1: 1, 2: 1})
+
+    def test_fleet_report_same_name(self):
+        def fake_hotsos(cmd, cwd, **kwargs):
+            for i, sosreport in enumerate(cmd[2:]):
+                name = os.path.basename(sosreport)
+                with open(os.path.join(cwd, name + ".summary"), 'w') as fd:
+                    fd.write(yaml.dump({"openstack": {"potential-issues":
+                                                      [{"Issue": "msg"}] * i
+                                                      }}))
+
+        with tempfile.TemporaryDirectory() as dtmp:
+            paths = []
+            for parent in ["a", "b"]:
+                path = os.path.join(dtmp, parent, "sosreport")
+                os.makedirs(path)
+                paths.append(path)
+
+            path = os.path.join(dtmp, "sosreport.summary")
+            with open(path, 'w') as fd:
+                fd.write(yaml.dump({}))
+
+            paths.append(path)
+            self.assertEqual(fleet_report.get_node_names(paths),
+                             ["sosreport", "sosreport-2", "sosreport-3"])
+            with mock.patch.object(fleet_report.subprocess, "run") as \
+                    mock_run:
+                mock_run.side_effect = fake_hotsos
+                report = fleet_report.build_report(paths)
+
+        self.assertEqual(report["num-nodes"], 3)
+        self.assertEqual(report["nodes"],
+                         {"sosreport": {"known-bugs": 0,
+                                        "potential-issues": 0},
+                          "sosreport-2": {"known-bugs": 0,
+                                          "potential-issues": 1},
+                          "sosreport-3": {"known-bugs": 0,
+                                          "potential-issues": 0}})
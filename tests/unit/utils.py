@@ -7,6 +7,8 @@ import unittest
 
 
 sys.path += ['plugins']
+# tools import each other as they do when run as scripts
+sys.path += ['tools']
 
 # Must be set prior to other imports
 TESTS_DIR = os.environ["TESTS_DIR"]
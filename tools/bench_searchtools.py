@@ -0,0 +1,270 @@
+#!/usr/bin/python3
+"""
+Benchmarks for common.searchtools. Each benchmark generates its own synthetic
+data in a temporary directory and prints its results as yaml.
+"""
+import argparse
+import gzip
+import lzma
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+from common import plugin_yaml
+from common.searchtools import (
+    FileSearcher,
+    SearchDef,
+    SearchResult,
+    SearchResultsCollection,
+    TokenIndexStore,
+)
+
+HOTSOS = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..",
+                      "hotsos.sh")
+FAKE_DATA_ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                              "..", "tests/unit/fake_data_root")
+LOG_LINE = ("2021-02-25 14:22:18.861 {} INFO neutron.agent.l3.agent [-] "
+            "Finished a router update for {}, update_id {}.\n")
+
+
+def create_log(path, num_lines, errors=None):
+    """
+    Write a synthetic log to path. Every line is an INFO line except for
+    every 1000th line which is an ERROR line containing one of errors.
+    """
+    errors = errors or []
+    with open(path, 'w') as fd:
+        for i in range(num_lines):
+            if errors and not i % 1000:
+                fd.write("2021-02-25 14:22:18.861 {} ERROR foo [-] {}: "
+                         "something went wrong\n".
+                         format(i, errors[i % len(errors)]))
+            else:
+                fd.write(LOG_LINE.format(i, "9b8efc4c", i))
+
+
+def bench_terms(args):
+    """
+    Time searching a log with an increasing number of registered search
+    terms to show that the per-line cost is flat in the number of terms.
+    """
+    out = {}
+    errors = ["SomeException{}".format(i) for i in range(max(args.terms))]
+    with tempfile.TemporaryDirectory() as dtmp:
+        path = os.path.join(dtmp, "bench.log")
+        create_log(path, args.lines, errors)
+        for num_terms in args.terms:
+            s = FileSearcher()
+            for exc in errors[:num_terms]:
+                expr = r"^([0-9\-]+) (\S+) .+ ({}):.*".format(exc)
+                s.add_search_term(SearchDef(expr, tag=exc,
+                                            hint="({})".format(exc)), path)
+
+            start = time.time()
+            results = s.search()
+            elapsed = time.time() - start
+            out[num_terms] = {"secs": round(elapsed, 3),
+                              "ns-per-line": int(elapsed * 1e9 / args.lines),
+                              "matches": len(results.find_by_path(path))}
+
+    return {"num-lines": args.lines, "num-terms": out}
+
+
+def bench_memory(args):
+    """
+    Measure the memory used by the results of a search in which every line
+    matches.
+    """
+    with tempfile.TemporaryDirectory() as dtmp:
+        path = os.path.join(dtmp, "bench.log")
+        create_log(path, args.lines)
+        s = FileSearcher()
+        s.add_search_term(SearchDef(r"^([0-9\-]+) (\S+) (\d+) INFO .+ "
+                                    r"router update for (\S+),",
+                                    tag="update"), path)
+        tracemalloc.start()
+        start = time.time()
+        results = s.search()
+        elapsed = time.time() - start
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        num_results = len(results.find_by_path(path))
+
+    return {"num-lines": args.lines,
+            "matches": num_results,
+            "secs": round(elapsed, 3),
+            "results-mib": round(current / 1024 ** 2, 1),
+            "peak-mib": round(peak / 1024 ** 2, 1),
+            "bytes-per-result": int(current / max(num_results, 1))}
+
+
+def bench_find_by_tag(args):
+    """
+    Time looking up results by tag, with and without a path, in a synthetic
+    collection of results spread across files and tags.
+    """
+    num_files = 100
+    num_tags = 1000
+    collection = SearchResultsCollection()
+    start = time.time()
+    for f in range(num_files):
+        path = "file{}.log".format(f)
+        results = []
+        for i in range(args.results // num_files):
+            results.append(SearchResult(i + 1, path,
+                                        "tag{}".format(i % num_tags),
+                                        ("foo", str(i))))
+
+        collection.add(path, results)
+
+    out = {"num-results": args.results,
+           "num-files": num_files,
+           "num-tags": num_tags,
+           "add-secs": round(time.time() - start, 3)}
+
+    start = time.time()
+    for t in range(num_tags):
+        collection.find_by_tag("tag{}".format(t))
+
+    out["find-by-tag-us"] = int((time.time() - start) * 1e6 / num_tags)
+    start = time.time()
+    for t in range(num_tags):
+        collection.find_by_tag("tag{}".format(t), path="file0.log")
+
+    out["find-by-tag-and-path-us"] = int((time.time() - start) * 1e6 /
+                                         num_tags)
+    return out
+
+
+def bench_compressed(args):
+    """
+    Time searching the same log plain and in each supported compression
+    format.
+    """
+    out = {}
+    errors = ["SomeException{}".format(i) for i in range(10)]
+    with tempfile.TemporaryDirectory() as dtmp:
+        path = os.path.join(dtmp, "bench.log")
+        create_log(path, args.lines, errors)
+        paths = {"plain": path}
+        with open(path, 'rb') as fd:
+            data = fd.read()
+
+        paths["gzip"] = "{}.1.gz".format(path)
+        with open(paths["gzip"], 'wb') as fd:
+            fd.write(gzip.compress(data))
+
+        paths["xz"] = "{}.2.xz".format(path)
+        with open(paths["xz"], 'wb') as fd:
+            fd.write(lzma.compress(data))
+
+        for name, path in paths.items():
+            s = FileSearcher()
+            for exc in errors:
+                expr = r"^([0-9\-]+) (\S+) .+ ({}):.*".format(exc)
+                s.add_search_term(SearchDef(expr, tag=exc,
+                                            hint="({})".format(exc)), path)
+
+            start = time.time()
+            results = s.search()
+            elapsed = time.time() - start
+            out[name] = {"secs": round(elapsed, 3),
+                         "matches": len(results.find_by_path(path))}
+
+    return {"num-lines": args.lines, "pigz": bool(shutil.which("pigz")),
+            "formats": out}
+
+
+def bench_token_index(args):
+    """
+    Time searching a log for a rare term with a literal hint with and
+    without a token index of the log.
+    """
+    with tempfile.TemporaryDirectory() as dtmp:
+        path = os.path.join(dtmp, "bench.log")
+        create_log(path, args.lines)
+        with open(path, 'a') as fd:
+            fd.write("2021-02-25 14:22:18.861 {} ERROR foo [-] "
+                     "SomeException3: something went wrong\n".
+                     format(args.lines))
+        index_dir = os.path.join(dtmp, "index")
+        start = time.time()
+        TokenIndexStore(index_dir).build([path])
+        out = {"build-secs": round(time.time() - start, 3),
+               "index-mib": round(sum([os.path.getsize(os.path.join(
+                   index_dir, f)) for f in os.listdir(index_dir)]) /
+                   1024 ** 2, 1)}
+        # the plain search must not use any index set by the caller, whose
+        # setting is restored however the searches end.
+        saved = os.environ.pop("SEARCH_INDEX_DIR", None)
+        try:
+            for name in ["plain", "indexed"]:
+                if name == "indexed":
+                    os.environ["SEARCH_INDEX_DIR"] = index_dir
+
+                s = FileSearcher()
+                s.add_search_term(SearchDef(r"^([0-9\-]+) (\S+) .+ "
+                                            r"(SomeException3):.*",
+                                            hint="SomeException3"), path)
+                start = time.time()
+                results = s.search()
+                out[name] = {"secs": round(time.time() - start, 3),
+                             "matches": len(results.find_by_path(path))}
+        finally:
+            os.environ.pop("SEARCH_INDEX_DIR", None)
+            if saved is not None:
+                os.environ["SEARCH_INDEX_DIR"] = saved
+
+    return {"num-lines": args.lines, "search": out}
+
+
+def bench_e2e(args):
+    """
+    Time complete runs of hotsos, with the results cache disabled, against a
+    sosreport.
+    """
+    times = []
+    for _ in range(args.runs):
+        start = time.time()
+        subprocess.run([HOTSOS, "--no-cache", args.data_root],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                       check=True)
+        times.append(time.time() - start)
+
+    return {"data-root": args.data_root,
+            "runs": args.runs,
+            "mean-secs": round(sum(times) / len(times), 3),
+            "min-secs": round(min(times), 3)}
+
+
+BENCHMARKS = {"terms": bench_terms,
+              "compressed": bench_compressed,
+              "memory": bench_memory,
+              "find-by-tag": bench_find_by_tag,
+              "token-index": bench_token_index,
+              "e2e": bench_e2e}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="searchtools benchmarks")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--lines", type=int, default=200000,
+                        help="number of lines in generated logs")
+    parser.add_argument("--terms", type=int, nargs="+",
+                        default=[1, 10, 100, 500],
+                        help="number of search terms to register")
+    parser.add_argument("--results", type=int, default=1000000,
+                        help="number of results in generated collections")
+    parser.add_argument("--data-root", default=FAKE_DATA_ROOT,
+                        help="sosreport to run against")
+    parser.add_argument("--runs", type=int, default=5,
+                        help="number of end-to-end runs")
+    args = parser.parse_args()
+    if not os.environ.get("USER_MAX_PARALLEL_TASKS"):
+        os.environ["USER_MAX_PARALLEL_TASKS"] = str(os.cpu_count())
+
+    result = BENCHMARKS[args.benchmark](args)
+    plugin_yaml.dump({args.benchmark: result}, ensure_master_has_plugin=False)
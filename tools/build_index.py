@@ -0,0 +1,29 @@
+#!/usr/bin/python3
+"""
+Build the token index of logs so that later searches of them for terms with
+literal hints only read the parts of each log that contain those hints.
+Indexes are stored in SEARCH_INDEX_DIR and are only used for as long as the
+file they were built from is unchanged.
+"""
+import os
+import sys
+
+from common.searchtools import (
+    FileSearcher,
+    TokenIndexStore,
+)
+
+
+if __name__ == "__main__":
+    index_dir = os.environ.get("SEARCH_INDEX_DIR")
+    if not index_dir:
+        sys.stderr.write("ERROR: SEARCH_INDEX_DIR not set\n")
+        sys.exit(1)
+
+    paths = sys.argv[1:]
+    if not paths:
+        paths = [os.path.join(os.environ.get("DATA_ROOT", "/"), "var/log")]
+
+    store = TokenIndexStore(index_dir)
+    num_indexed = store.build(paths, FileSearcher().num_cpus)
+    sys.stderr.write("INFO: indexed {} files\n".format(num_indexed))
@@ -0,0 +1,267 @@
+#!/usr/bin/python3
+"""
+Aggregate the output of hotsos across the nodes of a cloud into one report.
+
+Summaries are read one at a time and only their aggregates kept so memory
+used is bounded by the number of distinct bugs, issues, exceptions, events
+and packages found rather than by the number of nodes.
+"""
+import argparse
+import os
+import re
+import subprocess
+import tempfile
+import yaml
+
+from common import (
+    issues_utils,
+    plugin_yaml,
+)
+
+HOTSOS = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..",
+                      "hotsos.sh")
+SUMMARY_EXT = ".summary"
+# See known_bugs_utils, which is not imported since doing so logs in to
+# Launchpad.
+MASTER_YAML_KNOWN_BUGS_KEY = "known-bugs"
+# Counts are keyed by date, optionally followed by a time e.g. when agent
+# exceptions are keyed by time.
+DAY_EXPR = re.compile(r"^([0-9]{4}-[0-9]{2}-[0-9]{2})")
+
+
+class FleetReport(object):
+
+    def __init__(self):
+        """
+        Aggregate of the summaries of many nodes. For each thing found we
+        keep the number of nodes it was found on and, for things counted by
+        day, a histogram of their counts across nodes.
+        """
+        self.num_nodes = 0
+        # per node number of bugs and issues found
+        self.nodes = {}
+        self.known_bugs = {}
+        self.potential_issues = {}
+        self.agent_exceptions = {}
+        self.daemon_events = {}
+        self.packages = {}
+
+    @staticmethod
+    def _add_per_day(entry, counts):
+        """
+        Add counts by day to the histogram of entry. Counts may be nested
+        e.g. by daemon as well as by date, at any level, in which case those
+        of the same day are summed.
+        """
+        entry["nodes"] += 1
+        # (counts, day of the level above if any)
+        stack = [(counts, None)]
+        while stack:
+            counts, day = stack.pop()
+            for key, value in counts.items():
+                ret = DAY_EXPR.match(str(key))
+                if ret:
+                    key_day = ret.group(1)
+                else:
+                    key_day = day
+
+                if isinstance(value, dict):
+                    stack.append((value, key_day))
+                    continue
+
+                if key_day is None:
+                    # not counted by day
+                    continue
+
+                if key_day not in entry["per-day"]:
+                    entry["per-day"][key_day] = 0
+
+                entry["per-day"][key_day] += value
+
+    def _add_packages(self, packages):
+        """
+        @param packages: dict of package name and version found on a node.
+        """
+        for name, version in packages.items():
+            version = str(version)
+            if name not in self.packages:
+                self.packages[name] = {}
+
+            if version not in self.packages[name]:
+                self.packages[name][version] = 0
+
+            self.packages[name][version] += 1
+
+    def add(self, node, summary):
+        """
+        Add the summary of a node to the report.
+
+        @param node: name of the node
+        @param summary: dict of the hotsos output for the node.
+        """
+        self.num_nodes += 1
+        num_bugs = 0
+        num_issues = 0
+        packages = {}
+        for plugin, info in (summary or {}).items():
+            if not isinstance(info, dict):
+                continue
+
+            bugs = info.get(MASTER_YAML_KNOWN_BUGS_KEY, [])
+            for bug in bugs:
+                for url, description in bug.items():
+                    num_bugs += 1
+                    if url not in self.known_bugs:
+                        self.known_bugs[url] = {"description": description,
+                                                "nodes": 0}
+
+                    self.known_bugs[url]["nodes"] += 1
+
+            issues = info.get(issues_utils.MASTER_YAML_ISSUES_FOUND_KEY, [])
+            for issue in issues:
+                for issue_type, msg in issue.items():
+                    num_issues += 1
+                    key = "({}) {}".format(plugin, issue_type)
+                    if key not in self.potential_issues:
+                        self.potential_issues[key] = {}
+
+                    if msg not in self.potential_issues[key]:
+                        self.potential_issues[key][msg] = 0
+
+                    self.potential_issues[key][msg] += 1
+
+            agent_issues = info.get("agent-checks", {}).get("agent-issues",
+                                                            {})
+            for service, agents in agent_issues.items():
+                if service not in self.agent_exceptions:
+                    self.agent_exceptions[service] = {}
+
+                for agent, exceptions in agents.items():
+                    if agent not in self.agent_exceptions[service]:
+                        self.agent_exceptions[service][agent] = {}
+
+                    entries = self.agent_exceptions[service][agent]
+                    for exc, counts in exceptions.items():
+                        if exc not in entries:
+                            entries[exc] = {"nodes": 0, "per-day": {}}
+
+                        self._add_per_day(entries[exc], counts)
+
+            for event, counts in info.get("daemon-events", {}).items():
+                if event not in self.daemon_events:
+                    self.daemon_events[event] = {"nodes": 0, "per-day": {}}
+
+                self._add_per_day(self.daemon_events[event], counts)
+
+            for pkg in info.get("dpkg", []):
+                name, _, version = pkg.partition(" ")
+                packages[name] = version
+
+            packages.update(info.get("snaps", {}))
+
+        # packages installed by more than one plugin are only counted once
+        self._add_packages(packages)
+        self.nodes[node] = {"known-bugs": num_bugs,
+                            "potential-issues": num_issues}
+
+    @property
+    def report(self):
+        report = {"num-nodes": self.num_nodes}
+        for key, value in [("nodes", self.nodes),
+                           ("known-bugs", self.known_bugs),
+                           ("potential-issues", self.potential_issues),
+                           ("agent-exceptions", self.agent_exceptions),
+                           ("daemon-events", self.daemon_events),
+                           ("packages", self.packages)]:
+            if value:
+                report[key] = value
+
+        # Histogram of the number of nodes by number of bugs and issues
+        # found on them.
+        by_count = {}
+        for counts in self.nodes.values():
+            count = counts["known-bugs"] + counts["potential-issues"]
+            by_count[count] = by_count.get(count, 0) + 1
+
+        if by_count:
+            report["nodes-by-num-bugs-and-issues"] = \
+                {k: by_count[k] for k in sorted(by_count)}
+
+        return report
+
+
+def get_node_names(paths):
+    """
+    Returns the name of the node of each path. Names are the basename of the
+    path, with a numeric suffix added where that would be the same as that of
+    another path.
+
+    @param paths: list of paths to summaries or sosreports.
+    """
+    names = []
+    for path in paths:
+        name = os.path.basename(os.path.normpath(path))
+        if not os.path.isdir(path) and name.endswith(SUMMARY_EXT):
+            name = name[:-len(SUMMARY_EXT)]
+
+        unique = name
+        suffix = 1
+        while unique in names:
+            suffix += 1
+            unique = "{}-{}".format(name, suffix)
+
+        names.append(unique)
+
+    return names
+
+
+def get_summaries(paths, dtmp):
+    """
+    Yields the name and path of the summary of each node. Sosreports are
+    analysed with hotsos, concurrently, with their summaries saved in dtmp.
+
+    @param paths: list of paths to summaries or sosreports.
+    """
+    nodes = list(zip(get_node_names(paths), paths))
+    sosreports = []
+    for name, path in nodes:
+        if os.path.isdir(path):
+            # hotsos names summaries after the sosreport so each is linked
+            # to by the unique name of its node.
+            link = os.path.join(dtmp, "sosreports", name)
+            os.makedirs(os.path.dirname(link), exist_ok=True)
+            os.symlink(os.path.abspath(path), link)
+            sosreports.append(link)
+
+    if sosreports:
+        subprocess.run([HOTSOS, "--fleet"] + sosreports, cwd=dtmp,
+                       stdout=subprocess.DEVNULL, check=True)
+
+    for name, path in nodes:
+        if os.path.isdir(path):
+            path = os.path.join(dtmp, name + SUMMARY_EXT)
+
+        yield name, path
+
+
+def build_report(paths):
+    """
+    Returns the aggregate report of the summaries or sosreports in paths.
+    """
+    fleet = FleetReport()
+    with tempfile.TemporaryDirectory() as dtmp:
+        for name, path in get_summaries(paths, dtmp):
+            with open(path) as fd:
+                fleet.add(name, yaml.safe_load(fd))
+
+    return fleet.report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="aggregate hotsos output "
+                                                 "across nodes")
+    parser.add_argument("paths", nargs="+",
+                        help="hotsos summary (see --save) or sosreport of "
+                             "each node")
+    args = parser.parse_args()
+    plugin_yaml.dump(build_report(args.paths), ensure_master_has_plugin=False)
@@ -1,6 +1,4 @@
 #!/usr/bin/python3
-import yaml
-
 from common import (
     constants,
     issues_utils,
@@ -13,8 +11,7 @@ FILTER_SCHEMA = [issues_utils.MASTER_YAML_ISSUES_FOUND_KEY,
 
 
 def filter_master_yaml():
-    with open(constants.MASTER_YAML_OUT) as fd:
-        master_yaml = yaml.safe_load(fd)
+    master_yaml = plugin_yaml.get_master_yaml()
 
     # Create a master list of issues and bugs adding info about which plugin
     # added them.
@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+"""
+Execute the searches of all plugin parts up front with a single scan of each
+file. Parts declare their searches by implementing register_search_terms()
+and when they later run the same searches themselves, from this process or
+one forked from it, they get their share of the results without searching
+again.
+"""
+import importlib
+import os
+import sys
+import traceback
+
+from common.searchtools import SearchRegistry
+
+PLUGINS_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                           "..", "plugins")
+PART_SEARCH_HOOK = "register_search_terms"
+# Number of slowest files reported in debug mode.
+MAX_TIMINGS = 10
+
+
+def get_search_parts(plugin):
+    """Returns the names of parts of plugin that declare searches."""
+    plugin_dir = os.path.join(PLUGINS_DIR, plugin)
+    parts = []
+    for part in sorted(os.listdir(plugin_dir)):
+        if not part.startswith("_") or not part.endswith(".py"):
+            continue
+
+        with open(os.path.join(plugin_dir, part)) as fd:
+            if "def {}(".format(PART_SEARCH_HOOK) in fd.read():
+                parts.append(part)
+
+    return parts
+
+
+def register_plugin_searches(registry, plugin):
+    """Register the searches of all parts of plugin in registry."""
+    plugin_dir = os.path.join(PLUGINS_DIR, plugin)
+    sys.path.insert(0, plugin_dir)
+    try:
+        for part in get_search_parts(plugin):
+            try:
+                module = importlib.import_module(part[:-len(".py")])
+                searchobj = registry.get_searcher("{}.{}".format(plugin,
+                                                                 part))
+                getattr(module, PART_SEARCH_HOOK)(searchobj)
+            except Exception:
+                # The part will run its own search so just report this.
+                sys.stderr.write("WARNING: unable to prescan {}.{}\n{}".
+                                 format(plugin, part, traceback.format_exc()))
+    finally:
+        sys.path.remove(plugin_dir)
+
+
+def prescan(plugins):
+    """Execute the searches of all parts of plugins."""
+    registry = SearchRegistry()
+    for plugin in plugins:
+        register_plugin_searches(registry, plugin)
+
+    registry.search(share=True)
+    if os.environ.get("DEBUG_MODE") == "true":
+        sys.stderr.write("Prescan slowest files:\n")
+        timings = sorted(registry.timings.items(), key=lambda t: t[1],
+                         reverse=True)
+        for path, secs in timings[:MAX_TIMINGS]:
+            sys.stderr.write(" {} ({:.3f}s)\n".format(path, secs))
+
+
+if __name__ == "__main__":
+    prescan(sys.argv[1:])
@@ -0,0 +1,435 @@
+#!/usr/bin/python3
+"""
+Run the parts of plugins from this interpreter rather than each in its own so
+that the cost of starting python and importing common modules, yaml and
+launchpadlib is only paid once per run.
+
+If parallel tasks are allowed, each part runs in a process forked from this
+one so that parts, of the same or different plugins, run concurrently, each
+with a single search worker so that together they use no more than the
+parallel tasks allowed. Parts
+that read what other parts output declare them in PART_DEPENDENCIES and only
+run once those have run.
+Output is appended to MASTER_YAML_OUT in order of plugin then _NN priority of
+part so that it is the same as if parts had run one after another.
+"""
+import argparse
+import ast
+import contextlib
+import copy
+import functools
+import multiprocessing
+import multiprocessing.connection
+import os
+import runpy
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+import yaml
+
+from common import (
+    constants,
+    helpers,
+)
+from common.searchtools import (
+    FileSearcher,
+    close_pool,
+)
+
+import prescan
+
+PLUGINS_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                           "..", "plugins")
+# Helpers whose results may change during a run so are not cached.
+UNCACHED_HELPERS = ["get_date"]
+# Name of the list of parts of the same plugin that a part must run after,
+# e.g. because it reads their output from the master yaml.
+PART_DEPENDENCIES = "PART_DEPENDENCIES"
+# Parts of this priority collect what the other parts of their plugin found
+# so only run once all of them have run.
+LAST_PRIORITY = "_99"
+# Files in PLUGIN_TMP_DIR in which parts collect what they find, see
+# issues_utils and known_bugs_utils, and whether each of their entries is
+# only added once.
+PLUGIN_TMP_FILES = {"issues.yaml": False, "known_bugs.yaml": True}
+
+
+def get_parts(plugin, parts=None):
+    """
+    Returns the names of the parts of plugin in the order they are run.
+
+    @param parts: optional list of names of parts to run. If not provided
+                  all parts of the plugin are run.
+    """
+    plugin_dir = os.path.join(PLUGINS_DIR, plugin)
+    if parts:
+        return [p for p in parts if os.access(os.path.join(plugin_dir, p),
+                                              os.R_OK)]
+
+    ordered = []
+    for priority in range(100):
+        prefix = "_{:02d}".format(priority)
+        ordered += sorted([p for p in os.listdir(plugin_dir)
+                           if p.startswith(prefix)])
+
+    return ordered
+
+
+def cached(func):
+    """
+    Cache the results of func. Callers get a copy of them so that they are
+    free to modify them as they would if each part was run on its own.
+    """
+    func = functools.lru_cache(maxsize=None)(func)
+
+    @functools.wraps(func)
+    def cached_inner(*args, **kwargs):
+        return copy.deepcopy(func(*args, **kwargs))
+
+    return cached_inner
+
+
+def cache_helpers():
+    """
+    Cache the data sources of helpers since they are used by many parts and
+    do not change during a run.
+    """
+    for name in dir(helpers):
+        if name.startswith("get_") and name not in UNCACHED_HELPERS:
+            setattr(helpers, name, cached(getattr(helpers, name)))
+
+
+def set_constant(name, value):
+    """
+    Set constant name for the plugin or part about to run. Modules that
+    imported it from common.constants have their own reference to it so
+    those are updated too.
+    """
+    os.environ[name] = value
+    current = getattr(constants, name)
+    for module in list(sys.modules.values()):
+        if name in getattr(module, "__dict__", {}):
+            if getattr(module, name) is current:
+                setattr(module, name, value)
+
+    setattr(constants, name, value)
+
+
+def run_part(plugin, part):
+    """
+    Run a part of plugin with its output appended to MASTER_YAML_OUT. As
+    when parts are run on their own, a part that fails does not stop the
+    others from running.
+    """
+    set_constant("PART_NAME", part)
+    path = os.path.join(PLUGINS_DIR, plugin, part)
+    argv = sys.argv
+    sys.argv = [path]
+    try:
+        # line buffered so that parts see what they have already output
+        with open(constants.MASTER_YAML_OUT, 'a', buffering=1) as fd:
+            with contextlib.redirect_stdout(fd):
+                runpy.run_path(path, run_name="__main__")
+    except SystemExit:
+        pass
+    except Exception:
+        traceback.print_exc()
+    finally:
+        sys.argv = argv
+
+
+def run_plugin(plugin, parts=None, debug=False):
+    """
+    Run the parts of plugin, each with the plugin directory first in the
+    path as if it had been run as a script.
+    """
+    if debug:
+        sys.stderr.write("{}:  \n".format(plugin.upper()))
+
+    plugin_dir = os.path.join(PLUGINS_DIR, plugin)
+    plugin_tmp_dir = tempfile.mkdtemp()
+    set_constant("PLUGIN_NAME", plugin)
+    set_constant("PLUGIN_TMP_DIR", plugin_tmp_dir)
+    sys.path.insert(0, plugin_dir)
+    try:
+        for part in get_parts(plugin, parts):
+            start = time.time()
+            run_part(plugin, part)
+            if debug:
+                sys.stderr.write(" {} ({:.3f}s)\n".format(part, time.time() -
+                                                          start))
+    finally:
+        sys.path.remove(plugin_dir)
+        shutil.rmtree(plugin_tmp_dir)
+
+    if debug:
+        sys.stderr.write("\n")
+
+
+class Part(object):
+
+    def __init__(self, plugin, name, path):
+        """
+        A part of a plugin run in its own process.
+
+        Since parts run concurrently each has its own copy of the master yaml
+        and its own PLUGIN_TMP_DIR, both kept in path, and what it outputs is
+        merged into the master yaml in the order parts would have run one
+        after another.
+
+        @param plugin: name of the plugin
+        @param name: name of the part
+        @param path: directory in which the part keeps its state
+        """
+        self.plugin = plugin
+        self.name = name
+        self.master_yaml = os.path.join(path, "master.yaml")
+        self.tmp_dir = os.path.join(path, "tmp")
+        # parts of the plugin that come before this one
+        self.preceding = []
+        # parts that must have run before this one
+        self.dependencies = []
+        self.process = None
+        # size of the copy of the master yaml before the part ran
+        self.offset = 0
+        self.output = None
+        self.start_time = None
+        self.elapsed = None
+
+    @property
+    def done(self):
+        return self.output is not None
+
+    @property
+    def ready(self):
+        """
+        Returns True if the part can run i.e. its dependencies have run and
+        whether any part before it has output anything is known. The latter
+        matters since the first part of a plugin to output anything adds the
+        plugin to the master yaml and the others add to it.
+        """
+        if not all([p.done for p in self.dependencies]):
+            return False
+
+        if any([p.done and p.output for p in self.preceding]):
+            return True
+
+        return all([p.done for p in self.preceding])
+
+    def start(self, master):
+        """
+        Start running the part.
+
+        @param master: contents of the master yaml before any plugin ran.
+        """
+        os.makedirs(self.tmp_dir)
+        if self.name.startswith(LAST_PRIORITY):
+            merge_tmp_files(self.preceding, self.tmp_dir)
+
+        master += b"".join([p.output for p in self.preceding if p.done])
+        with open(self.master_yaml, 'wb') as fd:
+            fd.write(master)
+
+        self.offset = len(master)
+        self.start_time = time.time()
+        self.process = multiprocessing.get_context("fork").Process(
+            target=self._run)
+        self.process.start()
+
+    def _run(self):
+        # parts run concurrently so share the parallel tasks allowed
+        os.environ["USER_MAX_PARALLEL_TASKS"] = "1"
+        set_constant("PLUGIN_NAME", self.plugin)
+        set_constant("PLUGIN_TMP_DIR", self.tmp_dir)
+        set_constant("MASTER_YAML_OUT", self.master_yaml)
+        sys.path.insert(0, os.path.join(PLUGINS_DIR, self.plugin))
+        run_part(self.plugin, self.name)
+
+    def finish(self):
+        """Collect what the part output once its process has exited."""
+        self.process.join()
+        self.elapsed = time.time() - self.start_time
+        with open(self.master_yaml, 'rb') as fd:
+            fd.seek(self.offset)
+            self.output = fd.read()
+
+
+def get_dependencies(plugin, part):
+    """
+    Returns the names of the parts that part declares, with
+    PART_DEPENDENCIES, that it must run after. The part is not imported to
+    get them.
+    """
+    with open(os.path.join(PLUGINS_DIR, plugin, part)) as fd:
+        tree = ast.parse(fd.read())
+
+    for node in tree.body:
+        if not isinstance(node, ast.Assign):
+            continue
+
+        for target in node.targets:
+            if (isinstance(target, ast.Name) and
+                    target.id == PART_DEPENDENCIES):
+                return ast.literal_eval(node.value)
+
+    return []
+
+
+def merge_tmp_files(parts, tmp_dir):
+    """
+    Merge what parts collected in their PLUGIN_TMP_DIR into tmp_dir as if
+    they had run one after another with tmp_dir as their PLUGIN_TMP_DIR.
+    """
+    for name, unique in PLUGIN_TMP_FILES.items():
+        merged = {}
+        for part in parts:
+            path = os.path.join(part.tmp_dir, name)
+            if not os.path.exists(path):
+                continue
+
+            with open(path) as fd:
+                found = yaml.safe_load(fd) or {}
+
+            for key, entries in found.items():
+                if key not in merged:
+                    merged[key] = []
+
+                for entry in entries:
+                    if not unique or entry not in merged[key]:
+                        merged[key].append(entry)
+
+        if merged:
+            with open(os.path.join(tmp_dir, name), 'w') as fd:
+                fd.write(yaml.dump(merged))
+
+
+def get_plugin_parts(plugins, parts, path):
+    """
+    Returns a list of Part for each part of plugins to run in the order they
+    would run one after another.
+
+    @param path: directory in which parts keep their state.
+    """
+    ordered = []
+    for plugin in plugins:
+        plugin_parts = []
+        for name in get_parts(plugin, parts):
+            part = Part(plugin, name, os.path.join(path, plugin, name))
+            part.preceding = list(plugin_parts)
+            if name.startswith(LAST_PRIORITY):
+                part.dependencies = list(plugin_parts)
+            else:
+                dependencies = get_dependencies(plugin, name)
+                part.dependencies = [p for p in plugin_parts
+                                     if p.name in dependencies]
+
+            plugin_parts.append(part)
+
+        ordered += plugin_parts
+
+    return ordered
+
+
+def get_fleet_parallel(fleet_parallel=0):
+    """
+    Share the parallel tasks allowed for a single run between the sosreports
+    that hotsos --fleet runs concurrently so that together they do not use
+    more than that.
+
+    @param fleet_parallel: number of sosreports to run concurrently. 0 or
+                           more than the parallel tasks allowed means as many
+                           as those.
+    @return: tuple of the number of sosreports to run concurrently and the
+             parallel tasks allowed for each of them.
+    """
+    max_parallel = FileSearcher().num_cpus
+    if fleet_parallel <= 0 or fleet_parallel > max_parallel:
+        fleet_parallel = max_parallel
+
+    return fleet_parallel, max_parallel // fleet_parallel
+
+
+def run_plugins(plugins, parts=None, max_parallel=1, debug=False):
+    """
+    Run the parts of plugins, up to max_parallel at a time, appending their
+    output to MASTER_YAML_OUT. Parts run as soon as the parts they depend
+    on have run. The master yaml is the same as if the parts had run one
+    after another, which they do in this process if max_parallel is 1.
+
+    @param parts: optional list of names of parts to run. If not provided
+                  all parts of the plugins are run.
+    """
+    if max_parallel <= 1:
+        for plugin in plugins:
+            run_plugin(plugin, parts, debug)
+
+        return
+
+    with open(constants.MASTER_YAML_OUT, 'rb') as fd:
+        master = fd.read()
+
+    # Parts are forked from this process so stop the search workers, and
+    # the threads that manage them, first. Forking while other threads are
+    # running can leave parts with locks that are never released.
+    close_pool()
+    with tempfile.TemporaryDirectory() as dtmp:
+        ordered = get_plugin_parts(plugins, parts, dtmp)
+        pending = list(ordered)
+        running = []
+        num_merged = 0
+        while pending or running:
+            for part in list(pending):
+                if len(running) >= max_parallel:
+                    break
+
+                if part.ready:
+                    pending.remove(part)
+                    part.start(master)
+                    running.append(part)
+
+            multiprocessing.connection.wait([p.process.sentinel
+                                             for p in running])
+            for part in list(running):
+                if not part.process.is_alive():
+                    part.finish()
+                    running.remove(part)
+
+            with open(constants.MASTER_YAML_OUT, 'ab') as fd:
+                while num_merged < len(ordered):
+                    if not ordered[num_merged].done:
+                        break
+
+                    fd.write(ordered[num_merged].output)
+                    num_merged += 1
+
+    if debug:
+        for plugin in plugins:
+            sys.stderr.write("{}:  \n".format(plugin.upper()))
+            for part in ordered:
+                if part.plugin == plugin:
+                    sys.stderr.write(" {} ({:.3f}s)\n".format(part.name,
+                                                              part.elapsed))
+
+            sys.stderr.write("\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="run hotsos plugins")
+    parser.add_argument("plugins", nargs="+")
+    parser.add_argument("--part", action="append", dest="parts",
+                        help="name of a part to run. May be specified "
+                             "multiple times. Defaults to all parts.")
+    args = parser.parse_args()
+    debug = os.environ.get("DEBUG_MODE") == "true"
+    cache_helpers()
+    # Execute the searches declared by all parts up front so that each file
+    # is only read once. Not worth it when running specific parts.
+    if not args.parts:
+        prescan.prescan(args.plugins)
+
+    if debug:
+        sys.stderr.write("Running plugins:\n\n")
+
+    run_plugins(args.plugins, args.parts, FileSearcher().num_cpus, debug)